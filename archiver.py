@@ -0,0 +1,1431 @@
+import argparse
+import datetime
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from launcher import configure_loggers
+from utils import human_timestamp, get_full_path, print_and_log, is_file7
+from utils import checksums_filetype, get_file_hash, read_checksums, session_filetypes
+from utils import output_root, get_archives_dir, strip_compression_suffix
+from utils import get_load_level
+from zips_deleter import execute_deletion, verify_checksums_in_zpaq
+from catalog import set_archive, get_modality
+
+""" Archives the logs of the previous sessions. Launched by launcher.py in the background, after the loggers.
+
+The launcher runs it at the idle CPU and I/O priority (nice, ionice -c 3), so the loggers are not slowed down.
+
+It never touches the files the loggers are still writing:
+- only the files with a timestamp (in the name) older than --cutoff are archived.
+  The launcher sets the cutoff right before launching the loggers, so the new logs are always newer
+- the files that are currently open by any process are skipped too (e.g. a logger from a previous launch)
+
+Archivation is done in 2 stages: zip and zpaq, see the docstring of launcher.py for details.
+After the archivation, zips_deleter.py deletes the zips that have valid zpaq copies.
+
+The archives are created by parallel jobs: a job per logger, or a job per logger per day if the logs span several days.
+The number of parallel jobs depends on the available cores and memory, and each zpaq gets its share of the cores.
+For each job, the throughput is logged.
+
+The archivation fits into a time budget (archival_budget_sec): the zpaq methods are planned using the sizes of the files
+and the CPU cost of the previous archivations (see plan_zpaq_methods). Each job records its predicted and actual cost,
+so the plans improve over time.
+
+Optionally, the logs can be appended to long-lived monthly journals instead, see use_journals7.
+
+The archives each file is stored in are recorded in the capture catalog, see catalog.py.
+
+The progress of each job is saved file by file into a ledger. If the archivation is interrupted, the next run
+continues the unfinished jobs with the same archives, instead of starting from scratch.
+
+The compression settings depend on the logger (e.g. the jpegs are only stored in the zip), see configure_loggers().
+To choose them, run this script with --measure: it compares the ratio and the CPU cost of the settings on your logs,
+without archiving anything.
+
+"""
+
+# get the location of this very file
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+lock_filename = "archiver.lock"
+
+# to not exceed the max length of a command line, the files are given to zpaq in batches of this size:
+zpaq_batch_size = 500
+
+# zpaq -m5 needs about this much memory per thread. Used to not run out of memory with many parallel jobs
+zpaq_mem_per_thread_mb = 1000
+
+# the files are grouped into separate archives by this many first digits of their timestamps. 8 means "by day"
+manifest_window_len = 8
+
+# with the hour shards (see output_root in utils.py), an hour dir is archived this long after the hour has ended.
+# A file is written for a while after its dir was chosen (e.g. 18 s for keyboard, 3 min for headphone)
+shard_grace_sec = 600
+
+# while governor.py reports this load level or higher, the next job waits (but no longer than max_load_pause_sec).
+# The archiver already runs at the idle priority, but zpaq still takes the memory bandwidth and the caches
+pause_at_load_level = 2
+max_load_pause_sec = 3600
+load_pause_check_sec = 30
+
+# the measurement mode (--measure) tries these, and appends the results to this file:
+measured_zip_levels = (0, 1, 6, 9)
+measured_zpaq_methods = (1, 2, 3, 4, 5)
+measurements_filename = "compression_measurements.jsonl"
+
+# if the archivation is planned to take longer than this, lower zpaq methods are used. None to not limit it
+archival_budget_sec = 3 * 3600
+# "wall" for the wall-clock time, "cpu" for the total CPU time:
+archival_budget_kind = "wall"
+
+# the actual cost of each archiving job is appended to this file, to plan the next archivations:
+history_filename = "archival_history.jsonl"
+# how many latest records per logger and method to use for the estimates:
+history_window = 20
+
+# if True, each session is appended to a long-lived journal per logger per month (e.g. brainMicOtputJournal202105.zpaq)
+# instead of a new archive per launch. zpaq deduplicates the identical content across all the sessions in the journal.
+# The added files are verified in the journal, and deleted. The zip is created only if the verification fails
+use_journals7 = False
+
+# a bigger journal is not appended anymore. A new part is started (e.g. brainMicOtputJournal202105p2.zpaq):
+journal_max_mb = 20000
+
+# the state of each archiving job and each of its files. If the archivation is interrupted (e.g. by a reboot),
+# the next run resumes the unfinished jobs from this file. See JobLedger
+ledger_filename = "archival_ledger.json"
+
+# the estimates used if there are no records yet: {method: (CPU seconds per MB, output MB per input MB)}
+default_zpaq_estimates = {
+    1: (0.01, 1.0),
+    2: (0.03, 0.95),
+    3: (0.1, 0.85),
+    4: (0.35, 0.8),
+    5: (1.0, 0.75),
+}
+
+
+def get_name_timestamp(filename):
+    """Returns the timestamp the filename starts with (e.g. "2021050211244412345" for "2021050211244412345mic.wav").
+
+    Returns an empty string if the filename doesn't start with a timestamp (e.g. "dummy.wav").
+    For a path in an hour shard (e.g. "mic/2021/05/02/11/2021050211244412345mic.wav"), the filename is used.
+    """
+    res = ""
+    for char in os.path.basename(filename):
+        if char.isdigit():
+            res += char
+        else:
+            break
+    return res
+
+
+def older_than_cutoff7(filename, cutoff):
+    """Returns True if the file was created before the cutoff, judging by the timestamp in its name.
+
+    The files without a timestamp (e.g. dummy.wav) are considered old.
+    """
+    file_ts = get_name_timestamp(filename)
+    if len(file_ts) < 14:
+        return True
+    comparable_len = min(len(file_ts), len(cutoff))
+    return file_ts[:comparable_len] < cutoff[:comparable_len]
+
+
+def get_open_files(working_dir):
+    """Returns the set of the files in the dir that are currently open by any process. Linux only.
+
+    The files in the subdirs (e.g. the hour shards) are returned as the paths relative to the dir.
+
+    The processes of other users are not visible, which is ok, as the loggers run under the same user.
+    """
+    res = set()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        fd_dir = os.path.join("/proc", pid, "fd")
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:  # the process has ended, or it's not ours
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if target.startswith(working_dir + os.sep):
+                res.add(os.path.relpath(target, working_dir))
+    return res
+
+
+def build_manifest(
+    working_dir,
+    loggers,
+    cutoff,
+    open_files,
+    window_len=manifest_window_len,
+    skipped=frozenset(),
+):
+    """Finds the files to archive in a single pass over the dir, and groups them by logger and by day.
+
+    Only the top-level files are considered. It means, the virtual environment, the old archives in subdirs etc
+    are never touched. The files are matched by the exact extension (e.g. "jpeg"), not by a pattern.
+
+    Args:
+        working_dir: str: the dir with the logs
+        loggers: list of Logger objects: see configure_loggers() in launcher.py
+        cutoff: str: only the files with the name timestamp older than this are added
+        open_files: set of str: these filenames are skipped, see get_open_files()
+        window_len: int: optional: see group_by_window()
+        skipped: set of str: optional: these filenames are skipped silently (e.g. they are in the unfinished jobs)
+    Returns:
+        manifest: dict: the key is the archive prefix, the value is the output of group_by_window()
+    """
+    loggers_by_filetype = {lgr.output_filetype: lgr for lgr in loggers}
+    found = {lgr.archive_prefix: [] for lgr in loggers}
+
+    with os.scandir(working_dir) as dir_entries:
+        for dir_entry in dir_entries:
+            # e.g. "mousetxt" for a compressed log "20210502112444123.mousetxt.gz"
+            filetype = strip_compression_suffix(dir_entry.name).rpartition(".")[2]
+            if filetype in session_filetypes:
+                # the session files of a logger are archived with its logs, e.g. 20210502112444123.keystxt.checksums
+                filetype = dir_entry.name.rpartition(".")[0].rpartition(".")[2]
+            if filetype not in loggers_by_filetype:
+                continue
+            if not dir_entry.is_file(follow_symlinks=False):
+                continue
+            if dir_entry.name in skipped:
+                continue
+            if dir_entry.name in open_files:
+                print_and_log("skipping the file as it's still open:", dir_entry.name)
+                continue
+            if not older_than_cutoff7(dir_entry.name, cutoff):
+                continue
+            stat_info = dir_entry.stat(follow_symlinks=False)
+            found[loggers_by_filetype[filetype].archive_prefix].append(
+                {
+                    "name": dir_entry.name,
+                    "size": stat_info.st_size,
+                    "mtime": stat_info.st_mtime,
+                }
+            )
+
+    return {
+        prefix: group_by_window(entries, window_len)
+        for prefix, entries in found.items()
+    }
+
+
+def iterate_hour_dirs(root, modality):
+    """Yields (the hour dir relative to the root, the start of the hour) for the hour shards of the modality
+
+    >>> import tempfile
+    >>> root0 = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(root0, "mic/2021/05/02/11"))
+    >>> os.makedirs(os.path.join(root0, "mic/2021/05/not_a_day"))
+    >>> list(iterate_hour_dirs(root0, "mic"))
+    [('mic/2021/05/02/11', datetime.datetime(2021, 5, 2, 11, 0))]
+    """
+
+    def sorted_digit_dirs(path):
+        try:
+            return sorted(name for name in os.listdir(path) if name.isdigit())
+        except OSError:
+            return []
+
+    modality_dir = os.path.join(root, modality)
+    for year in sorted_digit_dirs(modality_dir):
+        for month in sorted_digit_dirs(os.path.join(modality_dir, year)):
+            for day in sorted_digit_dirs(os.path.join(modality_dir, year, month)):
+                day_dir = os.path.join(modality_dir, year, month, day)
+                for hour in sorted_digit_dirs(day_dir):
+                    try:
+                        start = datetime.datetime(
+                            int(year), int(month), int(day), int(hour)
+                        )
+                    except ValueError:
+                        continue
+                    yield os.path.join(modality, year, month, day, hour), start
+
+
+def build_sharded_manifest(
+    root,
+    loggers,
+    cutoff,
+    open_files,
+    window_len=manifest_window_len,
+    skipped=frozenset(),
+):
+    """Same as build_manifest(), but for the hour shards (see output_root in utils.py).
+
+    Only the hour dirs that have ended shard_grace_sec before the cutoff are taken, as a whole.
+    The entry names are relative to the root, e.g. "screen/2021/05/02/11/20210502112444123screen.jpeg"
+    """
+    cutoff_time = datetime.datetime.strptime(cutoff[:14], "%Y%m%d%H%M%S")
+    closed_before = cutoff_time - datetime.timedelta(hours=1, seconds=shard_grace_sec)
+    found = {lgr.archive_prefix: [] for lgr in loggers}
+    for lgr in loggers:
+        modality = get_modality("." + lgr.output_filetype)
+        for hour_dir, start in iterate_hour_dirs(root, modality):
+            if start > closed_before:
+                break  # the hours are sorted
+            with os.scandir(os.path.join(root, hour_dir)) as dir_entries:
+                for dir_entry in dir_entries:
+                    name = os.path.join(hour_dir, dir_entry.name)
+                    if name in skipped or not dir_entry.is_file(follow_symlinks=False):
+                        continue
+                    if name in open_files:
+                        print_and_log("skipping the file as it's still open:", name)
+                        continue
+                    stat_info = dir_entry.stat(follow_symlinks=False)
+                    found[lgr.archive_prefix].append(
+                        {
+                            "name": name,
+                            "size": stat_info.st_size,
+                            "mtime": stat_info.st_mtime,
+                        }
+                    )
+
+    return {
+        prefix: group_by_window(entries, window_len)
+        for prefix, entries in found.items()
+    }
+
+
+def find_files_to_archive(
+    working_dir, loggers, cutoff, window_len=manifest_window_len, skipped=frozenset()
+):
+    """Calls build_sharded_manifest() if the hour shards are enabled, build_manifest() otherwise"""
+    if output_root is not None:
+        build_func = build_sharded_manifest
+    else:
+        build_func = build_manifest
+    return build_func(
+        working_dir,
+        loggers,
+        cutoff,
+        get_open_files(working_dir),
+        window_len,
+        skipped=skipped,
+    )
+
+
+def remove_empty_shard_dirs(working_dir, filenames):
+    """Removes the hour dirs emptied by the archivation, and their parent dirs up to the modality dir, if empty"""
+    for hour_dir in sorted({os.path.dirname(name) for name in filenames}, reverse=True):
+        # e.g. screen/2021/05/02/11 -> 4 levels below the modality dir
+        for _ in range(4):
+            if hour_dir.count(os.sep) < 1:
+                break
+            try:
+                os.rmdir(os.path.join(working_dir, hour_dir))
+            except OSError:  # not empty
+                break
+            hour_dir = os.path.dirname(hour_dir)
+
+
+def get_available_cores():
+    try:
+        res = len(os.sched_getaffinity(0))
+    except AttributeError:  # not Linux
+        res = os.cpu_count() or 1
+    return res
+
+
+def get_available_memory_mb():
+    """Returns MemAvailable from /proc/meminfo, in MB. Returns None if it's unknown (e.g. not Linux)"""
+    res = None
+    try:
+        with open("/proc/meminfo") as meminfo_f:
+            for line in meminfo_f:
+                if line.startswith("MemAvailable:"):
+                    res = int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return res
+
+
+def get_pool_size(jobs_num, cores, memory_mb):
+    """Returns how many jobs to run in parallel, and how many threads each zpaq should use.
+
+    >>> get_pool_size(jobs_num=5, cores=16, memory_mb=64000)
+    (5, 3)
+    >>> get_pool_size(jobs_num=5, cores=16, memory_mb=4500)
+    (4, 1)
+    >>> get_pool_size(jobs_num=2, cores=1, memory_mb=None)
+    (1, 1)
+    """
+    threads_total = cores
+    if memory_mb is not None:
+        threads_total = min(threads_total, memory_mb // zpaq_mem_per_thread_mb)
+    threads_total = max(1, threads_total)
+    workers = max(1, min(jobs_num, threads_total))
+    return workers, max(1, threads_total // workers)
+
+
+def group_by_window(entries, window_len=manifest_window_len):
+    """Groups the manifest entries by the day in their name timestamps. Returns a dict: the key is the day.
+
+    The window can be changed by window_len: the number of the first digits of the timestamp. E.g. 6 means by month.
+    If all the files are from the same window, there is only one group with the key "".
+    The files without a timestamp are added to the first group. The entries are sorted by name in each group.
+
+    >>> entry = lambda name: {"name": name, "size": 1, "mtime": 0.0}
+    >>> group_by_window([entry("20210502112444mic.wav"), entry("dummy.wav")]).keys()
+    dict_keys([''])
+    >>> res0 = group_by_window([entry("20210503000000mic.wav"), entry("dummy.wav"), entry("20210502112444mic.wav")])
+    >>> {key: [e["name"] for e in group] for key, group in res0.items()}
+    {'20210502': ['20210502112444mic.wav', 'dummy.wav'], '20210503': ['20210503000000mic.wav']}
+    >>> group_by_window([])
+    {}
+    """
+    res = dict()
+    undated = []
+    for entry in entries:
+        file_ts = get_name_timestamp(entry["name"])
+        if len(file_ts) < 14:
+            undated.append(entry)
+        else:
+            res.setdefault(file_ts[:window_len], []).append(entry)
+
+    if len(res) <= 1:
+        res = {"": entries} if len(entries) > 0 else dict()
+    else:
+        res[min(res.keys())] += undated
+
+    return {
+        key: sorted(group, key=lambda e: e["name"])
+        for key, group in sorted(res.items())
+    }
+
+
+def call_with_cpu(command, working_dir, input_text=None):
+    """Runs the command, and returns its exit code and the CPU seconds it consumed (user + system, all threads)"""
+    process = subprocess.Popen(
+        command,
+        cwd=working_dir,
+        stdin=subprocess.PIPE if input_text is not None else None,
+        text=True,
+    )
+    if input_text is not None:
+        process.stdin.write(input_text)
+        process.stdin.close()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+
+def run_zpaq(archive_path, filenames, working_dir, method, threads, on_batch=None):
+    """Adds the given files to the zpaq archive.
+
+    If on_batch is a callable, on_batch(batch) is called after each batch of files is added without errors.
+
+    Returns:
+        res: int: the zpaq exit code (0 if ok, 1 if warnings, 2 if errors)
+        cpu_sec: float: the CPU seconds zpaq consumed
+    """
+    path2zpaq = get_full_path("zpaq715")
+    options = ["-m" + str(method), "-threads", str(threads)]
+
+    res = 0
+    cpu_sec = 0.0
+    for i in range(0, len(filenames), zpaq_batch_size):
+        batch = filenames[i : i + zpaq_batch_size]
+        command = [path2zpaq, "add", archive_path] + batch + options
+
+        print_and_log(
+            "### ZPAQ command used: ",
+            subprocess.list2cmdline([path2zpaq, "add", archive_path] + options)
+            + " , files: "
+            + str(len(batch)),
+        )
+        try:
+            code, batch_cpu_sec = call_with_cpu(command, working_dir)
+            res = max(res, code)
+            cpu_sec += batch_cpu_sec
+            if code == 0 and callable(on_batch):
+                on_batch(batch)
+        except Exception as e:
+            print_and_log("Failed to launch zpaq: ", str(e))
+            res = 2
+    return res, cpu_sec
+
+
+def run_zip(archive_path, filenames, working_dir, level, move7):
+    """Adds the given files to the zip archive. Returns the zip exit code (0 if ok), and the CPU seconds zip consumed
+
+    Explanation of the zip command arguments:
+    -@ file lists.   If  a file list is specified as -@ , zip
+       takes the list of input files from standard input instead of  from  the
+       command line.
+    -m deletes the target directories/files after making the  specified zip  archive
+    -0 only stores the files, -1 .. -9 deflate them (faster .. better)
+    """
+    command = ["zip", "-q", "-" + str(level), "-@"]
+    if move7:
+        command += ["-m"]
+    command += [archive_path]
+    try:
+        res, cpu_sec = call_with_cpu(
+            command, working_dir, input_text="\n".join(filenames) + "\n"
+        )
+    except Exception as e:
+        print_and_log("failed to launch zipping:", str(e))
+        res, cpu_sec = None, 0.0
+    return res, cpu_sec
+
+
+def get_archive_name(lgr, shard_key, extension):
+    """E.g. brainMicOtput20210502112444.zip, or brainMicOtput20210502112444s20210428.zip for a shard"""
+    res = lgr.archive_prefix + human_timestamp()[:-4]
+    if shard_key != "":
+        res += "s" + shard_key
+    return res + extension
+
+
+def get_job_size_mb(job):
+    return sum(entry["size"] for entry in job["entries"]) / 2**20
+
+
+def load_history():
+    """Reads the actual archiving jobs and the measurements (see --measure) recorded so far.
+
+    Returns:
+        res: list of dicts: the zpaq runs, each with archive_prefix, method, input_mb, output_mb, cpu_sec
+    """
+    res = []
+    for filename in (history_filename, measurements_filename):
+        if not is_file7(filename):
+            continue
+        with open(get_full_path(filename)) as history_f:
+            for line in history_f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("tool") == "zpaq":  # a measurement
+                    record["method"] = record["level"]
+                    record["output_mb"] = record["input_mb"] / record["ratio"]
+                    record["cpu_sec"] = (
+                        record["cpu_sec_per_gb"] * record["input_mb"] / 2**10
+                    )
+                if "method" in record and record.get("input_mb", 0) > 0:
+                    res.append(record)
+    return res
+
+
+def get_estimates(history, archive_prefix, max_method):
+    """Estimates the cost and the result of each zpaq method for the logger, from the latest records in history.
+
+    Returns:
+        res: dict: the key is the method, the value is (CPU seconds per MB, output MB per input MB)
+
+    >>> history0 = [{"archive_prefix": "brainKeysOutput", "method": 5, "input_mb": 10.0, "output_mb": 1.0, "cpu_sec": 20.0}]
+    >>> get_estimates(history0, "brainKeysOutput", max_method=5)[5]
+    (2.0, 0.1)
+    >>> get_estimates(history0, "brainKeysOutput", max_method=5)[1] == default_zpaq_estimates[1]
+    True
+    """
+    res = dict()
+    for method in range(1, max_method + 1):
+        records = [
+            r
+            for r in history
+            if r["archive_prefix"] == archive_prefix and r["method"] == method
+        ][-history_window:]
+        input_mb = sum(r["input_mb"] for r in records)
+        if input_mb > 0:
+            res[method] = (
+                sum(r["cpu_sec"] for r in records) / input_mb,
+                sum(r["output_mb"] for r in records) / input_mb,
+            )
+        else:
+            res[method] = default_zpaq_estimates[method]
+    return res
+
+
+def plan_zpaq_methods(jobs, history, cpu_budget_sec):
+    """Picks the zpaq method for each job, to get the smallest archives within the CPU budget.
+
+    Starts with the fastest method for all the jobs. Then, greedily, upgrades the job that saves the most MB
+    per extra CPU second, while the budget allows. The logger's zpaq_method is the max method for its jobs.
+    If cpu_budget_sec is None, all the jobs get the logger's method.
+    Sets job["zpaq_method"] and job["predicted_cpu_sec"].
+
+    >>> class Lgr:
+    ...     archive_prefix, zpaq_method = "brainKeysOutput", 5
+    >>> jobs0 = [{"logger": Lgr(), "entries": [{"size": 100 * 2**20}]}]
+    >>> plan_zpaq_methods(jobs0, [], cpu_budget_sec=None)[0]["zpaq_method"]
+    5
+    >>> plan_zpaq_methods(jobs0, [], cpu_budget_sec=15)[0]["zpaq_method"]
+    3
+    >>> plan_zpaq_methods(jobs0, [], cpu_budget_sec=0)[0]["zpaq_method"]
+    1
+    """
+    # for each job: the list of (method, predicted CPU sec, predicted output MB)
+    options = []
+    for job in jobs:
+        lgr = job["logger"]
+        size_mb = get_job_size_mb(job)
+        estimates = get_estimates(history, lgr.archive_prefix, lgr.zpaq_method)
+        options.append(
+            [
+                (method, cpu_per_mb * size_mb, out_per_mb * size_mb)
+                for method, (cpu_per_mb, out_per_mb) in sorted(estimates.items())
+            ]
+        )
+
+    if cpu_budget_sec is None:
+        chosen = [len(job_options) - 1 for job_options in options]
+    else:
+        chosen = [0] * len(jobs)
+        spent = sum(job_options[0][1] for job_options in options)
+        while True:
+            best = None  # (MB saved per CPU sec, job index, option index)
+            for i, job_options in enumerate(options):
+                _, cur_cpu, cur_out = job_options[chosen[i]]
+                for j in range(chosen[i] + 1, len(job_options)):
+                    _, cpu, out = job_options[j]
+                    extra_cpu = cpu - cur_cpu
+                    if spent + extra_cpu > cpu_budget_sec:
+                        continue
+                    if extra_cpu <= 0 and out <= cur_out:
+                        gain = float("inf")  # a free upgrade, e.g. for an empty file
+                    elif out >= cur_out:
+                        continue
+                    else:
+                        gain = (cur_out - out) / extra_cpu
+                    if best is None or gain > best[0]:
+                        best = (gain, i, j)
+            if best is None:
+                break
+            _, i, j = best
+            spent += options[i][j][1] - options[i][chosen[i]][1]
+            chosen[i] = j
+
+    for job, job_options, choice in zip(jobs, options, chosen):
+        job["zpaq_method"] = job_options[choice][0]
+        job["predicted_cpu_sec"] = job_options[choice][1]
+    return jobs
+
+
+def record_job(job_report):
+    """Appends the actual cost of the job to the history, to improve the future plans. See plan_zpaq_methods()"""
+    record = {
+        "timestamp": human_timestamp(),
+        "archive_prefix": job_report["archive_prefix"],
+        "method": job_report["zpaq_method"],
+        "input_mb": job_report["input_mb"],
+        "output_mb": job_report["zpaq_output_mb"],
+        "cpu_sec": job_report["zpaq_cpu_sec"],
+        "wall_sec": job_report["zpaq_sec"],
+        "predicted_cpu_sec": job_report["predicted_cpu_sec"],
+    }
+    with open(get_full_path(history_filename), "a") as history_f:
+        history_f.write(json.dumps(record) + "\n")
+
+
+def get_journal_name(lgr, month, working_dir):
+    """Returns the name of the journal to append to, e.g. brainMicOtputJournal202105.zpaq
+
+    If the journal has reached journal_max_mb, the next part is used (e.g. brainMicOtputJournal202105p2.zpaq).
+    """
+    part = 1
+    while True:
+        res = lgr.archive_prefix + "Journal" + month
+        res += ("p" + str(part) if part > 1 else "") + ".zpaq"
+        path = os.path.join(working_dir, res)
+        if not os.path.isfile(path) or os.path.getsize(path) < journal_max_mb * 2**20:
+            return res
+        part += 1
+
+
+def get_job_month(job):
+    """Returns the month (e.g. "202105") of the job's files. The job's files are from the same month in the journal mode"""
+    if job["shard_key"] != "":
+        return job["shard_key"][:6]
+    for entry in job["entries"]:
+        file_ts = get_name_timestamp(entry["name"])
+        if len(file_ts) >= 14:
+            return file_ts[:6]
+    return human_timestamp()[:6]  # only undated files, e.g. dummy.wav
+
+
+def list_zpaq_files(archive_path, working_dir):
+    """Returns the set of the filenames stored in the latest version of the zpaq archive"""
+    path2zpaq = get_full_path("zpaq715")
+    try:
+        output = subprocess.run(
+            [path2zpaq, "list", archive_path],
+            cwd=working_dir,
+            capture_output=True,
+            text=True,
+        ).stdout
+    except Exception as e:
+        print_and_log("Failed to launch zpaq: ", str(e))
+        return set()
+
+    # the lines look like this: "- 2021-05-02 11:24:44   3000 0644 2021050211244412345mic.wav"
+    res = set()
+    for line in output.splitlines():
+        parts = line.split(None, 5)
+        if len(parts) == 6 and parts[0] == "-":
+            res.add(parts[5])
+    return res
+
+
+def collect_checksums(jobs, working_dir):
+    """Reads the session manifests found among the files of the jobs. Returns a dict, see read_checksums()
+
+    The key is the path relative to the working dir, as in the job entries (e.g. for the files in the hour shards).
+    """
+    res = dict()
+    for job in jobs:
+        for entry in job["entries"]:
+            if entry["name"].endswith("." + checksums_filetype):
+                manifest_dir = os.path.dirname(entry["name"])
+                try:
+                    records = read_checksums(os.path.join(working_dir, entry["name"]))
+                    for name, record in records.items():
+                        res[os.path.join(manifest_dir, name)] = record
+                except OSError as e:
+                    print_and_log(
+                        "failed to read the checksums " + entry["name"], str(e)
+                    )
+    return res
+
+
+def write_job_checksums(job, working_dir, checksums):
+    """Appends the checksums of all the files of the job to the manifest next to its zpaq.
+
+    E.g. brainKeysOutput20210502112444.zpaq.checksums. zips_deleter.py verifies the zpaq against it.
+    The checksums recorded by the loggers at capture time are used. The files without them
+    (e.g. the manifests themselves, or the logs of the older versions of the loggers), or changed since then,
+    are hashed now.
+    """
+    lines = []
+    for entry in job["entries"]:
+        record = checksums.get(entry["name"])
+        if record is not None and record["size"] != entry["size"]:
+            print_and_log(
+                "the file has changed since it was written by the logger (e.g. thinned by retention.py):",
+                entry["name"],
+            )
+            record = None
+        if record is None:
+            try:
+                full_path = os.path.join(working_dir, entry["name"])
+                record = {
+                    "name": entry["name"],
+                    "size": os.path.getsize(full_path),
+                    "sha256": get_file_hash(full_path),
+                }
+            except OSError as e:
+                print_and_log("failed to hash " + entry["name"], str(e))
+                continue
+        # the name as it's stored in the archive
+        record = dict(record, name=entry["name"])
+        lines.append(json.dumps(record) + "\n")
+
+    checksums_path = os.path.join(
+        working_dir, job["zpaq_archive"] + "." + checksums_filetype
+    )
+    with open(checksums_path, "a") as checksums_f:
+        checksums_f.writelines(lines)
+
+
+def verify_in_zpaq(archive_path, filenames, working_dir, threads):
+    """Returns True if all the files are in the archive, and they pass the zpaq test (the checksums are ok)
+
+    If there are the checksums of all the files (see write_job_checksums), the files are extracted and compared with them.
+    """
+    missing = set(filenames) - list_zpaq_files(archive_path, working_dir)
+    if len(missing) > 0:
+        print_and_log(archive_path + ": files missing in the archive:", len(missing))
+        return False
+
+    checksums_path = os.path.join(working_dir, archive_path + "." + checksums_filetype)
+    checksums = read_checksums(checksums_path) if os.path.isfile(checksums_path) else {}
+    if all(filename in checksums for filename in filenames):
+        code = verify_checksums_in_zpaq(
+            os.path.join(working_dir, archive_path),
+            {filename: checksums[filename] for filename in filenames},
+            threads,
+        )
+        if code != 0:
+            print_and_log(archive_path + ": checksums verification failed:", code)
+        return code == 0
+
+    path2zpaq = get_full_path("zpaq715")
+    test_dir = os.path.join(tempfile.gettempdir(), "zpaq_test")
+    for i in range(0, len(filenames), zpaq_batch_size):
+        batch = filenames[i : i + zpaq_batch_size]
+        command = [path2zpaq, "extract", archive_path] + batch
+        command += ["-to", test_dir, "-test", "-threads", str(threads)]
+        try:
+            code = subprocess.call(command, cwd=working_dir)
+        except Exception as e:
+            print_and_log("Failed to launch zpaq: ", str(e))
+            code = 2
+        if code != 0:
+            print_and_log(archive_path + ": zpaq test failed, exit code:", code)
+            return False
+    return True
+
+
+class JobLedger:
+    """Saves the state of the archiving jobs, file by file, to resume them after an interruption.
+
+    The states of a file: "pending" -> "in_zpaq" -> "in_zip" (or "deleted" in the journal mode, after the verification).
+    "missing" if the file has disappeared before it was archived.
+    A job is removed from the ledger when all its files are archived. The ledger files are removed when it's empty.
+
+    The changes are appended to a journal next to the ledger (one line per added job or per batch of files),
+    so a batch costs a small append, not a rewrite of all the jobs. The journal is folded into the ledger
+    (see compact()) on load and when a job is finished.
+
+    >>> ledger0 = JobLedger(os.path.join(tempfile.mkdtemp(), "ledger.json"))
+    >>> job0 = {"logger": None, "shard_key": "", "zpaq_archive": "a.zpaq", "zip_archive": "a.zip", "zpaq_method": 5}
+    >>> job0["entries"] = [{"name": "1.keystxt", "size": 10}, {"name": "2.keystxt", "size": 20}]
+    >>> job0["archive_prefix"], job0["journal7"] = "brainKeysOutput", False
+    >>> ledger0.add_job(job0)
+    >>> ledger0.set_state("a.zip", ["1.keystxt"], "in_zpaq")
+    >>> JobLedger(ledger0.path).files_in_states("a.zip", ["pending"])  # as if after a reboot
+    ['2.keystxt']
+    >>> ledger0.set_state("a.zip", ["1.keystxt", "2.keystxt"], "in_zip")
+    >>> JobLedger(ledger0.path).files_in_states("a.zip", ["in_zip"])
+    ['1.keystxt', '2.keystxt']
+    >>> ledger0.finish_job_if_done("a.zip"), os.path.isfile(ledger0.path), os.path.isfile(ledger0.journal_path)
+    (True, False, False)
+    """
+
+    final_states = ("in_zip", "deleted", "missing")
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.lock = threading.Lock()
+        self.jobs = dict()
+        if os.path.isfile(path):
+            try:
+                with open(path) as ledger_f:
+                    self.jobs = json.load(ledger_f)["jobs"]
+            except (OSError, ValueError, KeyError) as e:
+                print_and_log("failed to read the archival ledger:", str(e))
+        if os.path.isfile(self.journal_path):
+            try:
+                with open(self.journal_path) as journal_f:
+                    for line in journal_f:
+                        self.apply(line)
+            except OSError as e:
+                print_and_log("failed to read the archival ledger journal:", str(e))
+            with self.lock:
+                self.compact()
+
+    def apply(self, line):
+        """Replays a journal line. A broken line (e.g. the last one, if interrupted) is skipped"""
+        try:
+            change = json.loads(line)
+            if "job" in change:
+                self.jobs[change["job"]["zip_archive"]] = change["job"]
+            else:
+                files = self.jobs[change["key"]]["files"]
+                for filename in change["files"]:
+                    files[filename]["state"] = change["state"]
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    def append(self, change):
+        with open(self.journal_path, "a") as journal_f:
+            journal_f.write(json.dumps(change) + "\n")
+            journal_f.flush()
+            os.fsync(journal_f.fileno())
+
+    def compact(self):
+        """Writes all the jobs to the ledger atomically, and starts a new journal. Call it under the lock.
+
+        A reboot in the middle leaves the previous ledger and the journal intact. If the journal survives
+        the replacement of the ledger, replaying it again is harmless: the states end up the same,
+        and a finished job reappears with all its files done, to be removed by resume_jobs().
+        """
+        if len(self.jobs) == 0:
+            for path in (self.path, self.journal_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as ledger_f:
+            json.dump({"jobs": self.jobs}, ledger_f)
+            ledger_f.flush()
+            os.fsync(ledger_f.fileno())
+        os.replace(temp_path, self.path)
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+
+    def add_job(self, job):
+        record = {
+            "archive_prefix": job["archive_prefix"],
+            "shard_key": job["shard_key"],
+            "zpaq_archive": job["zpaq_archive"],
+            "zip_archive": job["zip_archive"],
+            "zpaq_method": job["zpaq_method"],
+            "journal7": job["journal7"],
+            "files": {
+                e["name"]: {"size": e["size"], "state": "pending"}
+                for e in job["entries"]
+            },
+        }
+        with self.lock:
+            self.jobs[job["zip_archive"]] = record
+            self.append({"job": record})
+
+    def set_state(self, job_key, filenames, state):
+        with self.lock:
+            files = self.jobs[job_key]["files"]
+            for filename in filenames:
+                files[filename]["state"] = state
+            self.append({"key": job_key, "files": list(filenames), "state": state})
+
+    def files_in_states(self, job_key, states):
+        with self.lock:
+            files = self.jobs[job_key]["files"]
+            return sorted(name for name in files if files[name]["state"] in states)
+
+    def all_filenames(self):
+        with self.lock:
+            return {name for job in self.jobs.values() for name in job["files"]}
+
+    def archive_pairs(self):
+        """Returns the list of (zip, zpaq) of the jobs, e.g. to delete the zips of the resumed jobs"""
+        with self.lock:
+            return [
+                (job["zip_archive"], job["zpaq_archive"]) for job in self.jobs.values()
+            ]
+
+    def finish_job_if_done(self, job_key):
+        """Removes the job from the ledger if all its files are archived. Returns True if removed"""
+        with self.lock:
+            files = self.jobs[job_key]["files"]
+            done7 = all(f["state"] in self.final_states for f in files.values())
+            if done7:
+                del self.jobs[job_key]
+                self.compact()
+            return done7
+
+
+def get_zip_contents(archive_path):
+    try:
+        with zipfile.ZipFile(archive_path) as zip_f:
+            return set(zip_f.namelist())
+    except (OSError, zipfile.BadZipFile):
+        return set()
+
+
+def resume_jobs(ledger, loggers, working_dir):
+    """Returns the unfinished jobs from the ledger, ready to be run again.
+
+    The files that have disappeared since the interruption are checked: if they are in the zip, they were moved there.
+    In the journal mode, they were deleted after the verification.
+    """
+    loggers_by_prefix = {lgr.archive_prefix: lgr for lgr in loggers}
+    res = []
+    for job_key in list(ledger.jobs.keys()):
+        record = ledger.jobs[job_key]
+        zip_contents = None
+        # the ledger is saved once per state, not once per file
+        filenames_by_state = dict()
+        for filename in ledger.files_in_states(job_key, ["pending", "in_zpaq"]):
+            if os.path.isfile(os.path.join(working_dir, filename)):
+                continue
+            if zip_contents is None:
+                zip_contents = get_zip_contents(
+                    os.path.join(working_dir, record["zip_archive"])
+                )
+            if filename in zip_contents:
+                state = "in_zip"
+            elif record["journal7"] and record["files"][filename]["state"] == "in_zpaq":
+                state = "deleted"
+            else:
+                state = "missing"
+                print_and_log("the file has disappeared before archiving:", filename)
+            filenames_by_state.setdefault(state, []).append(filename)
+        for state, filenames in filenames_by_state.items():
+            ledger.set_state(job_key, filenames, state)
+
+        if ledger.finish_job_if_done(job_key):
+            continue
+        if record["archive_prefix"] not in loggers_by_prefix:
+            print_and_log("can't resume a job of an unknown logger:", job_key)
+            continue
+
+        unfinished = ledger.files_in_states(job_key, ["pending", "in_zpaq"])
+        print_and_log(
+            "resuming the archiving job " + job_key + ", files:", len(unfinished)
+        )
+        res.append(
+            {
+                "logger": loggers_by_prefix[record["archive_prefix"]],
+                "archive_prefix": record["archive_prefix"],
+                "shard_key": record["shard_key"],
+                "entries": [
+                    {"name": name, "size": record["files"][name]["size"]}
+                    for name in unfinished
+                ],
+                "zpaq_archive": record["zpaq_archive"],
+                "zip_archive": record["zip_archive"],
+                "zpaq_method": record["zpaq_method"],
+                "predicted_cpu_sec": 0.0,
+                "journal7": record["journal7"],
+                "resumed7": True,
+            }
+        )
+    return res
+
+
+def wait_while_overloaded():
+    """Postpones the next job while the machine is busy, see governor.py"""
+    waited_sec = 0
+    while get_load_level() >= pause_at_load_level and waited_sec < max_load_pause_sec:
+        if waited_sec == 0:
+            print_and_log("the machine is busy. Postponing the next archiving job")
+        time.sleep(load_pause_check_sec)
+        waited_sec += load_pause_check_sec
+
+
+def run_archiving_job(job, working_dir, zpaq_found7, zpaq_threads, ledger):
+    """Archives the files of a logger (or of a shard of a logger) with zpaq, and then with zip.
+
+    In the journal mode, the files are appended to the journal instead, and deleted after the verification.
+    If something went wrong with the journal, the files are moved into a zip, as in the usual mode.
+    The progress is saved in the ledger, so the job can be resumed if interrupted.
+
+    Args:
+        job: dict: the logger, the manifest entries, the archive names and the planned zpaq method
+        ledger: JobLedger: where the job was added
+    Returns:
+        res: dict: the sizes and the timings of the job
+    """
+    lgr = job["logger"]
+    job_key = job["zip_archive"]
+    shard_key = job["shard_key"]
+    res = {
+        "name": lgr.archive_prefix + ("" if shard_key == "" else " " + shard_key),
+        "archive_prefix": lgr.archive_prefix,
+        "files": len(job["entries"]),
+        "input_mb": get_job_size_mb(job),
+        "zpaq_method": job["zpaq_method"],
+        "predicted_cpu_sec": job["predicted_cpu_sec"],
+        "zpaq_sec": 0.0,
+        "zpaq_code": None,
+    }
+
+    wait_while_overloaded()
+
+    # zpaq first, as zip -m deletes the files
+    pending = ledger.files_in_states(job_key, ["pending"])
+    if zpaq_found7 and len(pending) > 0:
+        zpaq_path = os.path.join(working_dir, job["zpaq_archive"])
+        size_before = os.path.getsize(zpaq_path) if os.path.isfile(zpaq_path) else 0
+        start = time.time()
+        res["zpaq_code"], res["zpaq_cpu_sec"] = run_zpaq(
+            job["zpaq_archive"],
+            pending,
+            working_dir,
+            job["zpaq_method"],
+            zpaq_threads,
+            on_batch=lambda batch: ledger.set_state(job_key, batch, "in_zpaq"),
+        )
+        res["zpaq_sec"] = time.time() - start
+        if os.path.isfile(zpaq_path) and not job.get("resumed7", False):
+            res["zpaq_output_mb"] = (os.path.getsize(zpaq_path) - size_before) / 2**20
+            record_job(res)
+
+    if zpaq_found7 and job["journal7"]:
+        start = time.time()
+        added = ledger.files_in_states(job_key, ["in_zpaq"])
+        if len(added) > 0 and verify_in_zpaq(
+            job["zpaq_archive"], added, working_dir, zpaq_threads
+        ):
+            for filename in added:
+                os.remove(os.path.join(working_dir, filename))
+            ledger.set_state(job_key, added, "deleted")
+            set_archive(added, job["zpaq_archive"], None)
+            print_and_log(
+                job["zpaq_archive"] + ": verified and deleted the added files:",
+                len(added),
+            )
+        res["verify_sec"] = time.time() - start
+
+    # in the journal mode, only the files that were not verified in the journal get here
+    unzipped = ledger.files_in_states(job_key, ["pending", "in_zpaq"])
+    if len(unzipped) > 0:
+        if job["journal7"]:
+            print_and_log(
+                job["zpaq_archive"] + ": not verified. Zipping the files instead"
+            )
+        start = time.time()
+        code, _ = run_zip(
+            job["zip_archive"], unzipped, working_dir, lgr.zip_level, move7=True
+        )
+        if code == 0:
+            in_zpaq = set(ledger.files_in_states(job_key, ["in_zpaq"]))
+            ledger.set_state(job_key, unzipped, "in_zip")
+            zpaq_archive = None if job["journal7"] else job["zpaq_archive"]
+            set_archive(
+                [name for name in unzipped if name in in_zpaq],
+                zpaq_archive,
+                job["zip_archive"],
+            )
+            set_archive(
+                [name for name in unzipped if name not in in_zpaq],
+                None,
+                job["zip_archive"],
+            )
+        res["zip_sec"] = time.time() - start
+
+    remove_empty_shard_dirs(working_dir, [e["name"] for e in job["entries"]])
+    if not ledger.finish_job_if_done(job_key):
+        print_and_log(
+            "the archiving job is not finished. Will retry it on the next run:", job_key
+        )
+    return res
+
+
+def format_job_report(job_report):
+    res = job_report["name"] + ": %d files, %.1f MB" % (
+        job_report["files"],
+        job_report["input_mb"],
+    )
+    for stage in ("zpaq", "verify", "zip"):
+        sec = job_report.get(stage + "_sec", 0.0)
+        if sec > 0:
+            res += ", %s %.1f s (%.2f MB/s)" % (
+                stage,
+                sec,
+                job_report["input_mb"] / sec,
+            )
+    if "zpaq_cpu_sec" in job_report:
+        res += ", zpaq -m%d CPU: predicted %.1f s, actual %.1f s" % (
+            job_report["zpaq_method"],
+            job_report["predicted_cpu_sec"],
+            job_report["zpaq_cpu_sec"],
+        )
+    if job_report["zpaq_code"] not in (None, 0):
+        res += ", zpaq exit code " + str(job_report["zpaq_code"])
+    return res
+
+
+def archive_everything(
+    loggers, working_dir, cutoff, budget_sec=None, budget_kind="wall", journals7=False
+):
+    """Archives the old logs of all the loggers, see the docstring of this script.
+
+    If journals7 is True, the logs are appended to the monthly journals, see use_journals7.
+
+    If budget_sec is given, the zpaq methods are lowered as needed to fit the budget, see plan_zpaq_methods().
+    budget_kind is "wall" for the wall-clock time of the whole archivation, or "cpu" for the total CPU time.
+    """
+    print_and_log("---------------launching archivation---------------")
+    print_and_log("archiving the files older than", cutoff)
+
+    zpaq_found7 = is_file7("zpaq715")
+    if not zpaq_found7:
+        print_and_log(
+            "zpaq715 not found. Check if you have it in the same dir as this srcipt"
+        )
+
+    # in the journal mode, a job per journal, to never append to the same journal in parallel
+    window_len = 6 if journals7 else manifest_window_len
+    ledger = JobLedger(get_full_path(ledger_filename))
+    resumed_jobs = resume_jobs(ledger, loggers, working_dir)
+    manifest = find_files_to_archive(
+        working_dir, loggers, cutoff, window_len, skipped=ledger.all_filenames()
+    )
+    jobs = []
+    for lgr in loggers:
+        groups = manifest[lgr.archive_prefix]
+        print_and_log(
+            lgr.archive_prefix + ": files to archive:",
+            sum(len(group) for group in groups.values()),
+        )
+        for shard_key, entries in groups.items():
+            jobs.append(
+                {
+                    "logger": lgr,
+                    "archive_prefix": lgr.archive_prefix,
+                    "shard_key": shard_key,
+                    "entries": entries,
+                    "journal7": journals7,
+                }
+            )
+
+    # the biggest jobs first, to not end up waiting for a big job started last
+    jobs.sort(key=get_job_size_mb, reverse=True)
+
+    workers, zpaq_threads = get_pool_size(
+        max(len(jobs), len(resumed_jobs)),
+        get_available_cores(),
+        get_available_memory_mb(),
+    )
+    print_and_log(
+        "archiving jobs: %d (resumed: %d), in parallel: %d, zpaq threads per job: %d"
+        % (len(jobs) + len(resumed_jobs), len(resumed_jobs), workers, zpaq_threads)
+    )
+
+    cpu_budget_sec = budget_sec
+    if budget_sec is not None and budget_kind == "wall":
+        # assuming the zpaqs keep all the threads busy. zip is fast in comparison
+        cpu_budget_sec = budget_sec * workers * zpaq_threads
+    plan_zpaq_methods(jobs, load_history(), cpu_budget_sec)
+    checksums = collect_checksums(jobs, working_dir)
+    for job in jobs:
+        if journals7:
+            job["zpaq_archive"] = get_journal_name(
+                job["logger"], get_job_month(job), working_dir
+            )
+        else:
+            job["zpaq_archive"] = get_archive_name(
+                job["logger"], job["shard_key"], ".zpaq"
+            )
+        job["zip_archive"] = get_archive_name(job["logger"], job["shard_key"], ".zip")
+        write_job_checksums(job, working_dir, checksums)
+        ledger.add_job(job)
+
+    predicted_cpu_sec = sum(job["predicted_cpu_sec"] for job in jobs)
+    print_and_log(
+        "the budget: %s CPU s, the predicted zpaq CPU time: %.0f s"
+        % (
+            "no" if cpu_budget_sec is None else "%.0f" % cpu_budget_sec,
+            predicted_cpu_sec,
+        )
+    )
+
+    start = time.time()
+    job_reports = []
+    # the interrupted jobs are finished first. Otherwise, a resumed and a new job could append to the same journal
+    for jobs_to_run in (resumed_jobs, jobs):
+        if len(jobs_to_run) == 0:
+            continue
+        # threads are enough, as the heavy lifting is done by the zpaq and zip processes
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    run_archiving_job,
+                    job,
+                    working_dir,
+                    zpaq_found7,
+                    zpaq_threads,
+                    ledger,
+                )
+                for job in jobs_to_run
+            ]
+            for future in futures:
+                try:
+                    job_reports.append(future.result())
+                    print_and_log(format_job_report(job_reports[-1]))
+                except Exception as e:
+                    print_and_log("an archiving job failed:", str(e))
+
+    total_mb = sum(r["input_mb"] for r in job_reports)
+    total_sec = time.time() - start
+    print_and_log(
+        "---------------archivation finished: %.1f MB in %.1f s---------------"
+        % (total_mb, total_sec)
+    )
+    return job_reports
+
+
+def pick_sample(entries, sample_mb):
+    """Returns the evenly spaced entries with the total size up to sample_mb (but at least one entry)
+
+    >>> entries0 = [{"name": str(i), "size": 2**20} for i in range(10)]
+    >>> [e["name"] for e in pick_sample(entries0, sample_mb=3)]
+    ['0', '3', '6']
+    >>> pick_sample(entries0, sample_mb=100) == entries0
+    True
+    """
+    total_mb = sum(entry["size"] for entry in entries) / 2**20
+    if total_mb <= sample_mb:
+        return entries
+    step = total_mb / sample_mb
+    res = []
+    res_size = 0
+    for i in range(0, len(entries), max(1, int(step))):
+        if len(res) > 0 and (res_size + entries[i]["size"]) / 2**20 > sample_mb:
+            break
+        res.append(entries[i])
+        res_size += entries[i]["size"]
+    return res
+
+
+def measure_compression(loggers, working_dir, cutoff, sample_mb):
+    """For each logger, compresses a sample of its files with all the zip levels and zpaq methods worth considering.
+
+    Nothing is deleted or moved: the archives are written to a temp dir, and then deleted.
+    For each choice, it logs the compression ratio and the CPU seconds per GB,
+    and appends them to measurements_filename (a json per line), to choose the policy in configure_loggers().
+
+    Returns:
+        res: list of dicts: the measurements
+    """
+    print_and_log("---------------measuring the compression---------------")
+    manifest = find_files_to_archive(working_dir, loggers, cutoff)
+    zpaq_found7 = is_file7("zpaq715")
+
+    choices = [("zip", level) for level in measured_zip_levels]
+    if zpaq_found7:
+        choices += [("zpaq", method) for method in measured_zpaq_methods]
+
+    res = []
+    temp_dir = tempfile.mkdtemp(prefix="archiver_measurements", dir=working_dir)
+    try:
+        for lgr in loggers:
+            entries = [
+                e for group in manifest[lgr.archive_prefix].values() for e in group
+            ]
+            sample = pick_sample(entries, sample_mb)
+            if len(sample) == 0:
+                continue
+            filenames = [entry["name"] for entry in sample]
+            input_bytes = sum(entry["size"] for entry in sample)
+
+            for tool, level in choices:
+                archive_path = os.path.join(temp_dir, "sample." + tool)
+                if tool == "zip":
+                    _, cpu_sec = run_zip(
+                        archive_path, filenames, working_dir, level, move7=False
+                    )
+                else:
+                    _, cpu_sec = run_zpaq(
+                        archive_path, filenames, working_dir, level, threads=1
+                    )
+
+                output_bytes = os.path.getsize(archive_path)
+                os.remove(archive_path)
+
+                measurement = {
+                    "timestamp": human_timestamp(),
+                    "archive_prefix": lgr.archive_prefix,
+                    "tool": tool,
+                    "level": level,
+                    "input_mb": input_bytes / 2**20,
+                    "ratio": input_bytes / max(1, output_bytes),
+                    "cpu_sec_per_gb": cpu_sec / max(1e-9, input_bytes / 2**30),
+                }
+                res.append(measurement)
+                print_and_log(
+                    "%s %s level %d: ratio %.2f, %.0f CPU s per GB (sample: %.1f MB)"
+                    % (
+                        lgr.archive_prefix,
+                        tool,
+                        level,
+                        measurement["ratio"],
+                        measurement["cpu_sec_per_gb"],
+                        measurement["input_mb"],
+                    )
+                )
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    with open(get_full_path(measurements_filename), "a") as measurements_f:
+        for measurement in res:
+            measurements_f.write(json.dumps(measurement) + "\n")
+    return res
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description="archives the logs of the previous sessions"
+    )
+    parser.add_argument(
+        "--cutoff",
+        dest="cutoff",
+        default=None,
+        help="archive only the files older than this timestamp (see human_timestamp in utils.py). Default: now",
+    )
+    parser.add_argument(
+        "--budget-sec",
+        dest="budget_sec",
+        type=float,
+        default=None,
+        help="the time budget for the archivation, in seconds (0 for no budget). Default: archival_budget_sec",
+    )
+    parser.add_argument(
+        "--budget-kind",
+        dest="budget_kind",
+        choices=["wall", "cpu"],
+        default=archival_budget_kind,
+        help="what the budget limits: the wall-clock time, or the total CPU time",
+    )
+    parser.add_argument(
+        "--journals",
+        dest="journals7",
+        action="store_true",
+        help="append to the monthly journals instead of creating new archives. See use_journals7",
+    )
+    parser.add_argument(
+        "--measure",
+        dest="measure7",
+        action="store_true",
+        help="don't archive anything. Instead, measure the ratio and the CPU cost of the compression settings",
+    )
+    parser.add_argument(
+        "--sample-mb",
+        dest="sample_mb",
+        type=float,
+        default=200.0,
+        help="in the measurement mode, how much of the logs of each logger to compress",
+    )
+    return parser.parse_args()
+
+
+def run_archiver():
+    args = parse_command_line_args()
+    cutoff = args.cutoff if args.cutoff is not None else human_timestamp()
+    # the archives of this run are named after this moment. The archivation could take hours
+    start = datetime.datetime.now().replace(microsecond=0)
+
+    # to not let two archivers process the same files (e.g. if the launcher was run twice)
+    with open(get_full_path(lock_filename), "w") as lock_f:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print_and_log("another archiver is already running. Exiting")
+            return
+
+        if args.measure7:
+            measure_compression(
+                configure_loggers(),
+                get_archives_dir(__location__),
+                cutoff,
+                args.sample_mb,
+            )
+            return
+
+        # the resumed jobs keep their archives, named before this run. They are paired for the deletion explicitly
+        resumed_pairs = JobLedger(get_full_path(ledger_filename)).archive_pairs()
+        budget_sec = archival_budget_sec
+        if args.budget_sec is not None:
+            budget_sec = args.budget_sec if args.budget_sec > 0 else None
+        archive_everything(
+            configure_loggers(),
+            get_archives_dir(__location__),
+            cutoff,
+            budget_sec=budget_sec,
+            budget_kind=args.budget_kind,
+            journals7=use_journals7 or args.journals7,
+        )
+        execute_deletion(since=start, known_pairs=resumed_pairs)
+
+
+if __name__ == "__main__":
+    run_archiver()
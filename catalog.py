@@ -0,0 +1,347 @@
+import argparse
+import datetime
+import os
+import sqlite3
+import threading
+
+from utils import print_and_log, get_full_path, strip_compression_suffix
+
+""" A local SQLite catalog of the captured files, shared by the loggers, the archiver and zips_deleter.py.
+
+Each logger registers every file it has closed: the modality, the start and end time, the size and the sha256.
+The archiver records in which archives each file is stored. It allows to find the data by an indexed query,
+instead of listing the working dir with hundreds of thousands of files. For example:
+
+python3 catalog.py --modality screen --since "2021-05-02 10:00" --until "2021-05-02 10:05"
+python3 catalog.py --usage
+
+The catalog is an index, not the source of truth: the files written before it existed are not there,
+and the registration is skipped (with a log message) if the database is locked for more than logger_busy_timeout_sec.
+"""
+
+use_catalog7 = True
+catalog_filename = "capture_catalog.sqlite"
+
+# how long to wait for another process that is writing into the catalog, in seconds
+busy_timeout_sec = 30
+# the same for the loggers: they don't wait, as it would delay the capture. The row is dropped instead
+logger_busy_timeout_sec = 0.2
+
+modalities_by_filetype = {
+    "keystxt": "keyboard",
+    "mousetxt": "mouse",
+    "jpeg": "screen",
+    "mp3": "headphone",
+    "wav": "mic",
+    "checksums": "checksums",
+}
+
+schema = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    modality TEXT NOT NULL,
+    start_time REAL,
+    end_time REAL,
+    size INTEGER,
+    sha256 TEXT,
+    zpaq_archive TEXT,
+    zip_archive TEXT,
+    dir TEXT
+);
+CREATE INDEX IF NOT EXISTS files_by_modality_time ON files (modality, start_time);
+CREATE INDEX IF NOT EXISTS files_by_zip ON files (zip_archive);
+"""
+
+# a connection per thread per catalog path. The threads never wait for each other, only SQLite's locks apply
+thread_connections = threading.local()
+
+
+def get_connection(catalog_path=None, timeout_sec=busy_timeout_sec):
+    if catalog_path is None:
+        catalog_path = get_full_path(catalog_filename)
+    if not hasattr(thread_connections, "by_path"):
+        thread_connections.by_path = dict()
+    connection = thread_connections.by_path.get(catalog_path)
+    if connection is None:
+        connection = sqlite3.connect(catalog_path, timeout=timeout_sec)
+        # the loggers write while the archiver reads. WAL lets them do it without blocking each other
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(schema)
+        # the catalogs created before the hour shards (see output_root in utils.py) have no dir column
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(files)")]
+        if "dir" not in columns:
+            connection.execute("ALTER TABLE files ADD COLUMN dir TEXT")
+        thread_connections.by_path[catalog_path] = connection
+    connection.execute("PRAGMA busy_timeout = %d" % (timeout_sec * 1000))
+    return connection
+
+
+def execute(
+    statement, rows=None, catalog_path=None, many7=False, timeout_sec=busy_timeout_sec
+):
+    """Runs the statement in a transaction. Returns the fetched rows, or None if failed.
+
+    If another process holds the catalog for more than timeout_sec, it fails.
+    """
+    try:
+        connection = get_connection(catalog_path, timeout_sec)
+        with connection:
+            if many7:
+                cursor = connection.executemany(statement, rows)
+            else:
+                cursor = connection.execute(statement, rows or ())
+            return cursor.fetchall()
+    except sqlite3.Error as e:
+        print_and_log("catalog query failed:", str(e))
+        return None
+
+
+def get_modality(filename):
+    """E.g. "screen" for "20210502112444123screen.jpeg". The unknown extensions are returned as is
+
+    >>> get_modality("20210502112444123.mousetxt.gz")
+    'mouse'
+    """
+    filetype = strip_compression_suffix(filename).rpartition(".")[2]
+    return modalities_by_filetype.get(filetype, filetype)
+
+
+def get_name_time(filename):
+    """Returns the time (in seconds since the epoch) the filename starts with, or None.
+
+    >>> get_name_time("202105021124441234screen.jpeg") == datetime.datetime(2021, 5, 2, 11, 24, 44, 123000).timestamp()
+    True
+    >>> get_name_time("dummy.wav") is None
+    True
+    """
+    digits = ""
+    for char in filename[:17]:
+        if not char.isdigit():
+            break
+        digits += char
+    if len(digits) < 14:
+        return None
+    digits = digits[:17].ljust(17, "0")
+    try:
+        res = datetime.datetime.strptime(digits[:14], "%Y%m%d%H%M%S")
+    except ValueError:
+        return None
+    return res.timestamp() + int(digits[14:]) / 1000
+
+
+def register_file(full_path, checksum_record=None, catalog_path=None):
+    """Adds a closed file to the catalog. A failure is logged, but never stops the logger.
+
+    It waits for the catalog no more than logger_busy_timeout_sec. If it's busy longer, the file is not registered.
+
+    Args:
+        full_path: str: the file
+        checksum_record: dict: optional: the size and sha256 of the file, see record_checksum() in utils.py
+        catalog_path: str: optional: by default, catalog_filename in the dir of this script
+
+    >>> import tempfile
+    >>> path0 = os.path.join(tempfile.mkdtemp(), "test_catalog.sqlite")
+    >>> register_file("/x/202105021124441234screen.jpeg", {"size": 10, "sha256": "ab"}, catalog_path=path0)
+    >>> register_file("/x/202105021124501234screen.jpeg", {"size": 20, "sha256": "cd"}, catalog_path=path0)
+    >>> register_file("/x/202105021125001234.mousetxt", {"size": 5, "sha256": "ef"}, catalog_path=path0)
+    >>> since0 = datetime.datetime(2021, 5, 2, 11, 24, 45).timestamp()
+    >>> query_files("screen", since0, since0 + 3600, catalog_path=path0)
+    ['202105021124501234screen.jpeg']
+    >>> bytes_per_modality_per_day(catalog_path=path0)
+    [('mouse', '2021-05-02', 5), ('screen', '2021-05-02', 30)]
+    >>> set_archive(["202105021124501234screen.jpeg"], "a.zpaq", "a.zip", catalog_path=path0)
+    >>> forget_zip("a.zip", catalog_path=path0)
+    >>> execute("SELECT zpaq_archive, zip_archive FROM files WHERE zpaq_archive IS NOT NULL", catalog_path=path0)
+    [('a.zpaq', None)]
+    """
+    if not use_catalog7:
+        return
+    filename = os.path.basename(full_path)
+    record = checksum_record or dict()
+    try:
+        end_time = os.path.getmtime(full_path)
+    except OSError:
+        end_time = None
+    res = execute(
+        "INSERT OR REPLACE INTO files (name, modality, start_time, end_time, size, sha256, dir) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            filename,
+            get_modality(filename),
+            get_name_time(filename),
+            end_time,
+            record.get("size"),
+            record.get("sha256"),
+            os.path.dirname(os.path.abspath(full_path)),
+        ),
+        catalog_path=catalog_path,
+        timeout_sec=logger_busy_timeout_sec,
+    )
+    if res is None:
+        print_and_log("the file is not registered in the catalog", full_path)
+
+
+def set_archive(filenames, zpaq_archive, zip_archive, catalog_path=None):
+    """Records that the files are stored in the archives. The files unknown to the catalog are added
+
+    The filenames could be relative paths (e.g. screen/2021/05/02/11/20210502112444123screen.jpeg). Only the names matter.
+    """
+    if not use_catalog7 or len(filenames) == 0:
+        return
+    filenames = [os.path.basename(name) for name in filenames]
+    execute(
+        "INSERT OR IGNORE INTO files (name, modality, start_time) VALUES (?, ?, ?)",
+        [(name, get_modality(name), get_name_time(name)) for name in filenames],
+        catalog_path=catalog_path,
+        many7=True,
+    )
+    execute(
+        "UPDATE files SET zpaq_archive = ?, zip_archive = ? WHERE name = ?",
+        [(zpaq_archive, zip_archive, name) for name in filenames],
+        catalog_path=catalog_path,
+        many7=True,
+    )
+
+
+def forget_zip(zip_archive, catalog_path=None):
+    """Records that the zip was deleted"""
+    if not use_catalog7:
+        return
+    execute(
+        "UPDATE files SET zip_archive = NULL WHERE zip_archive = ?",
+        (zip_archive,),
+        catalog_path=catalog_path,
+    )
+
+
+def loose_files(catalog_path=None):
+    """Returns the files that are not in any archive yet, as a list of (name, modality, start_time, size, dir)
+
+    The dir is None for the files registered before the dir was recorded.
+    """
+    rows = execute(
+        "SELECT name, modality, start_time, size, dir FROM files "
+        "WHERE zpaq_archive IS NULL AND zip_archive IS NULL ORDER BY start_time",
+        catalog_path=catalog_path,
+    )
+    return [tuple(row) for row in rows or []]
+
+
+def update_file(name, size, sha256, catalog_path=None):
+    """Records the new size and sha256 of a changed file (e.g. thinned by retention.py)"""
+    if not use_catalog7:
+        return
+    execute(
+        "UPDATE files SET size = ?, sha256 = ? WHERE name = ?",
+        (size, sha256, name),
+        catalog_path=catalog_path,
+    )
+
+
+def set_dir(names, file_dir, catalog_path=None):
+    """Records the new dir of the moved files (e.g. from the staging dir to the disk by flusher.py)"""
+    if not use_catalog7 or len(names) == 0:
+        return
+    execute(
+        "UPDATE files SET dir = ? WHERE name = ?",
+        [(file_dir, name) for name in names],
+        catalog_path=catalog_path,
+        many7=True,
+    )
+
+
+def forget_files(names, catalog_path=None):
+    """Removes the deleted files from the catalog"""
+    if not use_catalog7 or len(names) == 0:
+        return
+    execute(
+        "DELETE FROM files WHERE name = ?",
+        [(name,) for name in names],
+        catalog_path=catalog_path,
+        many7=True,
+    )
+
+
+def forget_archive(archive_name, catalog_path=None):
+    """Records that the archive (zip or zpaq) was deleted. The files that are not in any archive anymore are removed"""
+    if not use_catalog7:
+        return
+    rows = execute(
+        "SELECT name FROM files WHERE zpaq_archive = ? OR zip_archive = ?",
+        (archive_name, archive_name),
+        catalog_path=catalog_path,
+    )
+    for column in ("zpaq_archive", "zip_archive"):
+        execute(
+            "UPDATE files SET %s = NULL WHERE %s = ?" % (column, column),
+            (archive_name,),
+            catalog_path=catalog_path,
+        )
+    execute(
+        "DELETE FROM files WHERE name = ? AND zpaq_archive IS NULL AND zip_archive IS NULL",
+        rows or [],
+        catalog_path=catalog_path,
+        many7=True,
+    )
+
+
+def query_files(modality, since, until, catalog_path=None):
+    """Returns the names of the files of the modality, started in the time range (in seconds since the epoch)"""
+    rows = execute(
+        "SELECT name FROM files WHERE modality = ? AND start_time >= ? AND start_time < ? "
+        "ORDER BY start_time",
+        (modality, since, until),
+        catalog_path=catalog_path,
+    )
+    return [row[0] for row in rows or []]
+
+
+def bytes_per_modality_per_day(catalog_path=None):
+    """Returns a list of (modality, day, bytes), sorted by modality and day"""
+    rows = execute(
+        "SELECT modality, date(start_time, 'unixepoch', 'localtime') AS day, SUM(size) FROM files "
+        "WHERE start_time IS NOT NULL GROUP BY modality, day ORDER BY modality, day",
+        catalog_path=catalog_path,
+    )
+    return [tuple(row) for row in rows or []]
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(description="Queries the capture catalog")
+    parser.add_argument("--modality", help="e.g. screen, mouse, keyboard, mic")
+    parser.add_argument("--since", help='e.g. "2021-05-02 10:00"')
+    parser.add_argument("--until", help='e.g. "2021-05-02 10:05"')
+    parser.add_argument(
+        "--usage",
+        dest="usage7",
+        action="store_true",
+        help="print the bytes per modality per day",
+    )
+    return parser.parse_args()
+
+
+def parse_time(time_str):
+    if time_str is None:
+        return None
+    return datetime.datetime.strptime(time_str, "%Y-%m-%d %H:%M")
+
+
+def run_query():
+    args = parse_command_line_args()
+    if args.usage7:
+        for modality, day, size in bytes_per_modality_per_day():
+            print("%s %s %.1f MB" % (day, modality, (size or 0) / 2**20))
+    if args.modality is not None:
+        since = parse_time(args.since)
+        until = parse_time(args.until)
+        for name in query_files(
+            args.modality,
+            since.timestamp() if since else 0,
+            until.timestamp() if until else float("inf"),
+        ):
+            print(name)
+
+
+if __name__ == "__main__":
+    run_query()
@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import re
+
+from archiver import iterate_hour_dirs
+from catalog import get_name_time, parse_time
+from utils import output_root, get_archives_dir, repeats_filetype, triggers_filetype
+
+""" Reads the captured screenshots as a dataset, resolving the repeat records.
+
+If dedup_identical_frames7 is on in logger_screen.py, an unchanged frame is not saved as a new jpeg.
+Instead, a record like {"name": "20210502112450123screen.jpeg", "repeat_of": "20210502112444123screen.jpeg"}
+is appended to the session's repeats file. Here, such a frame is returned as if it was a jpeg on its own,
+with the path of the repeated screenshot. For example:
+
+python3 dataset_reader.py --since "2021-05-02 10:00" --until "2021-05-02 10:05"
+
+In the triggered mode (see triggered_capture7 in logger_screen.py), the screenshots taken on a button or key press
+are returned with the triggering event, e.g. "button1". The others are returned with None.
+
+In the foveated mode (see foveated7 in logger_screen.py), each frame also has a full resolution crop around the pointer,
+e.g. 20210502112444123fovea_x560_y240_s4.jpeg. It's returned with the frame, see parse_fovea_name().
+
+Only the not yet archived files are read. The repeats never refer to another dir, so an extracted hour
+(or an extracted archive in the flat layout) can be read as a whole. retention.py never thins a repeated screenshot,
+but if it was deleted anyway, its repeats are skipped.
+"""
+
+fovea_pattern = re.compile(r"^(\d+)fovea_x(\d+)_y(\d+)_s(\d+)\.jpeg$")
+
+# get the location of this very file
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+
+def read_session_records(full_path, key):
+    """Returns the records of a repeats or triggers file as a dict: name -> record[key]. The broken lines are skipped"""
+    res = dict()
+    with open(full_path) as session_f:
+        for line in session_f:
+            try:
+                record = json.loads(line)
+                res[record["name"]] = record[key]
+            except (ValueError, KeyError, TypeError):
+                continue
+    return res
+
+
+def parse_fovea_name(filename):
+    """Returns (the timestamp, the crop's x, y on the full resolution frame, the frame's scale factor), or None
+
+    To map a point of the crop to the stored low resolution frame: ((x + crop_x) / scale, (y + crop_y) / scale)
+
+    >>> parse_fovea_name("20210502112444123fovea_x560_y240_s4.jpeg")
+    ('20210502112444123', 560, 240, 4)
+    >>> parse_fovea_name("20210502112444123screen.jpeg") is None
+    True
+    """
+    match = fovea_pattern.match(filename)
+    if match is None:
+        return None
+    timestamp, crop_x, crop_y, scale = match.groups()
+    return timestamp, int(crop_x), int(crop_y), int(scale)
+
+
+def get_frame_timestamp(filename):
+    """E.g. "20210502112444123" for "20210502112444123screen.jpeg" """
+    return filename[: -len("screen.jpeg")]
+
+
+def read_screen_dir(dir_path):
+    """Returns the list of (name, full path of the jpeg, full path of the crop or None, event or None)
+    for the screenshots of the dir.
+
+    The list is sorted by name. A repeat gets the paths of the repeated screenshot.
+
+    >>> import tempfile
+    >>> dir0 = tempfile.mkdtemp()
+    >>> for name0 in ["20210502112444123screen.jpeg", "20210502112444123fovea_x0_y0_s4.jpeg", "20210502112500123screen.jpeg"]:
+    ...     open(os.path.join(dir0, name0), "w").close()
+    >>> with open(os.path.join(dir0, "20210502112444000.jpeg.repeats"), "w") as f0:
+    ...     _ = f0.write('{"name": "20210502112450123screen.jpeg", "repeat_of": "20210502112444123screen.jpeg"}\\n')
+    ...     _ = f0.write('{"name": "20210502112520123screen.jpeg", "repeat_of": "deleted_screen.jpeg"}\\n')
+    >>> with open(os.path.join(dir0, "20210502112444000.jpeg.triggers"), "w") as f0:
+    ...     _ = f0.write('{"name": "20210502112500123screen.jpeg", "event": "button1"}\\n')
+    >>> for res0 in read_screen_dir(dir0):
+    ...     print(*[os.path.basename(e) if e else e for e in res0])
+    20210502112444123screen.jpeg 20210502112444123screen.jpeg 20210502112444123fovea_x0_y0_s4.jpeg None
+    20210502112450123screen.jpeg 20210502112444123screen.jpeg 20210502112444123fovea_x0_y0_s4.jpeg None
+    20210502112500123screen.jpeg 20210502112500123screen.jpeg None button1
+    """
+    saved = dict()
+    foveas = dict()
+    repeats = dict()
+    triggers = dict()
+    for filename in os.listdir(dir_path):
+        full_path = os.path.join(dir_path, filename)
+        fovea_info = parse_fovea_name(filename)
+        if fovea_info is not None:
+            foveas[fovea_info[0]] = full_path
+        elif filename.endswith(".jpeg"):
+            saved[filename] = full_path
+        elif filename.endswith(".jpeg." + repeats_filetype):
+            try:
+                repeats.update(read_session_records(full_path, "repeat_of"))
+            except OSError as e:
+                print("failed to read the repeats " + full_path + ":", str(e))
+        elif filename.endswith(".jpeg." + triggers_filetype):
+            try:
+                triggers.update(read_session_records(full_path, "event"))
+            except OSError as e:
+                print("failed to read the triggers " + full_path + ":", str(e))
+
+    res = {
+        name: (full_path, foveas.get(get_frame_timestamp(name)))
+        for name, full_path in saved.items()
+    }
+    for name, repeat_of in repeats.items():
+        if repeat_of in res:
+            res[name] = res[repeat_of]
+    return [
+        (name,) + paths + (triggers.get(name),) for name, paths in sorted(res.items())
+    ]
+
+
+def get_screen_dirs(data_dir):
+    """The hour dirs of the screenshots if the hour shards are enabled (see output_root in utils.py), the data dir otherwise"""
+    if output_root is None:
+        return [data_dir]
+    return [
+        os.path.join(data_dir, hour_dir)
+        for hour_dir, _ in iterate_hour_dirs(data_dir, "screen")
+    ]
+
+
+def iterate_screenshots(data_dir, since=None, until=None):
+    """Yields (name, time, full path of the jpeg, full path of the crop or None, event or None) for every frame.
+
+    The frames are yielded in the order of capture.
+
+    Args:
+        data_dir: str: the dir with the captures, see get_archives_dir() in utils.py
+        since, until: float: optional: the time range, in seconds since the epoch
+    """
+    for dir_path in get_screen_dirs(data_dir):
+        for name, full_path, fovea_path, event in read_screen_dir(dir_path):
+            frame_time = get_name_time(name)
+            if frame_time is None:
+                continue
+            if since is not None and frame_time < since:
+                continue
+            if until is not None and frame_time >= until:
+                continue
+            yield name, frame_time, full_path, fovea_path, event
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description="Lists the captured screenshots, with the repeats resolved"
+    )
+    parser.add_argument("--since", help='e.g. "2021-05-02 10:00"')
+    parser.add_argument("--until", help='e.g. "2021-05-02 10:05"')
+    return parser.parse_args()
+
+
+def run_listing():
+    args = parse_command_line_args()
+    since = parse_time(args.since)
+    until = parse_time(args.until)
+    for name, _, full_path, fovea_path, event in iterate_screenshots(
+        get_archives_dir(__location__),
+        since.timestamp() if since else None,
+        until.timestamp() if until else None,
+    ):
+        print(name, full_path, fovea_path or "", event or "")
+
+
+if __name__ == "__main__":
+    run_listing()
@@ -0,0 +1,218 @@
+import ctypes
+import ctypes.util
+import fcntl
+import os
+import time
+
+from archiver import get_open_files
+from utils import get_full_path, print_and_log, session_filetypes
+from utils import staging_root, staging_ram_cap_mb, get_archives_dir
+from catalog import set_dir
+
+""" Moves the closed files from the RAM-backed staging dir to the disk, in batches. Launched by launcher.py.
+
+If staging_root is set in utils.py, the loggers write there instead of the disk. It spares the SSD the many
+small creates and writes: the flusher writes the files of a batch sequentially, then syncs the target filesystem
+once for the whole batch, and deletes the staged copies only after that sync.
+The layout under staging_root mirrors the one on the disk.
+
+The durability is explicit: a file closed by a logger reaches the disk in no more than max_loss_window_sec
+(plus the time to write the batch). If the machine loses power, only the files of that window are lost.
+If the staged files exceed staging_ram_cap_mb/2, they are flushed at once, without waiting for the window.
+
+The per-session files (see session_filetypes in utils.py), e.g. the checksums manifests, are appended to
+by the loggers all the session long.
+They are claimed by renaming, and their lines are appended to the manifests on the disk.
+"""
+
+# a file closed by a logger is on the disk no later than this, in seconds.
+# Keep it below shard_grace_sec in archiver.py, to not add files to the already archived hours
+max_loss_window_sec = 60
+
+# the files modified more recently are left for the next batch, as the logger could be still recording their checksums
+min_file_age_sec = 5
+
+check_interval_sec = 5
+
+copy_chunk_bytes = 2**22
+
+lock_filename = "flusher.lock"
+
+# the empty staged dirs (e.g. of the past hours) are removed after this, in seconds
+empty_dir_age_sec = 3600
+
+# a staged manifest is renamed with this suffix before it's appended to the one on the disk
+claimed_suffix = ".flushing"
+
+# get the location of this very file
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+
+def list_staged(staging):
+    """Returns the list of (relative path, size, mtime) of the staged files, the oldest first"""
+    res = []
+    for parent, _, filenames in os.walk(staging):
+        for filename in filenames:
+            full_path = os.path.join(parent, filename)
+            try:
+                stat_info = os.stat(full_path)
+            except OSError:
+                continue
+            res.append(
+                (
+                    os.path.relpath(full_path, staging),
+                    stat_info.st_size,
+                    stat_info.st_mtime,
+                )
+            )
+    res.sort(key=lambda e: e[2])
+    return res
+
+
+def select_batch(staged, open_files, now):
+    """Returns the relative paths of the closed files that can be flushed now
+
+    >>> staged0 = [("a.jpeg", 10, 100.0), ("b.jpeg", 10, 103.0), ("c.mousetxt", 10, 104.0)]
+    >>> select_batch(staged0, {"c.mousetxt"}, now=107.0)
+    ['a.jpeg']
+    """
+    res = []
+    for rel_path, _, mtime in staged:
+        if rel_path in open_files or now - mtime < min_file_age_sec:
+            continue
+        res.append(rel_path)
+    return res
+
+
+def copy_file(source_path, target_path, append7=False):
+    """Writes the file to the disk, without syncing it (see sync_filesystem()).
+
+    Unless appended, it's written to a .part file first, so a half-written file never has the final name.
+    """
+    write_path = target_path if append7 else target_path + ".part"
+    with open(source_path, "rb") as source_f:
+        with open(write_path, "ab" if append7 else "wb") as target_f:
+            for chunk in iter(lambda: source_f.read(copy_chunk_bytes), b""):
+                target_f.write(chunk)
+    if not append7:
+        stat_info = os.stat(source_path)
+        # keeps the mtime, as it's the end time of the capture
+        os.utime(write_path, ns=(stat_info.st_atime_ns, stat_info.st_mtime_ns))
+        os.replace(write_path, target_path)
+
+
+def sync_filesystem(dir_path):
+    """Makes everything written to the filesystem of the dir durable: the file contents, the renames and the dirs.
+
+    A single syncfs() call for the whole batch. If it's unavailable, os.sync() is used (it syncs all the filesystems)
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    syncfs = getattr(libc, "syncfs", None)
+    if syncfs is None:
+        os.sync()
+        return
+    dir_fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        if syncfs(dir_fd) != 0:
+            raise OSError(ctypes.get_errno(), "syncfs failed", dir_path)
+    finally:
+        os.close(dir_fd)
+
+
+def flush_batch(staging, persistent_dir, batch):
+    """Moves the files to the disk. Returns the number of the moved files"""
+    flushed = []
+    for rel_path in batch:
+        source_path = os.path.join(staging, rel_path)
+        target_path = os.path.join(persistent_dir, rel_path)
+        # a manifest claimed by a previous flush that was interrupted
+        if rel_path.endswith(claimed_suffix):
+            target_path = target_path[: -len(claimed_suffix)]
+        append7 = target_path.rpartition(".")[2] in session_filetypes
+        try:
+            if append7 and not source_path.endswith(claimed_suffix):
+                # the logger's next record creates a new staged manifest
+                claimed_path = source_path + claimed_suffix
+                os.replace(source_path, claimed_path)
+                source_path = claimed_path
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            copy_file(source_path, target_path, append7)
+        except OSError as e:
+            print_and_log("flusher: failed to flush " + rel_path, str(e))
+            continue
+        flushed.append((target_path, source_path))
+
+    if len(flushed) == 0:
+        return 0
+    # one sync for the whole batch. If it fails, the staged copies are kept, and flushed again by the next batch
+    sync_filesystem(persistent_dir)
+
+    moved_by_dir = dict()
+    for target_path, _ in flushed:
+        target_dir, name = os.path.split(target_path)
+        moved_by_dir.setdefault(target_dir, []).append(name)
+    for target_dir, names in moved_by_dir.items():
+        set_dir(names, target_dir)
+
+    # only now the files are durable on the disk
+    for _, source_path in flushed:
+        os.remove(source_path)
+    return len(flushed)
+
+
+def remove_empty_dirs(staging, now):
+    """Removes the staged hour dirs left empty. The recent ones are kept, as a logger could be about to write there"""
+    for parent, dirnames, filenames in os.walk(staging, topdown=False):
+        if parent == staging or dirnames or filenames:
+            continue
+        try:
+            if now - os.path.getmtime(parent) > empty_dir_age_sec:
+                os.rmdir(parent)
+        except OSError:  # a logger has just written into it
+            pass
+
+
+def flush_due7(staged, last_flush_time, now):
+    """The loss window is ending, or the staged files are taking too much RAM"""
+    if len(staged) == 0:
+        return False
+    if now - last_flush_time >= max_loss_window_sec - min_file_age_sec:
+        return True
+    return sum(e[1] for e in staged) >= staging_ram_cap_mb * 2**20 / 2
+
+
+def run_flusher():
+    if staging_root is None:
+        print_and_log("staging_root is not set in utils.py. Nothing to flush. Exiting")
+        return
+    staging = os.path.expanduser(staging_root)
+    persistent_dir = get_archives_dir(__location__)
+
+    # only one flusher at a time (e.g. if the launcher was run twice)
+    with open(get_full_path(lock_filename), "w") as lock_f:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print_and_log("another flusher is already running. Exiting")
+            return
+
+        os.makedirs(staging, exist_ok=True)
+        # the files left by a previous session are flushed at once
+        last_flush_time = 0
+        while True:
+            try:
+                staged = list_staged(staging)
+                now = time.time()
+                if flush_due7(staged, last_flush_time, now):
+                    batch = select_batch(staged, get_open_files(staging), now)
+                    flushed = flush_batch(staging, persistent_dir, batch)
+                    remove_empty_dirs(staging, now)
+                    last_flush_time = now
+                    print_and_log("flusher: files moved to the disk:", flushed)
+            except Exception as e:
+                print_and_log("flusher pass failed:", str(e))
+            time.sleep(check_interval_sec)
+
+
+if __name__ == "__main__":
+    run_flusher()
@@ -0,0 +1,169 @@
+import fcntl
+import json
+import os
+import shutil
+import time
+
+from utils import get_full_path, print_and_log, get_archives_dir
+from utils import governor_state_filename, load_slowdowns
+
+""" Tells the loggers to capture less while the machine is busy. Launched by launcher.py in the background.
+
+Every check_interval_sec, it reads the CPU pressure (/proc/pressure/cpu), the IO pressure (/proc/pressure/io),
+the load average per core, and the free disk space. Each of them gives a load level from 0 (idle) to 3 (overloaded),
+by the thresholds below, and the highest one is published in governor_state_filename (see get_load_level() in utils.py).
+
+The loggers step down as the level grows: the screen logger takes screenshots less often, and drops the HIGH SPEED mode,
+the quality and the HYPER scaling; the mouse and keyboard loggers poll less often; the archiver postpones its jobs.
+The level goes up at once, but goes down only one step per restore_after_sec of calm, to not oscillate.
+If the governor is not running, the loggers work at full rate.
+
+The pressure files need Linux 4.20+. Without them, only the load average and the free disk space are used.
+"""
+
+check_interval_sec = 5
+
+# the thresholds of the levels 1, 2, 3.
+# The pressure is the percentage of time some tasks waited for the CPU (or the IO), in the last 10 sec
+cpu_pressure_thresholds = (10.0, 25.0, 50.0)
+io_pressure_thresholds = (20.0, 40.0, 70.0)
+load_per_core_thresholds = (0.9, 1.5, 2.5)
+free_disk_gb_thresholds = (20.0, 10.0, 5.0)  # the less, the higher the level
+
+# the level goes one step down after this much time with the lower readings, in seconds
+restore_after_sec = 60
+
+lock_filename = "governor.lock"
+
+# get the location of this very file
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+
+def read_pressure_avg10(pressure_path):
+    """Returns the "some avg10" of a PSI file (e.g. /proc/pressure/cpu), or None if unavailable
+
+    The file looks like this:
+    some avg10=2.80 avg60=2.93 avg300=3.55 total=126563728
+    full avg10=0.00 avg60=0.00 avg300=0.00 total=0
+    """
+    try:
+        with open(pressure_path) as pressure_f:
+            for line in pressure_f:
+                parts = line.split()
+                if parts and parts[0] == "some":
+                    for part in parts[1:]:
+                        key, _, value = part.partition("=")
+                        if key == "avg10":
+                            return float(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def get_load_per_core():
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:  # not Linux
+        cores = os.cpu_count() or 1
+    return os.getloadavg()[0] / cores
+
+
+def level_by_thresholds(value, thresholds, descending7=False):
+    """Returns how many thresholds the value has reached: 0..len(thresholds). None counts as 0
+
+    >>> level_by_thresholds(30.0, (10.0, 25.0, 50.0))
+    2
+    >>> level_by_thresholds(7.0, (20.0, 10.0, 5.0), descending7=True)
+    2
+    >>> level_by_thresholds(None, (10.0, 25.0, 50.0))
+    0
+    """
+    if value is None:
+        return 0
+    if descending7:
+        return sum(1 for threshold in thresholds if value <= threshold)
+    return sum(1 for threshold in thresholds if value >= threshold)
+
+
+def measure(data_dir):
+    """Returns (the load level now, the readings as a dict)"""
+    readings = {
+        "cpu_pressure": read_pressure_avg10("/proc/pressure/cpu"),
+        "io_pressure": read_pressure_avg10("/proc/pressure/io"),
+        "load_per_core": round(get_load_per_core(), 2),
+        "free_disk_gb": round(shutil.disk_usage(data_dir).free / 2**30, 1),
+    }
+    level = max(
+        level_by_thresholds(readings["cpu_pressure"], cpu_pressure_thresholds),
+        level_by_thresholds(readings["io_pressure"], io_pressure_thresholds),
+        level_by_thresholds(readings["load_per_core"], load_per_core_thresholds),
+        level_by_thresholds(
+            readings["free_disk_gb"], free_disk_gb_thresholds, descending7=True
+        ),
+    )
+    return level, readings
+
+
+def next_level(level, measured_level, lowered_time, now):
+    """Returns (the new level, the time it was last changed or confirmed).
+
+    Up at once, down by one step after restore_after_sec below the current level.
+
+    >>> next_level(0, 3, 0, 100)
+    (3, 100)
+    >>> next_level(3, 0, 100, 130)
+    (3, 100)
+    >>> next_level(3, 0, 100, 160)
+    (2, 160)
+    >>> next_level(2, 2, 100, 170)
+    (2, 170)
+    """
+    if measured_level >= level:
+        return measured_level, now
+    if now - lowered_time >= restore_after_sec:
+        return level - 1, now
+    return level, lowered_time
+
+
+def publish_level(level, readings):
+    """Writes the state file atomically, for the loggers to read it"""
+    state_path = get_full_path(governor_state_filename)
+    temp_path = state_path + ".tmp"
+    with open(temp_path, "w") as state_f:
+        json.dump({"level": level, "time": time.time(), "readings": readings}, state_f)
+    os.replace(temp_path, state_path)
+
+
+def run_governor():
+    # only one governor at a time (e.g. if the launcher was run twice)
+    with open(get_full_path(lock_filename), "w") as lock_f:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print_and_log("another governor is already running. Exiting")
+            return
+
+        data_dir = get_archives_dir(__location__)
+        level = 0
+        changed_time = time.time()
+        while True:
+            try:
+                measured_level, readings = measure(data_dir)
+                new_level, changed_time = next_level(
+                    level, measured_level, changed_time, time.time()
+                )
+                if new_level != level:
+                    print_and_log(
+                        "governor: the load level is now %d (the loggers slow down x%s)"
+                        % (new_level, load_slowdowns[new_level]),
+                        json.dumps(readings),
+                    )
+                level = new_level
+                publish_level(level, readings)
+            except Exception as e:
+                print_and_log("governor check failed:", str(e))
+            time.sleep(check_interval_sec)
+
+
+if __name__ == "__main__":
+    run_governor()
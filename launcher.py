@@ -1,5 +1,8 @@
 """ Prepares the virtual environment for loggers, installs dependencies, and launches the loggers.
-Also launches the archiving of the yesterday's logs.
+Also launches the archiving of the yesterday's logs, in background (see archiver.py),
+and the retention manager that keeps the disk usage within budgets (see retention.py).
+Also launches the governor that slows the loggers down while the machine is busy (see governor.py).
+If the loggers write into a RAM-backed staging dir, also launches the flusher that moves their files to the disk (see flusher.py).
 
 The idea is to add this script to the list of startup applications, so
 it automatically do the logging and archiving.
@@ -28,10 +31,11 @@ if zpaqs are not created, try remake the zpaq exec.
 
 
 import os
+import shutil
 import subprocess
 import time
 
-from utils import human_timestamp, get_full_path, print_and_log, is_file7
+from utils import human_timestamp, get_full_path, print_and_log, staging_root
 
 # the script will try to create an venv environment with this name:
 env_name = "loggers_env"
@@ -39,18 +43,32 @@ env_name = "loggers_env"
 # TODO: move it the config
 launch_delay_sec = 1  # set it to at least 300, to allow the OS to load peacefully
 
+archiver_niceness = 19  # the lowest CPU priority
+
 env_path = get_full_path(env_name)
 python3_path = os.path.join(env_path, "/bin/python3")
 pip3_path = os.path.join(env_path, "/bin/pip3")
 
 
 class Logger:
-    def __init__(self, script_file, py_version, archive_prefix, output_filetype):
+    def __init__(
+        self,
+        script_file,
+        py_version,
+        archive_prefix,
+        output_filetype,
+        zip_level=6,
+        zpaq_method=5,
+    ):
         self.script_file = script_file  # e.g. 'logger_keyboard.py'
         self.py_version = py_version  # e.g. 'python3.6'
         self.archive_prefix = archive_prefix  # e.g. "brainOutput"
         self.output_filetype = output_filetype  # e.g. "txt" (without a point!)
 
+        # the compression policy. To choose it, see the measurements by "python3 archiver.py --measure"
+        self.zip_level = zip_level  # 0 to only store the files in the fallback zip, 1..9 to deflate them
+        self.zpaq_method = zpaq_method  # 1 (fast) .. 5 (max compression, the most CPU)
+
 
 def configure_loggers():
     logger_keyboard = Logger(
@@ -72,6 +90,8 @@ def configure_loggers():
         py_version="python3",
         archive_prefix="brainScreenInput",
         output_filetype="jpeg",
+        zip_level=0,  # jpeg is already compressed. Deflate and the heavy zpaq methods gain almost nothing
+        zpaq_method=1,  # still deduplicates the identical screenshots
     )
 
     logger_headphone = Logger(
@@ -79,6 +99,8 @@ def configure_loggers():
         py_version="python3",
         archive_prefix="brainSoundInput",
         output_filetype="mp3",
+        zip_level=0,  # mp3 is already compressed
+        zpaq_method=1,
     )
 
     logger_mic = Logger(
@@ -114,75 +136,67 @@ def run_in_env(script_filename):
     print_and_log("launched the script " + str(script_filename))
 
 
-def launch_zpaq_stuff(loggers, workingFolder):
-    """Launches zpaq processes, to archive the yesterday's logs.
-
-    Done sequentially, not in parallel, as each zpaq process consumes a lot of compute"""
-    print_and_log("---------------launching zpaq stuff---------------")
+def get_low_priority_prefix():
+    """Returns the command prefix to run a process at the idle CPU and I/O priority, to not slow down the loggers"""
+    res = []
+    if shutil.which("nice") is not None:
+        res += ["nice", "-n", str(archiver_niceness)]
+    if shutil.which("ionice") is not None:
+        # the idle class: gets the disk only if no one else needs it
+        res += ["ionice", "-c", "3"]
+    return res
 
-    if is_file7("zpaq715"):
-        path2zpaq = os.path.join(workingFolder, "zpaq715")
 
-        for lgr in loggers:
-            command = [
-                path2zpaq,
-                "add",
-                lgr.archive_prefix + human_timestamp()[:-4] + ".zpaq",
-                "./",
-                "-m5",
-                "-only",
-                "*." + lgr.output_filetype,
-            ]
+def launch_archiver(cutoff):
+    """Launches the archivation of the previous sessions' logs in the background. See archiver.py for details.
 
-            print_and_log("### ZPAQ command used: ", subprocess.list2cmdline(command))
-
-            try:
-                subprocess.call(command, cwd=workingFolder)
-            except Exception as e:
-                print_and_log("Failed to launch zpaq: ", str(e))
-
-        print_and_log("---------------zpaq stuff finished---------------")
-    else:
-        print_and_log(
-            "zpaq715 not found. Check if you have it in the same dir as this srcipt"
-        )
+    Args:
+        cutoff: str: the timestamp taken before launching the loggers. The newer files are not touched
+    """
+    print_and_log("---------------launching archiver in background---------------")
+    command = get_low_priority_prefix()
+    command += ["python3", get_full_path("archiver.py"), "--cutoff", cutoff]
+    try:
+        # popen because it disowns automatically
+        subprocess.Popen(command)
+        print_and_log("### archiver command used: ", subprocess.list2cmdline(command))
+    except Exception as e:
+        print_and_log("ERROR IN LAUNCHING archiver", str(e))
 
 
-def launch_zipping(loggers, workingFolder):
-    """
-    Explanation of the zip command arguments:
-    -@ file lists.   If  a file list is specified as -@ , zip
-       takes the list of input files from standard input instead of  from  the
-       command line.
-    -m deletes the target directories/files after making the  specified zip  archive
-    """
-    print_and_log("---------------launching zipping---------------")
+def launch_retention():
+    """Launches the retention manager in the background. It keeps the disk usage within budgets, see retention.py"""
+    command = get_low_priority_prefix()
+    command += ["python3", get_full_path("retention.py")]
+    try:
+        subprocess.Popen(command)
+        print_and_log("### retention command used: ", subprocess.list2cmdline(command))
+    except Exception as e:
+        print_and_log("ERROR IN LAUNCHING retention", str(e))
 
-    # the resulting command looks similar to this command:
-    # command='find . | egrep "\.(txt)$" | zip -@ -m brainOutput$(date +%Y%m%d%H%M%S).zip'
-    for lgr in loggers:
-        command = (
-            'find . | egrep "\.('
-            + lgr.output_filetype
-            + ')$" | zip -@ -m '
-            + lgr.archive_prefix
-            + "$(date +%Y%m%d%H%M%S).zip"
-        )
-        try:
-            subprocess.call(command, cwd=workingFolder, shell=True)
-        except Exception as e:
-            print_and_log("failed to launch zipping:", str(e))
 
-    print_and_log("---------------zipping finished---------------")
+def launch_flusher():
+    """Launches the flusher in the background, if the loggers write into the staging dir. See flusher.py"""
+    if staging_root is None:
+        return
+    # not at the idle priority: if starved, the staged files would fill the RAM
+    command = ["python3", get_full_path("flusher.py")]
+    try:
+        subprocess.Popen(command)
+        print_and_log("### flusher command used: ", subprocess.list2cmdline(command))
+    except Exception as e:
+        print_and_log("ERROR IN LAUNCHING flusher", str(e))
 
 
-def launch_autodelete():
-    print_and_log("---------------launching autoDelete in parallel---------------")
+def launch_governor():
+    """Launches the governor in the background. It tells the loggers to capture less under load, see governor.py"""
+    # not at the idle priority: it must notice the load in time
+    command = ["python3", get_full_path("governor.py")]
     try:
-        # popen because it disowns automatically
-        subprocess.Popen(["python3", get_full_path("zips_deleter.py")])
-    except:
-        print_and_log("ERROR IN LAUNCHING autoDelete")
+        subprocess.Popen(command)
+        print_and_log("### governor command used: ", subprocess.list2cmdline(command))
+    except Exception as e:
+        print_and_log("ERROR IN LAUNCHING governor", str(e))
 
 
 def launch_loggers(loggers):
@@ -250,10 +264,13 @@ def start_logging():
 
     create_dummy_files(working_dir)
 
-    launch_zpaq_stuff(loggers_list, working_dir)
-    launch_zipping(loggers_list, working_dir)
-    launch_autodelete()
+    # the loggers start at once. The files they create after this moment are never archived by this launch
+    archiving_cutoff = human_timestamp()
+    launch_flusher()
+    launch_governor()
     launch_loggers(loggers_list)
+    launch_archiver(archiving_cutoff)
+    launch_retention()
     preserve_source_code(working_dir)
 
 
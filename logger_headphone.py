@@ -2,7 +2,9 @@ import subprocess
 import os
 import time
 
-from utils import human_timestamp, print_and_log, is_file7
+from utils import human_timestamp, print_and_log, is_file7, record_checksum
+from utils import get_output_dir
+from catalog import register_file
 
 """ Records that the user hears, and saves the audio on regular intervals.
 
@@ -37,6 +39,9 @@ max_allowed_bitrate = 24
 
 mono7 = True  # If true, will reduce stereo sound to mono
 
+# the checksums of this session's files are recorded under this id
+session_id = human_timestamp()
+
 
 # get location of this very file to put the log in the same folder
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
@@ -44,7 +49,7 @@ __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file
 
 def get_full_path_sound():
     filename = human_timestamp() + "sound.mp3"
-    fullpath = os.path.join(__location__, filename)
+    fullpath = os.path.join(get_output_dir("headphone", __location__), filename)
     return fullpath
 
 
@@ -196,6 +201,10 @@ if __name__ == "__main__":
                     print("recording comand:\n", full_command)
 
                     subprocess.run(full_command, shell=True)
+                    if os.path.isfile(filename_str):
+                        register_file(
+                            filename_str, record_checksum(filename_str, session_id)
+                        )
                 else:
                     print_and_log(
                         "logger_headphone: main_command is None. Skipping this circle, with a delay"
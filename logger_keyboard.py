@@ -4,7 +4,9 @@ import sys
 import ctypes as ct
 from ctypes.util import find_library
 
-from utils import human_timestamp
+from utils import human_timestamp, record_checksum, get_output_dir
+from utils import text_log_compression, CompressedLog, get_load_level, load_slowdowns
+from catalog import register_file
 
 """A keylogger. Saves the keys the user presses, with timestamps.
 """
@@ -12,6 +14,10 @@ from utils import human_timestamp
 
 TimeBetweenSaves = 18.0  # in seconds
 verboseTimestamping7 = True  # if true, every keystroke will be timestamped
+max_sleep_interval = 0.02
+
+# the checksums of this session's files are recorded under this id
+session_id = human_timestamp()
 
 
 # linux only!
@@ -182,6 +188,11 @@ def fetch_keys():
 
 
 def log(done, callback, sleep_interval=0.005):
+    # under load (see governor.py), the keys are polled less often. But not slower than max_sleep_interval,
+    # to not miss the short key presses
+    sleep_interval = min(
+        sleep_interval * load_slowdowns[get_load_level()], max_sleep_interval
+    )
     while not done():
         time.sleep(sleep_interval)
         changed, log_modifiers, keys = fetch_keys()
@@ -195,7 +206,7 @@ __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file
 
 def get_full_path_keys():
     file_name = human_timestamp() + ".keystxt"
-    full_path = os.path.join(__location__, file_name)
+    full_path = os.path.join(get_output_dir("keyboard", __location__), file_name)
     return full_path
 
 
@@ -207,18 +218,31 @@ def record_keys(t, res_modifiers, keys):
         logArray.append("%r" % keys)
 
 
+# if the compression is on, the saves are appended to a compressed file, see text_log_compression in utils.py
+compressed_log = None
+if text_log_compression is not None:
+    compressed_log = CompressedLog(get_full_path_keys, text_log_compression)
+
 while True:
     try:
         logArray = []
         now = time.time()
         done = lambda: time.time() > now + TimeBetweenSaves
-        with open(get_full_path_keys(), "w") as myFile:
+        if compressed_log is not None:
             log(done, record_keys)
             logStr = "".join(logArray)
-            myFile.write(logStr)
-            myFile.flush()
-            # print logStr
-        myFile.close()
+            keys_path = compressed_log.write_block(logStr)
+        else:
+            keys_path = get_full_path_keys()
+            with open(keys_path, "w") as myFile:
+                log(done, record_keys)
+                logStr = "".join(logArray)
+                myFile.write(logStr)
+                myFile.flush()
+                # print logStr
+            myFile.close()
+        if keys_path is not None:
+            register_file(keys_path, record_checksum(keys_path, session_id))
         print("Saved a file with the following keys log:\n" + logStr)
     except Exception as e:
         print("logger_keyboard caused an exception:", str(e))
@@ -23,21 +23,25 @@ import random
 import configparser
 import math
 
-import statistics
-import struct
 import argparse
+import heapq
+import multiprocessing
 
 from array import array
 from sys import byteorder
 
 import wave
 import os
+import json
 import traceback
 
 from ctypes import CFUNCTYPE, c_char_p, c_int, cdll
 from contextlib import contextmanager  # ALSA error handling
 import time
 
+from catalog import register_file
+from utils import get_output_dir, record_checksum
+
 
 def print_and_log(my_text1, my_text2="", dummy_log_path=None, mode="a"):
     """Writes down the given text to a file. Also prints it to the console.
@@ -74,14 +78,6 @@ def print_and_log(my_text1, my_text2="", dummy_log_path=None, mode="a"):
     fff.close()
 
 
-try:
-    import gc
-    import pyaudio
-except Exception as e:
-    msg = "\n\nException while trying to import gc or pyaudio: " + str(e) + "\n\n"
-    print_and_log(msg)
-
-
 c_print_verbose7 = True  # if true, the c_print func will print to stdout
 
 
@@ -148,6 +144,14 @@ def filename_timestamp(custom_datetime=None, random_last_digit7=True):
     return time_st
 
 
+try:
+    import pyaudio
+except Exception as e:
+    # the offline sources (e.g. WavFileSource) still work without pyaudio
+    msg = "\n\nException while trying to import pyaudio: " + str(e) + "\n\n"
+    print_and_log(msg)
+
+
 def read_config():
     """Returns a dict with all the settings, read from config.ini
 
@@ -164,6 +168,12 @@ def read_config():
 
     res["indicator_part"] = pa.get("hardware", "indicator_part", fallback="USB")
     res["sound_dev_part"] = pa.get("hardware", "sound_dev_part", fallback="pulse")
+    res["sound_dev_parts"] = [
+        part.strip()
+        for part in pa.get("hardware", "sound_dev_parts", fallback="").split(",")
+        if part.strip() != ""
+    ]
+    res["multi_device"] = pa.getboolean("hardware", "multi_device", fallback=False)
     res["frame_rate"] = pa.getint("hardware", "frame_rate", fallback=48000)
     res["channels"] = pa.getint("hardware", "channels", fallback=1)
     res["chunk_size"] = pa.getint("hardware", "chunk_size", fallback=4098)
@@ -175,11 +185,28 @@ def read_config():
 
     res["trim_level"] = pa.getint("filter", "trim_level", fallback=0)
     res["calibrate_num"] = pa.getint("filter", "calibrate_num", fallback=100)
+    res["calibrate_warmup_num"] = pa.getint(
+        "filter", "calibrate_warmup_num", fallback=10
+    )
+    res["noise_quantile"] = pa.getint("filter", "noise_quantile", fallback=50)
+    res["calibration_path"] = pa.get(
+        "filter", "calibration_path", fallback="mic_calibration.json"
+    )
+    res["calibration_reset_ratio"] = pa.getfloat(
+        "filter", "calibration_reset_ratio", fallback=3.0
+    )
+    res["calibration_max_age_h"] = pa.getfloat(
+        "filter", "calibration_max_age_h", fallback=168.0
+    )
     res["min_relative_l"] = pa.getint("filter", "min_relative_l", fallback=250)
     res["max_relative_l"] = pa.getint("filter", "max_relative_l", fallback=1700)
     res["consecutive_num"] = pa.getint("filter", "consecutive_num", fallback=2)
     res["silent_num"] = pa.getint("filter", "silent_num", fallback=10)
     res["breath_min_data"] = pa.getint("breathing", "breath_min_data", fallback=1000)
+    res["record_checksums"] = pa.getboolean(
+        "archival", "record_checksums", fallback=True
+    )
+    res["use_catalog"] = pa.getboolean("archival", "use_catalog", fallback=True)
 
     res = add_calculated_config_keys(res)
 
@@ -198,6 +225,10 @@ def add_calculated_config_keys(config):
     normalize_minus_one_d_b = 10 ** (-1.0 / 20)
     config["normalisation_val"] = float(normalize_minus_one_d_b * frame_max_value)
     config["trim_append"] = config["frame_rate"] * 4
+
+    # in the multi-device mode, each capture process gets its own device. See run_multi_device()
+    config["device_index"] = None
+    config["device_label"] = ""
     return config
 
 
@@ -205,6 +236,8 @@ config_dic = read_config()
 
 dyn_level = 0
 breathing_raw_data = []
+# used instead of a real device id if the chunks are not read from a device:
+offline_device_id = -1
 start_time = None
 
 # ALSA error handling:
@@ -254,6 +287,248 @@ def get_absolute_threshold(dynamic_level, percent_louder_than_background):
     return percent_louder_than_background * dynamic_level / 100
 
 
+class NoiseFloorEstimator:
+    """Tracks the background noise level, chunk by chunk, with constant memory and constant cost per chunk.
+
+    The input is the max of each chunk. The estimate follows the given quantile of these values (the median by default).
+    Each chunk moves the estimate up or down by a small step, proportional to the running median absolute deviation.
+    calibrate_num (from the config) is the time constant of the adaptation, in chunks.
+    The level is published after calibrate_warmup_num chunks, and is updated on every chunk after that.
+
+    A saved calibration (see save_calibration) can be used with seed(). Then the level is published from the first chunk.
+    A fresh estimator runs in parallel for calibrate_warmup_num chunks. If the environment turns out to be too different
+    (by more than calibration_reset_ratio times), the seeded estimate is replaced with the fresh one.
+
+    >>> set_c_print_switch(False)
+    >>> test_config = {"calibrate_num": 100, "calibrate_warmup_num": 3, "noise_quantile": 50, "calibration_reset_ratio": 3}
+    >>> estimator0 = NoiseFloorEstimator(test_config)
+    >>> for value in [100, 120, 80]:
+    ...     estimator0.update(value)
+    >>> estimator0.level() > 0
+    True
+    >>> for i in range(1000):
+    ...     estimator0.update(200 + (i % 5) * 10 + (5000 if i % 10 == 0 else 0))  # occasional loud chunks
+    >>> 210 < estimator0.level() < 230
+    True
+    >>> estimator0.state()["count"]
+    1003
+    >>> saved = estimator0.export()
+    >>> estimator0.reset()
+    >>> estimator0.level()
+    0
+    >>> estimator0.seed(saved)
+    >>> 210 < estimator0.level() < 230  # no warmup needed
+    True
+    >>> for value in [215, 225, 220]:
+    ...     estimator0.update(value)
+    >>> estimator0.state()["resets"], 210 < estimator0.level() < 230
+    (0, True)
+    >>> estimator0.seed(saved)
+    >>> for value in [2000, 2100, 1900]:  # a much louder environment
+    ...     estimator0.update(value)
+    >>> estimator0.state()["resets"], estimator0.level() > 1000
+    (1, True)
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.adapt_num = 1
+        self.warmup_num = 1
+        self.quantile = 0.5
+        self.reset_ratio = 1.0
+        self.configure(config)
+        self.estimate = 0.0
+        self.deviation = 0.0
+        self.count = 0
+        self.resets = 0
+        self.device_name = None  # the device this estimate belongs to
+        self.probation = None  # a fresh estimator that checks a seeded estimate
+
+    def configure(self, config):
+        """Applies the settings from the config, without losing the current estimate"""
+        self.config = config
+        self.adapt_num = max(1, config["calibrate_num"])
+        self.warmup_num = max(1, config["calibrate_warmup_num"])
+        self.quantile = min(max(config["noise_quantile"] / 100, 0.01), 0.99)
+        self.reset_ratio = max(1.0, config["calibration_reset_ratio"])
+
+    def reset(self):
+        self.estimate = 0.0
+        self.deviation = 0.0
+        self.count = 0
+        self.probation = None
+
+    def seed(self, saved):
+        """Starts from a saved calibration (the output of export), instead of from scratch"""
+        self.estimate = float(saved["estimate"])
+        self.deviation = float(saved["deviation"])
+        self.count = self.warmup_num
+        self.probation = NoiseFloorEstimator(self.config)
+
+    def export(self):
+        """Returns the part of the state that is worth saving to disk"""
+        return {
+            "estimate": self.estimate,
+            "deviation": self.deviation,
+            "saved_at": time.time(),
+        }
+
+    def update(self, value):
+        """Updates the estimate with the max of a new chunk"""
+        self.count += 1
+        if self.count == 1:
+            self.estimate = float(value)
+            self.deviation = 0.0
+        else:
+            # at the start, it's a running average. Later - an exponential one, with the time constant adapt_num
+            rate = 1 / min(self.count, self.adapt_num)
+
+            # the deviation follows the median of the absolute errors in the same way, to ignore rare loud chunks
+            deviation_step = 2 * rate * max(self.deviation, 1.0)
+            if abs(value - self.estimate) > self.deviation:
+                self.deviation += deviation_step
+            else:
+                self.deviation = max(0.0, self.deviation - deviation_step)
+
+            step = 2 * rate * max(self.deviation, 1.0)
+            if value > self.estimate:
+                self.estimate += step * self.quantile
+            elif value < self.estimate:
+                self.estimate -= step * (1 - self.quantile)
+
+        if self.probation is not None:
+            self.check_probation(value)
+
+    def check_probation(self, value):
+        self.probation.update(value)
+        if self.probation.warm7():
+            ratio = (self.probation.estimate + 1) / (self.estimate + 1)
+            if ratio > self.reset_ratio or ratio < 1 / self.reset_ratio:
+                c_print(
+                    "the saved calibration doesn't fit the environment. Resetting it. Ratio:",
+                    ratio,
+                )
+                self.estimate = self.probation.estimate
+                self.deviation = self.probation.deviation
+                self.count = self.probation.count
+                self.resets += 1
+            self.probation = None
+
+    def warm7(self):
+        return self.count >= self.warmup_num
+
+    def level(self):
+        """Returns the background noise level, or 0 if it's not calibrated yet"""
+        if self.warm7():
+            return self.estimate
+        else:
+            return 0
+
+    def state(self):
+        """Returns the internal state, for diagnostics"""
+        return {
+            "level": self.level(),
+            "estimate": self.estimate,
+            "deviation": self.deviation,
+            "count": self.count,
+            "warm7": self.warm7(),
+            "quantile": self.quantile,
+            "adapt_num": self.adapt_num,
+            "device_name": self.device_name,
+            "on_probation7": self.probation is not None,
+            "resets": self.resets,
+        }
+
+
+def load_calibration(path, device_name, max_age_h):
+    """Returns the saved calibration for the given device, or None if there is no usable one.
+
+    Args:
+        path: str: the .json with the calibrations of all the devices
+        device_name: str: the name of the device, as reported by PyAudio
+        max_age_h: float: older calibrations are ignored
+    Returns:
+        res: dict or None: the output of NoiseFloorEstimator.export()
+
+    >>> path0 = "mock_calibration.json"
+    >>> save_calibration(path0, "USB PnP", {"estimate": 42.0, "deviation": 3.0, "saved_at": time.time()})
+    >>> load_calibration(path0, "USB PnP", max_age_h=1)["estimate"]
+    42.0
+    >>> load_calibration(path0, "some other device", max_age_h=1) is None
+    True
+    >>> save_calibration(path0, "USB PnP", {"estimate": 42.0, "deviation": 3.0, "saved_at": time.time() - 7200})
+    >>> load_calibration(path0, "USB PnP", max_age_h=1) is None
+    True
+    """
+    res = None
+    try:
+        with open(path) as calibration_f:
+            saved = json.load(calibration_f)
+        candidate = saved.get(device_name)
+        if isinstance(candidate, dict):
+            if time.time() - candidate["saved_at"] < max_age_h * 3600:
+                res = candidate
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # a missing or a broken file means: calibrate from scratch
+    return res
+
+
+def save_calibration(path, device_name, exported_state):
+    """Saves the calibration for the given device, keeping the calibrations of other devices.
+
+    Args:
+        path: str: the .json with the calibrations of all the devices
+        device_name: str: the name of the device, as reported by PyAudio
+        exported_state: dict: the output of NoiseFloorEstimator.export()
+    Returns:
+        None
+    """
+    try:
+        with open(path) as calibration_f:
+            saved = json.load(calibration_f)
+        if not isinstance(saved, dict):
+            saved = dict()
+    except (OSError, ValueError):
+        saved = dict()
+    saved[device_name] = exported_state
+
+    # write-then-rename, to never leave a half-written file after a crash
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as calibration_f:
+        json.dump(saved, calibration_f, indent=2)
+    os.replace(temp_path, path)
+
+
+def calibrate_for_device(estimator, device_name, config):
+    """Makes sure that the estimator tracks the given device, loading its saved calibration if possible.
+
+    Args:
+        estimator: NoiseFloorEstimator
+        device_name: str or None: the name of the device. None if the source is not a device
+        config: dict: the key is the setting name, the value is the setting value
+    Returns:
+        None
+    """
+    if device_name is None or device_name == estimator.device_name:
+        return
+
+    estimator.reset()
+    estimator.device_name = device_name
+    saved = load_calibration(
+        config["calibration_path"], device_name, config["calibration_max_age_h"]
+    )
+    if saved is not None:
+        estimator.seed(saved)
+        c_print("using the saved calibration for", device_name, saved)
+    else:
+        c_print(
+            "no usable saved calibration for", device_name, "Calibrating from scratch"
+        )
+
+
+noise_estimator = NoiseFloorEstimator(config_dic)
+
+
 def chunk_is_silent(data_chunk, percent_louder_than_background, dynamic_level=0.0):
     """Returns 'True' if below the 'silent' threshold
 
@@ -282,7 +557,11 @@ def safe_array_max(input_arr, default=0):
     """
     res = default
 
-    if isinstance(input_arr, type(array("h"))) or isinstance(input_arr, list):
+    if isinstance(input_arr, array) and input_arr.typecode != "u":
+        # the fast path: an array of numbers can't contain junk
+        if len(input_arr) > 0:
+            res = max(input_arr)
+    elif isinstance(input_arr, list):
         clean_list = []
         for element in input_arr:
             if isinstance(element, int) or isinstance(element, float):
@@ -293,13 +572,15 @@ def safe_array_max(input_arr, default=0):
     return res
 
 
-def trim(data_all, trimming_thresh, trimming_append):
+def trim(data_all, trimming_thresh, trimming_append, trim_left7=True, trim_right7=True):
     """Removes the left and the right of the data_all array according the given threshold, to reduce the file size
 
     Args:
         data_all: array: the data that must be trimmed
         trimming_thresh: int/float: the value must be higher than this to stay in the array
         trimming_append: int: how many elements to keep from the left and right, even if they don't pass the threshold
+        trim_left7: bool: optional: if False, the left side is kept as is (e.g. for a continuation segment)
+        trim_right7: bool: optional: if False, the right side is kept as is (e.g. for a segment that continues)
     Returns:
         res: array: same as data_all, but without the trimmed elements
 
@@ -313,6 +594,10 @@ def trim(data_all, trimming_thresh, trimming_append):
     array('h', [1, 5, 9, 2])
     >>> trim(test_data0,trimming_thresh=4, trimming_append=5)
     array('h', [1, 4, 1, 5, 9, 2])
+    >>> trim(test_data0,trimming_thresh=4, trimming_append=0, trim_left7=False)
+    array('h', [1, 4, 1, 5, 9])
+    >>> trim(test_data0,trimming_thresh=4, trimming_append=0, trim_right7=False)
+    array('h', [5, 9, 2])
     """
     res = array("h")
 
@@ -321,17 +606,19 @@ def trim(data_all, trimming_thresh, trimming_append):
 
             _from = 0
             _to = len(data_all) - 1
-            for i, b in enumerate(data_all):
-                if abs(b) > trimming_thresh:
-                    _from = int(max(0, i - trimming_append))
-                    break
-
-            for i, b in enumerate(reversed(data_all)):
-                if abs(b) > trimming_thresh:
-                    candidate_a = len(data_all) - 1
-                    candidate_b = len(data_all) - 1 - i + trimming_append
-                    _to = int(min(candidate_a, candidate_b))
-                    break
+            if trim_left7:
+                for i, b in enumerate(data_all):
+                    if abs(b) > trimming_thresh:
+                        _from = int(max(0, i - trimming_append))
+                        break
+
+            if trim_right7:
+                for i, b in enumerate(reversed(data_all)):
+                    if abs(b) > trimming_thresh:
+                        candidate_a = len(data_all) - 1
+                        candidate_b = len(data_all) - 1 - i + trimming_append
+                        _to = int(min(candidate_a, candidate_b))
+                        break
 
             res = data_all[_from : (_to + 1)]
 
@@ -413,8 +700,7 @@ def top3avg(input_list):
     3
     """
     if len(input_list) > 2:
-        temp = sorted(input_list, reverse=True)
-        res = (temp[0] + temp[1] + temp[2]) / 3
+        res = sum(heapq.nlargest(3, input_list)) / 3
     else:
         res = safe_array_max(input_list, default=0)
     return res
@@ -451,7 +737,7 @@ def console_indicator(data_chunk, dynamic_level, chunks_counter, silent_chunks,
     Args:
         data_chunk: array of ints: raw audio data
         dynamic_level: float: background noise level
-        chunks_counter: int: the current index of the chunk. Determines when to recalibrate, and when to cut recording
+        chunks_counter: int: how many chunks the background noise estimator has seen
         silent_chunks: int: how many consecutive chunks are silent. Determines when to cut recording
         config: dict: the key is the setting name, the value is the setting value
     Returns:
@@ -463,8 +749,8 @@ def console_indicator(data_chunk, dynamic_level, chunks_counter, silent_chunks,
     >>> test_config = read_config()
     >>> console_indicator(test_chunk, dynamic_level=100, chunks_counter=42, silent_chunks=3, config=test_config)
     ############300. silent chunks: 3 of 10
-    >>> console_indicator(test_chunk, dynamic_level=0, chunks_counter=42, silent_chunks=3, config=test_config)
-    ################400. uncalibrated. Counter: 42 of 100. silent chunks: 3 of 10
+    >>> console_indicator(test_chunk, dynamic_level=0, chunks_counter=4, silent_chunks=3, config=test_config)
+    ################400. uncalibrated. Counter: 4 of 10. silent chunks: 3 of 10
     """
     vol = int(top3avg(data_chunk)) - dynamic_level
 
@@ -475,7 +761,7 @@ def console_indicator(data_chunk, dynamic_level, chunks_counter, silent_chunks,
             ". uncalibrated. Counter: "
             + str(chunks_counter)
             + " of "
-            + str(config["calibrate_num"])
+            + str(config["calibrate_warmup_num"])
         )
     silent_str = (
         ". silent chunks: " + str(silent_chunks) + " of " + str(config["silent_num"])
@@ -484,12 +770,13 @@ def console_indicator(data_chunk, dynamic_level, chunks_counter, silent_chunks,
     c_print(res)
 
 
-def create_filename(dir_path, custom_datetime=None):
+def create_filename(dir_path, custom_datetime=None, device_label=""):
     """Returns the full path where the script should save the .wav . The filename contains a timestamp.
 
     Args:
         dir_path: str: the dir where the file should be saved
         custom_datetime: datetime obj: optional: if stated, this datetime will be used instead of the current one
+        device_label: str: optional: added after "mic", to tell apart the devices in the multi-device mode
     Returns:
          full_path: str: the full path to the future .wav
 
@@ -499,14 +786,63 @@ def create_filename(dir_path, custom_datetime=None):
     True
     >>> res0.endswith('mic.wav')
     True
+    >>> create_filename("/some/dir/path/", custom_datetime=dt, device_label="_USBPnP").endswith('mic_USBPnP.wav')
+    True
     """
-    filename = filename_timestamp(custom_datetime=custom_datetime) + "mic.wav"
+    filename = (
+        filename_timestamp(custom_datetime=custom_datetime)
+        + "mic"
+        + device_label
+        + ".wav"
+    )
     full_path = os.path.join(dir_path, filename)
     return full_path
 
 
-def get_device_id_and_rate(config, pyaudio_obj, trusted_hardware7, prints7=True):
+def create_segment_filename(
+    dir_path, session_id, part_index, custom_datetime=None, device_label=""
+):
+    """Returns the full path for a segment of a long recording that was split into several files.
+
+    All the segments of the same recording share the session_id. The part index is the continuation marker:
+    part 0 is the start of the recording, part N continues part N-1 without a gap.
+    Sorting the segments of a session by the part index restores the whole recording.
+
+    Args:
+        dir_path: str: the dir where the file should be saved
+        session_id: str: the same for all the segments of the recording, e.g. the timestamp of its first segment
+        part_index: int: 0 for the first segment, 1 for the next one etc
+        custom_datetime: datetime obj: optional: if stated, this datetime will be used instead of the current one
+        device_label: str: optional: see create_filename()
+    Returns:
+         full_path: str: the full path to the future .wav
+
+    >>> dt = datetime.datetime(year=2021, month=4, day=4, hour=12, minute=44, second=50)
+    >>> res0 = create_segment_filename("/some/dir/path/", "202104041244000000", 3, custom_datetime=dt)
+    >>> res0
+    '/some/dir/path/202104041244500000mic_session202104041244000000_part0003.wav'
     """
+    filename = (
+        filename_timestamp(custom_datetime=custom_datetime)
+        + "mic"
+        + device_label
+        + "_session"
+        + str(session_id)
+        + "_part"
+        + str(part_index).zfill(4)
+        + ".wav"
+    )
+    full_path = os.path.join(dir_path, filename)
+    return full_path
+
+
+def get_device_id_and_rate(config, pyaudio_obj, trusted_hardware7, prints7=True):
+    """Returns the id and the rate of the input device to use. Returns None as the id if there is no such device.
+
+    The device is the first input device with sound_dev_part (from the config) in its name.
+    But if config["device_index"] is set (see run_multi_device), it's this very device.
+    The report contains all the input devices that match sound_dev_part or any of sound_dev_parts.
+
     TODO: split this func into manageable chunks
 
     >>> set_c_print_switch(False)
@@ -525,6 +861,12 @@ def get_device_id_and_rate(config, pyaudio_obj, trusted_hardware7, prints7=True)
     ...     device_id, dev_rate, rep = get_device_id_and_rate(config0, pyaudio_obj0, trusted_hardware7=True)
     >>> isinstance(device_id, int)
     True
+    >>> config0["device_index"] = device_id
+    >>> with sound_handler():
+    ...     pyaudio_obj0 = pyaudio.PyAudio()
+    ...     device_id1, dev_rate, rep = get_device_id_and_rate(config0, pyaudio_obj0, trusted_hardware7=True)
+    >>> device_id1 == device_id, device_id in [dev["id"] for dev in rep["get_device_id_and_rate"]["matching_devices"]]
+    (True, True)
 
     """
     report = dict()
@@ -576,9 +918,25 @@ def get_device_id_and_rate(config, pyaudio_obj, trusted_hardware7, prints7=True)
             "Using the trusted hardware mode. Ignoring the absence of the indicator"
         )
 
+    name_parts = [config["sound_dev_part"]] + config["sound_dev_parts"]
+    report["matching_devices"] = []
     if indicator_connected7:
         for j in range(len(good_devices_names)):
-            if config["sound_dev_part"] in good_devices_names[j]:
+            if any(part in good_devices_names[j] for part in name_parts):
+                report["matching_devices"].append(
+                    {
+                        "id": good_dev_indexes[j],
+                        "name": good_devices_names[j],
+                        "rate": int(good_sample_rates[j]),
+                    }
+                )
+
+        for j in range(len(good_devices_names)):
+            if config["device_index"] is not None:
+                matched7 = good_dev_indexes[j] == config["device_index"]
+            else:
+                matched7 = config["sound_dev_part"] in good_devices_names[j]
+            if matched7:
                 target_device_id = good_dev_indexes[j]
                 c_print(
                     "using this device:",
@@ -600,8 +958,11 @@ def get_device_id_and_rate(config, pyaudio_obj, trusted_hardware7, prints7=True)
     )
 
 
-def open_stream_from_scratch(config, trusted_hardware7):
-    """
+def open_stream_from_scratch(config, trusted_hardware7, report=None):
+    """Opens the input stream of the device selected by the config.
+
+    If report is a dict, the id and the name of the used device are added to it.
+
     >>> set_c_print_switch(False)
     >>> config0 = read_config()
     >>> stream0, pyaudio_obj0 = open_stream_from_scratch(config0, trusted_hardware7=True)
@@ -630,6 +991,14 @@ def open_stream_from_scratch(config, trusted_hardware7):
             frames_per_buffer=config["chunk_size"],
             input_device_index=target_device_id,
         )
+
+        if isinstance(report, dict):
+            if target_device_id is None:  # PyAudio used the default device
+                device_info = pyaudio_obj.get_default_input_device_info()
+            else:
+                device_info = pyaudio_obj.get_device_info_by_index(target_device_id)
+            report["device_id"] = device_info.get("index")
+            report["device_name"] = device_info.get("name")
     return stream, pyaudio_obj
 
 
@@ -662,7 +1031,6 @@ def close_stream_and_pyaudio_obj(stream, pyaudio_obj):
     if hasattr(pyaudio_obj, "terminate"):
         pyaudio_obj.terminate()
         report["pyaudio_obj_terminate_success7"] = True
-    gc.collect()
 
     return {"close_stream_and_pyaudio_obj": report}
 
@@ -694,6 +1062,205 @@ def get_data_chunk(stream, config, custom_byteorder=None):
     return data_chunk
 
 
+class PyAudioSource:
+    """Reads the chunks from the live input device selected by the config. The default source.
+
+    All the sources have the same interface: open(), read_chunk(), reopen(), close(), plus the fields
+    sample_width, device_name, chunks_read and exhausted7. read_chunk() raises EOFError if there is no more data.
+    device_name is None for the sources that are not devices.
+
+    >>> set_c_print_switch(False)
+    >>> source0 = PyAudioSource(read_config(), trusted_hardware7=True)
+    >>> source0.open()
+    >>> len(source0.read_chunk()) > 0, source0.chunks_read, source0.sample_width
+    (True, 1, 2)
+    >>> _ = source0.close()
+    """
+
+    def __init__(self, config, trusted_hardware7=False):
+        self.config = config
+        self.trusted_hardware7 = trusted_hardware7
+        self.stream = None
+        self.pyaudio_obj = None
+        self.sample_width = None
+        self.device_name = None
+        self.chunks_read = 0
+        self.exhausted7 = False
+
+    def open(self):
+        stream_report = dict()
+        self.stream, self.pyaudio_obj = open_stream_from_scratch(
+            self.config, trusted_hardware7=self.trusted_hardware7, report=stream_report
+        )
+        self.sample_width = self.pyaudio_obj.get_sample_size(
+            self.config["sampling_format"]
+        )
+        self.device_name = stream_report["device_name"]
+
+    def read_chunk(self):
+        data_chunk = get_data_chunk(self.stream, self.config)
+        self.chunks_read += 1
+        return data_chunk
+
+    def reopen(self):
+        """Recreates the stream from scratch. Could help if the device was reconnected etc"""
+        report = self.close()
+        self.open()
+        return report
+
+    def close(self):
+        return close_stream_and_pyaudio_obj(self.stream, self.pyaudio_obj)
+
+
+class ChunkListSource:
+    """Replays the given list of chunks, e.g. the output of get_mock_chunks(). Doesn't need any audio hardware.
+
+    >>> source0 = ChunkListSource(get_mock_chunks(list_len=2, chunk_len=3))
+    >>> source0.open()
+    >>> source0.read_chunk()
+    array('h', [-154, 109, 195])
+    >>> _ = source0.read_chunk()
+    >>> try:
+    ...     source0.read_chunk()
+    ... except EOFError:
+    ...     source0.exhausted7
+    True
+    """
+
+    def __init__(self, chunks, sample_width=2):
+        self.chunks = chunks
+        self.sample_width = sample_width
+        self.device_name = None
+        self.chunks_read = 0
+        self.exhausted7 = False
+
+    def open(self):
+        pass
+
+    def read_chunk(self):
+        if self.chunks_read >= len(self.chunks):
+            self.exhausted7 = True
+            raise EOFError("no more chunks to replay")
+        data_chunk = self.chunks[self.chunks_read]
+        self.chunks_read += 1
+        return data_chunk
+
+    def reopen(self):
+        """Does nothing: unlike a device, the list continues from the same position"""
+        return {"reopen": "nothing to reopen in ChunkListSource"}
+
+    def close(self):
+        return {"close": "nothing to close in ChunkListSource"}
+
+
+class WavFileSource:
+    """Replays a 16-bit .wav file chunk by chunk, as fast as the pipeline can consume it.
+
+    Useful for the offline benchmarks and for tuning the filter settings on recorded corpora.
+    See mic_benchmark.py for details.
+    """
+
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.wave_file = None
+        self.sample_width = 2
+        self.device_name = None
+        self.channels = None
+        self.frame_rate = None
+        self.chunks_read = 0
+        self.exhausted7 = False
+
+    def open(self):
+        if self.wave_file is None:
+            self.wave_file = wave.open(self.path, "rb")
+            if self.wave_file.getsampwidth() != self.sample_width:
+                raise ValueError(
+                    "only 16-bit .wav files are supported, got this one: " + self.path
+                )
+            self.channels = self.wave_file.getnchannels()
+            self.frame_rate = self.wave_file.getframerate()
+
+    def read_chunk(self):
+        frames = self.wave_file.readframes(self.chunk_size)
+        if len(frames) == 0:
+            self.exhausted7 = True
+            raise EOFError("the end of " + self.path)
+
+        # .wav stores little endian, signed short
+        data_chunk = array("h", frames)
+        if byteorder == "big":
+            data_chunk.byteswap()
+        self.chunks_read += 1
+        return data_chunk
+
+    def reopen(self):
+        """Does nothing: unlike a device, the file continues from the same position"""
+        return {"reopen": "nothing to reopen in WavFileSource"}
+
+    def close(self):
+        """Does nothing, as the same file is read by several recording cycles. See release()"""
+        return {"close": "WavFileSource is kept open until release()"}
+
+    def release(self):
+        if self.wave_file is not None:
+            self.wave_file.close()
+            self.wave_file = None
+
+
+class SampleBuffer:
+    """A preallocated buffer for the recorded samples, reused by all the recordings.
+
+    The chunks are copied into the same memory, instead of growing a new array for each recording.
+    This keeps the memory flat in the long run without forced garbage collections,
+    which would pause the audio reading and could cause buffer overruns.
+    The buffer grows only if a recording is longer than all the previous ones.
+
+    >>> buffer0 = SampleBuffer()
+    >>> buffer0.reserve(4)
+    >>> buffer0.extend(array("h", [3, 1, 4]))
+    >>> buffer0.extend(array("h", [1, 5]))
+    >>> len(buffer0), buffer0.capacity(), buffer0.snapshot()
+    (5, 8, array('h', [3, 1, 4, 1, 5]))
+    >>> buffer0.clear()
+    >>> buffer0.extend(array("h", [9]))
+    >>> len(buffer0), buffer0.capacity(), buffer0.snapshot()
+    (1, 8, array('h', [9]))
+    """
+
+    def __init__(self):
+        self.data = array("h")
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def capacity(self):
+        return len(self.data)
+
+    def reserve(self, capacity):
+        """Makes sure the buffer can hold the given number of samples without growing"""
+        if capacity > len(self.data):
+            self.data.extend(array("h", bytes(2 * (capacity - len(self.data)))))
+
+    def extend(self, chunk):
+        end = self.length + len(chunk)
+        if end > len(self.data):
+            self.reserve(max(end, 2 * len(self.data)))
+        self.data[self.length : end] = chunk
+        self.length = end
+
+    def clear(self):
+        self.length = 0
+
+    def snapshot(self):
+        """Returns a copy of the recorded samples, to hand it over while the buffer is reused"""
+        return self.data[: self.length]
+
+
+sample_buffer = SampleBuffer()
+
+
 def deterministic_random(iterations):
     """
     Returns a pseudo-random number x, such as 0 < x < 1.
@@ -780,6 +1347,7 @@ def get_mock_config(test_len):
 
     # to make it finish calibrating before max_cycles
     res["calibrate_num"] = round(test_len / 3)
+    res["calibrate_warmup_num"] = round(test_len / 5)
 
     # to generate breathing data before max_cycles
     res["breath_min_data"] = round(test_len / 2)
@@ -787,6 +1355,7 @@ def get_mock_config(test_len):
     res["chunk_break_num"] = round(test_len / 1.5)
     res["min_relative_l"] = 5  # setting it low to make useful sounds appear more often
     res["consecutive_num"] = 2
+    res["use_catalog"] = False  # to not add the mock files to the real catalog
 
     return res
 
@@ -797,8 +1366,20 @@ def recording_cycle(
     max_cycles=-1,
     saving_path="breathing.txt",
     mock_chunks=None,
+    on_segment=None,
+    source=None,
 ):
-    """
+    """Reads the chunks until a useful sound is recorded, and returns it.
+
+    The chunks are read from the source (see PyAudioSource for the interface). By default, it's the live device.
+    If mock_chunks is a list, they are replayed instead, without touching any audio hardware.
+    If the source runs out of data, the cycle ends with whatever was read so far.
+
+    If on_segment is a callable, a recording that reaches chunk_break_num is not stopped.
+    Instead, the recorded data is handed to on_segment(data, sample_width) as a finished segment,
+    and the recording continues into a new buffer from the next chunk, without reopening the stream.
+    This keeps the memory bounded without splitting long speeches with gaps.
+
     TODO: sanitize data_chunk: it should contain only correct data (ints?)
     TODO: add tests where data_chunk is partially corrupted (e.g. contains non-floats and non-integers)
 
@@ -826,6 +1407,28 @@ def recording_cycle(
     >>> dat, wid, rep = recording_cycle(config0, trusted_hardware7=True, max_cycles=test_len, saving_path=pth, mock_chunks=ch3)
     >>> len(dat) > 0, wid > 0
     (True, True)
+    >>> config1 = get_mock_config(test_len)
+    >>> config1["chunk_break_num"] = 6
+    >>> config1["silent_num"] = 100  # to make it record until the mock chunks run out
+    >>> ch4 = get_mock_chunks(list_len=test_len*2, chunk_len=30, bias=0.5, initial_silent_chunks_num=config1["calibrate_num"])
+    >>> segments = []
+    >>> noise_estimator.reset()
+    >>> dat, wid, rep = recording_cycle(config1, True, mock_chunks=ch4, on_segment=lambda d, w: segments.append(d))
+    >>> len(segments) > 1, rep["recording_cycle"]["segments_num"] == len(segments)
+    (True, True)
+    >>> all(len(seg) <= (config1["chunk_break_num"] + 1) * 30 for seg in segments)
+    True
+    >>> source0 = ChunkListSource(ch4)
+    >>> dat, wid, rep = recording_cycle(config1, source=source0, on_segment=lambda d, w: None)
+    >>> source0.exhausted7, rep["recording_cycle"]["source_exhausted7"]
+    (True, True)
+    >>> span = rep["recording_cycle"]["detected_span"]
+    >>> 0 < span[0] < span[1] < len(ch4)
+    True
+    >>> silent0 = ChunkListSource(get_mock_chunks(list_len=test_len, chunk_len=30, bias=0.0, initial_silent_chunks_num=test_len))
+    >>> dat, wid, rep = recording_cycle(config1, source=silent0)
+    >>> len(dat), rep["recording_cycle"]["detected_span"]
+    (0, None)
 
     """
     report = dict()
@@ -836,61 +1439,95 @@ def recording_cycle(
     audio_started = False
     end_circle7 = False
 
-    data_all = array("h")
-    chunks_for_bg = []
+    # reserving the max recording length, to never grow the buffer in the middle of a recording:
+    sample_buffer.reserve((config["chunk_break_num"] + 2) * config["chunk_size"])
+    sample_buffer.clear()
 
     global dyn_level
     global start_time
     if start_time is None:
         start_time = time.time()
+    noise_estimator.configure(config)
 
-    stream, pyaudio_obj = open_stream_from_scratch(
-        config, trusted_hardware7=trusted_hardware7
-    )
+    if source is None:
+        if isinstance(mock_chunks, list):
+            source = ChunkListSource(mock_chunks)
+        else:
+            source = PyAudioSource(config, trusted_hardware7=trusted_hardware7)
+
+    source.open()
+    sample_width = source.sample_width
+    calibrate_for_device(noise_estimator, source.device_name, config)
+    report["segments_num"] = 0
+    report["source_exhausted7"] = False
+    # the indexes of the first and the last recorded chunks in the source:
+    report["detected_span"] = None
 
     cycles_counter = 0
     while True:
-        data_chunk = get_data_chunk(stream, config)
-
-        if isinstance(mock_chunks, list):
-            del data_chunk
-            data_chunk = mock_chunks[cycles_counter]
-
-        if chunks_counter > 0 and chunks_counter % config["calibrate_num"] == 0:
+        try:
+            data_chunk = source.read_chunk()
+        except EOFError:
+            c_print("the source is exhausted. Ending the circle")
+            report["source_exhausted7"] = True
+            # without a started recording, the buffer holds only the silence before it
+            data_all = sample_buffer.snapshot() if audio_started else array("h")
+            break
 
-            # TODO: ensure it will not crash if chunks_for_bg contains junk
-            dyn_level = statistics.median(chunks_for_bg)
-            c_print("new background noise level:", dyn_level)
+        noise_estimator.update(safe_array_max(data_chunk, default=0))
+        dyn_level = noise_estimator.level()
+        if noise_estimator.count % config["calibrate_num"] == 0:
+            c_print("background noise estimator:", noise_estimator.state())
+            if source.device_name is not None:
+                save_calibration(
+                    config["calibration_path"],
+                    source.device_name,
+                    noise_estimator.export(),
+                )
             c_print(
-                "new absolute threshold above the level:",
+                "absolute threshold above the level:",
                 get_absolute_threshold(dyn_level, config["min_relative_l"]),
             )
-            chunks_for_bg = []
-
-        else:
-            chunks_for_bg.append(safe_array_max(data_chunk, default=0))
 
         chunks_counter += 1
 
-        console_indicator(data_chunk, dyn_level, chunks_counter, silent_chunks, config)
+        console_indicator(
+            data_chunk, dyn_level, noise_estimator.count, silent_chunks, config
+        )
 
         if audio_started:
             c_print("recording is ongoing")
 
         if chunks_counter > config["chunk_break_num"]:
 
-            report["closing"] = close_stream_and_pyaudio_obj(stream, pyaudio_obj)
-            c_print(report)
-
             if not audio_started:
-                del data_all
-                data_all = array("h")
+                report["closing"] = source.reopen()
+                c_print(report)
+
+                sample_buffer.clear()
                 chunks_counter = 0
-                gc.collect()
 
-                stream, pyaudio_obj = open_stream_from_scratch(
-                    config, trusted_hardware7=trusted_hardware7
+            elif callable(on_segment):
+                # the stream stays open, so the next chunk continues the recording without a gap
+                segment = sample_buffer.snapshot()
+                loud_percentage = percentage_of_elements_higher_than_value(
+                    segment, config["max_relative_l"]
                 )
+                if loud_percentage < 20:
+                    c_print(
+                        "chunks_counter > MAX_CHUNKS_BEFORE_BREAK. Continuing in a new segment"
+                    )
+                    on_segment(segment, sample_width)
+                    report["segments_num"] += 1
+                else:
+                    c_print(
+                        "Pathological segment. Discarding it and ending the recording"
+                    )
+                    audio_started = False
+                    silent_chunks = 0
+                    report["detected_span"] = None
+                sample_buffer.clear()
+                chunks_counter = 0
 
             else:
                 c_print(
@@ -898,7 +1535,7 @@ def recording_cycle(
                 )
                 end_circle7 = True
 
-        data_all.extend(data_chunk)
+        sample_buffer.extend(data_chunk)
 
         useful_sound7 = False
         chunk_silent7 = chunk_is_silent(
@@ -914,6 +1551,7 @@ def recording_cycle(
             consecutive_loud_num = 0
 
         if audio_started:
+            report["detected_span"][1] = source.chunks_read - 1
             if chunk_silent7:
                 silent_chunks += 1
                 if silent_chunks > config["silent_num"]:
@@ -927,12 +1565,14 @@ def recording_cycle(
             audio_started = True
             c_print("useful sound detected, starting recording")
             report["cycles_counter when recorded started"] = cycles_counter
+            report["detected_span"] = [source.chunks_read - 1, source.chunks_read - 1]
 
         if max_cycles > 0:
             if cycles_counter > max_cycles:
                 end_circle7 = True
 
         if end_circle7:
+            data_all = sample_buffer.snapshot()
             loud_percentage = percentage_of_elements_higher_than_value(
                 data_all, config["max_relative_l"]
             )
@@ -944,35 +1584,25 @@ def recording_cycle(
                 good_data7 = False
 
             if good_data7:
-
-                sample_width = pyaudio_obj.get_sample_size(config["sampling_format"])
-
-                report["closing"] = close_stream_and_pyaudio_obj(stream, pyaudio_obj)
-                c_print(report)
-
                 break
             else:
                 # Happens when the data is bad (e.g.constant loud noise)
                 # Discarding it.
+                report["closing"] = source.reopen()
+                c_print(report)
+
                 chunks_counter = 0
                 audio_started = False
                 end_circle7 = False
-                del data_all
-                data_all = array("h")
+                report["detected_span"] = None
+                sample_buffer.clear()
                 c_print("Pathological data. Discarding it")
-                gc.collect()
-
-                stream, pyaudio_obj = open_stream_from_scratch(
-                    config, trusted_hardware7=trusted_hardware7
-                )
 
         cycles_counter += 1
 
-    report["closing"] = close_stream_and_pyaudio_obj(stream, pyaudio_obj)
+    report["closing"] = source.close()
     c_print(report)
 
-    gc.collect()
-
     return data_all, sample_width, {"recording_cycle": report}
 
 
@@ -983,10 +1613,20 @@ def record_sound(
     mock_device_id=None,
     saving_path="breathing.txt",
     sleep_time_sec=10,
+    on_segment=None,
+    source=None,
+    report=None,
 ):
     """Record sound from the microphone and
     return the data as an array of signed shorts.
 
+    If the source (see recording_cycle) or mock_chunks are given, no audio device is required.
+    If report is a dict, the report of recording_cycle() is added to it.
+
+    If on_segment is a callable, the long recordings are delivered in segments, see recording_cycle().
+    The segments are trimmed only at the outer edges of the whole recording, to keep them seamless.
+    The returned data is the last segment then.
+
     >>> set_c_print_switch(False)
     >>> test_len = 15
     >>> config0 = get_mock_config(test_len)
@@ -1001,12 +1641,17 @@ def record_sound(
     (0, [])
     """
 
-    with sound_handler():
-        initial_pyaudio_obj = pyaudio.PyAudio()
-        target_device_id, device_rate, _ = get_device_id_and_rate(
-            config, initial_pyaudio_obj, trusted_hardware7
-        )
-        initial_pyaudio_obj.terminate()
+    if source is None and mock_chunks is None:
+        with sound_handler():
+            initial_pyaudio_obj = pyaudio.PyAudio()
+            target_device_id, device_rate, _ = get_device_id_and_rate(
+                config, initial_pyaudio_obj, trusted_hardware7
+            )
+            initial_pyaudio_obj.terminate()
+    else:
+        # the offline sources don't need a device
+        target_device_id = offline_device_id
+        device_rate = config["frame_rate"]
 
     if mock_device_id is not None:
         target_device_id = mock_device_id
@@ -1015,19 +1660,40 @@ def record_sound(
 
         c_print("device_rate", device_rate)
 
+        segments_counter = [0]
+
+        def on_cycle_segment(segment, segment_sample_width):
+            trimmed_segment = trim(
+                segment,
+                config["trim_level"],
+                config["trim_append"],
+                trim_left7=segments_counter[0] == 0,
+                trim_right7=False,
+            )
+            on_segment(trimmed_segment, segment_sample_width)
+            segments_counter[0] += 1
+
         data_all, sample_width, rep = recording_cycle(
             config,
             trusted_hardware7=trusted_hardware7,
             mock_chunks=mock_chunks,
             saving_path=saving_path,
+            on_segment=on_cycle_segment if callable(on_segment) else None,
+            source=source,
         )
         c_print("len(data_all) as the output of recording_cycle", len(data_all))
+        if isinstance(report, dict):
+            report.update(rep)
 
         # we trim before normalize as threshold applies to un-normalized wave (as well as is_silent() function)
-        data_all_trimmed = trim(data_all, config["trim_level"], config["trim_append"])
+        data_all_trimmed = trim(
+            data_all,
+            config["trim_level"],
+            config["trim_append"],
+            trim_left7=segments_counter[0] == 0,
+        )
         data_all_normalized = data_all_trimmed
         c_print("finished recording")
-        del data_all
     else:
         indicator_device_name_part = config["indicator_part"]
         use_this_device_name_part = config["sound_dev_part"]
@@ -1039,10 +1705,63 @@ def record_sound(
         data_all_normalized = []
         sample_width = 0
 
-    gc.collect()
     return sample_width, data_all_normalized
 
 
+def write_wav(path, data, config, sample_width):
+    """Writes the given audio data to a .wav file.
+
+    Args:
+        path: str: where to write the file
+        data: array of ints: raw audio data
+        config: dict: the key is the setting name, the value is the setting value
+        sample_width: int: the sample size in bytes, e.g. 2
+    Returns:
+        None
+    """
+    if not isinstance(data, array):
+        data = array("h", data)
+
+    # .wav stores little endian. The array is written as is (without a copy), if the machine is little endian too
+    if byteorder == "big":
+        data = array("h", data)
+        data.byteswap()
+
+    wave_file = wave.open(path, "wb")
+    wave_file.setnchannels(config["channels"])
+    wave_file.setsampwidth(sample_width)
+    wave_file.setframerate(config["frame_rate"])
+    wave_file.writeframes(data)
+    wave_file.close()
+
+
+def register_written_file(path, config):
+    """Records the checksum of the written file, and adds it to the capture catalog, as configured
+
+    See record_checksum() in utils.py for the checksums manifest.
+
+    >>> set_c_print_switch(False)
+    >>> dir_path0 = get_this_script_dir() + "/resources/mock_output_dir/"
+    >>> os.makedirs(dir_path0, exist_ok=True)
+    >>> config0 = get_mock_config(15)
+    >>> write_wav(dir_path0 + "1mic.wav", [1, 2, 3], config0, 2)
+    >>> register_written_file(dir_path0 + "1mic.wav", config0)
+    >>> manifest0 = dir_path0 + checksums_session_id + config0["device_label"] + ".wav.checksums"
+    >>> record0 = json.loads(open(manifest0).readlines()[-1])
+    >>> record0["name"], record0["size"], len(record0["sha256"])
+    ('1mic.wav', 50, 64)
+    """
+    record = None
+    if config["record_checksums"]:
+        record = record_checksum(path, checksums_session_id + config["device_label"])
+    if config["use_catalog"]:
+        register_file(path, record)
+
+
+# the checksums of all the files written by this process are recorded under this id
+checksums_session_id = filename_timestamp()
+
+
 def record_to_file(
     config,
     dir_path,
@@ -1051,9 +1770,15 @@ def record_to_file(
     breathing_saving_path="breathing.txt",
     mock_chunks=None,
     custom_datetime=None,
+    source=None,
 ):
     """Records from the microphone and outputs the resulting data to 'path'
 
+    A recording longer than chunk_break_num chunks is saved as several seamless segments.
+    See create_segment_filename() for how to stitch them back together.
+    dir_path can be a callable that returns the dir for the current moment. Then the segments of a long recording
+    follow the hour shards (see output_root in utils.py).
+
     >>> set_c_print_switch(False)
     >>> test_len = 15
     >>> config0 = get_mock_config(test_len)
@@ -1064,22 +1789,66 @@ def record_to_file(
     >>> res0 = record_to_file(config0, dir_path=dir_path0, trusted_hardware7=True, discard_wav7=False, breathing_saving_path=pth, mock_chunks=ch0, custom_datetime=dt0)
     >>> "logger_mic wrote the result" in str(res0)
     True
-    >>> res0["record_to_file"]["data_len"]
-    330
+    >>> res0["record_to_file"]["data_len"]  # the last segment
+    270
+    >>> res0["record_to_file"]["segments_num"]
+    3
     >>> res1 = record_to_file(config0, dir_path=dir_path0, trusted_hardware7=True, discard_wav7=True, breathing_saving_path=pth, mock_chunks=ch0, custom_datetime=dt0)
     >>> "not saving" in str(res1)
     True
+    >>> config1 = get_mock_config(test_len)
+    >>> config1["chunk_break_num"] = 6
+    >>> config1["silent_num"] = 100  # to make it record until the mock chunks run out
+    >>> ch1 = get_mock_chunks(list_len=test_len*2, chunk_len=30, bias=0.5, initial_silent_chunks_num=config1["calibrate_num"])
+    >>> noise_estimator.reset()
+    >>> res2 = record_to_file(config1, dir_path=dir_path0, trusted_hardware7=True, breathing_saving_path=pth, mock_chunks=ch1, custom_datetime=dt0)
+    >>> res2["record_to_file"]["segments_num"] > 1
+    True
+    >>> "_part0000.wav" in res2["record_to_file"]["segment_paths"][0]
+    True
 
 
     """
 
     report = dict()
+    report["segment_paths"] = []
+    session = {"id": None, "parts": 0}
+
+    def current_dir():
+        return dir_path() if callable(dir_path) else dir_path
+
+    def segment_path():
+        """The path of the next part. The part counter is advanced by written_segment(), once the file is written"""
+        if session["id"] is None:
+            session["id"] = filename_timestamp(custom_datetime=custom_datetime)
+        return create_segment_filename(
+            current_dir(),
+            session["id"],
+            session["parts"],
+            custom_datetime=custom_datetime,
+            device_label=config["device_label"],
+        )
+
+    def written_segment(path):
+        session["parts"] += 1
+        report["segment_paths"].append(path)
+
+    def save_segment(segment, segment_sample_width):
+        if not discard_wav7 and len(segment) > 0:
+            path = segment_path()
+            write_wav(path, segment, config, segment_sample_width)
+            written_segment(path)
+            register_written_file(path, config)
+            print_and_log("logger_mic wrote a segment to " + str(path))
 
     sample_width, data = record_sound(
         config,
         trusted_hardware7=trusted_hardware7,
         saving_path=breathing_saving_path,
         mock_chunks=mock_chunks,
+        on_segment=save_segment,
+        source=source,
+        report=report,
     )
 
     report["data_len"] = len(data)
@@ -1087,32 +1856,30 @@ def record_to_file(
     if len(data) > 0:
 
         if not discard_wav7:
-            struct_format = "<" + ("h" * len(data))
-            data_bytes = struct.Struct(struct_format).pack(*data)
-
-            # TODO: move it to a separate func
-            path = create_filename(dir_path=dir_path, custom_datetime=custom_datetime)
-            wave_file = wave.open(path, "wb")
-            wave_file.setnchannels(config["channels"])
-            wave_file.setsampwidth(sample_width)
-            wave_file.setframerate(config["frame_rate"])
-            wave_file.writeframes(data_bytes)
-            wave_file.close()
+            # the last segment of a long recording
+            segment7 = session["parts"] > 0
+            if segment7:
+                path = segment_path()
+            else:
+                path = create_filename(
+                    dir_path=current_dir(),
+                    custom_datetime=custom_datetime,
+                    device_label=config["device_label"],
+                )
+            write_wav(path, data, config, sample_width)
+            if segment7:
+                written_segment(path)
+            register_written_file(path, config)
 
             write_msg = "logger_mic wrote the result to " + str(path)
             print_and_log(write_msg)
             report["main"] = write_msg
-
-            del data_bytes
-            del struct_format
-            struct._clearcache()  # noqa . Is required to avoid memory leaks
         else:
             not_saving = "not saving the audio file because discard_wav7==True"
             c_print(not_saving)
             report["main"] = not_saving
 
-        del data
-        gc.collect()
+    report["segments_num"] = len(report["segment_paths"])
 
     return {"record_to_file": report}
 
@@ -1184,6 +1951,9 @@ def run_everything(
     script_dir = get_this_script_dir()
     if isinstance(mock_dir_path, str):
         script_dir = mock_dir_path
+    else:
+        # the dir of the current hour, if the hour shards are enabled (see output_root in utils.py)
+        script_dir = lambda: get_output_dir("mic", get_this_script_dir())
 
     c_print("If you want to start a recording, say something; be silent to stop it")
     top_counter = cycles_max
@@ -1220,8 +1990,93 @@ def run_everything(
     return latest_report
 
 
+def device_label_from_name(device_name):
+    """Converts a device name into a short label that can be used in filenames.
+
+    >>> device_label_from_name("USB PnP Sound Device: Audio (hw:2,0)")
+    '_USB_PnP_Sound_Device_Aud'
+    """
+    allowed = [ch if ch.isalnum() else "_" for ch in device_name]
+    words = [w for w in "".join(allowed).split("_") if w != ""]
+    return "_" + "_".join(words)[:24]
+
+
+def get_device_configs(config, matching_devices):
+    """Returns a copy of the config for each of the matching devices, to run a capture process per device.
+
+    Each process writes to its own files (see create_filename) and keeps its own calibration,
+    but they all take the timestamps from the same wall clock.
+
+    >>> devs = [{"id": 3, "name": "USB PnP: Audio (hw:2,0)", "rate": 44100}, {"id": 7, "name": "pulse", "rate": 48000}]
+    >>> [(c["device_index"], c["device_label"], c["frame_rate"]) for c in get_device_configs(config_dic, devs)]
+    [(3, '_USB_PnP_Audio_hw_2_0', 44100), (7, '_pulse', 48000)]
+    >>> get_device_configs(config_dic, devs)[0]["calibration_path"]
+    'mic_calibration_USB_PnP_Audio_hw_2_0.json'
+    """
+    res = []
+    for device in matching_devices:
+        dev_config = dict(config)
+        dev_config["frame_rate"] = device["rate"]
+        # trim_append depends on the rate:
+        dev_config = add_calculated_config_keys(dev_config)
+        dev_config["device_index"] = device["id"]
+        dev_config["device_label"] = device_label_from_name(device["name"])
+
+        # a file per process, as concurrent rewrites of the same file would lose entries
+        root, ext = os.path.splitext(config["calibration_path"])
+        dev_config["calibration_path"] = root + dev_config["device_label"] + ext
+        res.append(dev_config)
+    return res
+
+
+def run_multi_device(config):
+    """Captures all the matching input devices at once (see sound_dev_parts in config.ini), a process per device.
+
+    The processes don't share anything, so a slow or stuck device can't block the others,
+    and the detection of each device runs on its own core.
+    If only one device matches, it's the same as run_everything().
+    """
+    args = parse_command_line_args()
+    with sound_handler():
+        pyaudio_obj = pyaudio.PyAudio()
+        _, _, report = get_device_id_and_rate(
+            config, pyaudio_obj, args.trusted_hardware7, prints7=False
+        )
+        pyaudio_obj.terminate()
+    matching_devices = report["get_device_id_and_rate"]["matching_devices"]
+
+    if len(matching_devices) < 2:
+        run_everything(config=config)
+        return
+
+    processes = []
+    # spawn, to give each process a fresh PortAudio state:
+    context = multiprocessing.get_context("spawn")
+    for dev_config in get_device_configs(config, matching_devices):
+        label = dev_config["device_label"]
+        print_and_log(
+            "logger_mic: starting the capture of device",
+            str(dev_config["device_index"]) + " " + label,
+        )
+        process = context.Process(
+            target=run_everything,
+            kwargs={
+                "config": dev_config,
+                "breathing_saving_path": "breathing" + label + ".txt",
+            },
+        )
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+
+
 if __name__ == "__main__":
-    run_everything(config=config_dic)
+    if config_dic["multi_device"]:
+        run_multi_device(config=config_dic)
+    else:
+        run_everything(config=config_dic)
 
 """
 Inspired by this code by OliverLengwinat:
@@ -3,7 +3,9 @@ import os
 import time
 from ctypes import *  # TODO: import only the necessary parts. Find by commenting this out
 
-from utils import human_timestamp
+from utils import human_timestamp, record_checksum, get_output_dir
+from utils import text_log_compression, CompressedLog, get_load_level, load_slowdowns
+from catalog import register_file
 
 """Records mouse movements as the coordinates of the cursor, with timestamps. 
 """
@@ -11,6 +13,9 @@ from utils import human_timestamp
 time_between_saves = 18.0  # how oft should it be saved in file, in seconds
 time_between_fetches = 0.01  # how of should the coordinates be fetched, in seconds
 
+# the checksums of this session's files are recorded under this id
+session_id = human_timestamp()
+
 
 # linux only!
 assert "linux" in sys.platform
@@ -40,8 +45,10 @@ def fetch_xy():
 
 
 def log(done, callback):
+    # under load (see governor.py), the position is fetched less often
+    fetch_interval = time_between_fetches * load_slowdowns[get_load_level()]
     while not done():
-        time.sleep(time_between_fetches)
+        time.sleep(fetch_interval)
         my_x, my_y = fetch_xy()
         callback(time.time(), my_x, my_y)
 
@@ -52,7 +59,7 @@ __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file
 
 def get_full_path_mouse():
     file_name = human_timestamp() + ".mousetxt"
-    full_path = os.path.join(__location__, file_name)
+    full_path = os.path.join(get_output_dir("mouse", __location__), file_name)
     return full_path
 
 
@@ -65,6 +72,11 @@ def record_moves(t, x, y):
     logArray.append(temp)
 
 
+# if the compression is on, the saves are appended to a compressed file, see text_log_compression in utils.py
+compressed_log = None
+if text_log_compression is not None:
+    compressed_log = CompressedLog(get_full_path_mouse, text_log_compression)
+
 while True:
     try:
         logArray = []
@@ -77,11 +89,17 @@ while True:
 
         log(done, record_moves)
 
-        with open(get_full_path_mouse(), "w") as myFile:
-            for s in logArray:
-                myFile.write(s)
-            myFile.flush()
-        myFile.close()
+        if compressed_log is not None:
+            mouse_path = compressed_log.write_block("".join(logArray))
+        else:
+            mouse_path = get_full_path_mouse()
+            with open(mouse_path, "w") as myFile:
+                for s in logArray:
+                    myFile.write(s)
+                myFile.flush()
+            myFile.close()
+        if mouse_path is not None:
+            register_file(mouse_path, record_checksum(mouse_path, session_id))
         Xlib.XCloseDisplay(display)
         print("Saved a logger_mouse file with this many entries:", len(logArray))
 
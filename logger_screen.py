@@ -1,10 +1,15 @@
+import ctypes as ct
+import hashlib
+import json
 import sys
 import os
 import time
 
 from gi.repository import Gdk, GdkPixbuf
 
-from utils import human_timestamp
+from utils import human_timestamp, record_checksum, get_output_dir, repeats_filetype
+from utils import triggers_filetype, get_load_level, load_slowdowns
+from catalog import register_file
 
 """
 Makes screenshots on regular intervals, and saves them. 
@@ -24,8 +29,34 @@ scale_factor_normal = 1  # 1 means no scaling. 2 - scaling down by a factor of 2
 scale_factor_in_low_speed = 2
 scale_factor_in_high_speed = 1
 
+# if true, each screenshot is saved as two jpegs with the same timestamp: a low resolution full frame
+# (e.g. 20210502112444123screen.jpeg), and a full resolution crop around the pointer
+# (e.g. 20210502112444123fovea_x560_y240_s4.jpeg: the crop's top left corner, and how much the full frame is scaled down).
+# The text the user is working with stays readable, for less bytes and encoding time than the full frame.
+# See dataset_reader.py to read them together
+foveated7 = False
+fovea_width = 800
+fovea_height = 600
+periphery_scale_factor = 4  # multiplied by scale_factor
+# much cheaper than HYPER, and good enough for the periphery
+periphery_interp = GdkPixbuf.InterpType.BILINEAR
+
+# if true, a mouse button press (including the wheel) or a key press causes an immediate screenshot,
+# as the screen state right before an action is what matters for cloning. Each such screenshot is tagged
+# with its event (e.g. "button1", "key38": an X keycode) in the session's triggers file, see triggers_filetype in utils.py.
+# The timer is then slowed down by timer_slowdown_when_triggered
+triggered_capture7 = False
+min_trigger_interval_sec = 0.5  # the events that come faster are not captured
+trigger_poll_sec = 0.01
+timer_slowdown_when_triggered = 4.0
+
 time_between_saves = 6.0  # how often should it be saved in file, in seconds. Always use the point (2.0 instead of 2 etc)
 
+# if true, a frame identical to the previously saved one is not saved as a new jpeg. Instead, a tiny repeat record
+# is appended to the session's repeats file (see repeats_filetype in utils.py). It saves a lot on idle or locked screens.
+# The first frame of each dir (e.g. of each hour shard) is always saved as a jpeg, so every dir is self-contained
+dedup_identical_frames7 = False
+
 dymanic_timing = True
 how_much_faster_in_high_speed = 8.0  # how much faster it will be on the high speed
 how_much_slower_in_low_speed = 8.0  # how much slower it will be on the slow speed
@@ -40,7 +71,14 @@ dynamic_time_between_saves = time_between_saves
 current_speed_mode = "normal"
 jpeg_quality = jpeg_quality_normal
 scale_factor = 1
+# the load level published by governor.py, from 0 (idle) to 3. The higher, the less the logger captures
+load_level = 0
 previous_differ_speed = 66.6
+last_saved_hash = None
+last_saved_path = None
+
+# the checksums of this session's files are recorded under this id
+session_id = human_timestamp()
 
 
 # linux only!
@@ -74,16 +112,50 @@ def image_difference(img1, img2):
     return percent_changed
 
 
+# created once and reused by all the captures
+root_window = None
+
+
+def get_time_between_saves():
+    """The current interval. Under load (see governor.py), no HIGH SPEED, and slowed down by the level"""
+    if load_level == 0:
+        return dynamic_time_between_saves
+    not_high_speed = max(dynamic_time_between_saves, time_between_saves)
+    return not_high_speed * load_slowdowns[load_level]
+
+
+def get_jpeg_quality():
+    """Under load, no more than the normal quality, and the low speed quality from the level 2"""
+    if load_level == 0:
+        return jpeg_quality
+    if load_level == 1:
+        return min(jpeg_quality, jpeg_quality_normal)
+    return min(jpeg_quality, jpeg_quality_in_low_speed)
+
+
+def get_scale_factor():
+    """Under load, from the level 2, at least the low speed scaling"""
+    if load_level >= 2:
+        return max(scale_factor, scale_factor_in_low_speed)
+    return scale_factor
+
+
 def fetch_screen():
-    w = Gdk.get_default_root_window()
+    global root_window
+    if root_window is None:
+        root_window = Gdk.get_default_root_window()
+    w = root_window
     sz = w.get_geometry()[2:4]
     pb = Gdk.pixbuf_get_from_window(w, 0, 0, sz[0], sz[1])
 
-    if scale_factor != 1:
+    current_scale_factor = get_scale_factor()
+    if current_scale_factor != 1 and not foveated7:
+        # HYPER is the best, but the most expensive
+        interp = GdkPixbuf.InterpType.HYPER if load_level == 0 else periphery_interp
         pb = pb.scale_simple(
-            int(sz[0] / scale_factor),
-            int(sz[1] / scale_factor),
-            GdkPixbuf.InterpType.HYPER,
+            int(sz[0] / current_scale_factor),
+            int(sz[1] / current_scale_factor),
+            interp,
         )
 
     if pb is not None:
@@ -93,11 +165,90 @@ def fetch_screen():
         raise ValueError("ERROR: unable to get the screenshot.")
 
 
+# the X connection to watch the input, opened once
+x11 = None
+x_display = None
+last_buttons_mask = 0
+last_keymap = bytes(32)
+last_trigger_time = 0.0
+
+
+def get_input_events():
+    """Returns the list of the buttons and keys pressed since the previous call, e.g. ["button1", "key38"]"""
+    global x11, x_display, last_buttons_mask, last_keymap
+    if x_display is None:
+        x11 = ct.CDLL("libX11.so.6")
+        # the pointers must not be truncated to int
+        x11.XOpenDisplay.restype = ct.c_void_p
+        x11.XDefaultRootWindow.restype = ct.c_ulong
+        display_pointer = x11.XOpenDisplay(None)
+        if not display_pointer:
+            raise ValueError("unable to open the X display to watch the input")
+        x_display = ct.c_void_p(display_pointer)
+
+    root_id, child_id = ct.c_ulong(), ct.c_ulong()
+    root_x, root_y, win_x, win_y = ct.c_int(), ct.c_int(), ct.c_int(), ct.c_int()
+    mask = ct.c_uint()
+    x11.XQueryPointer(
+        x_display,
+        ct.c_ulong(x11.XDefaultRootWindow(x_display)),
+        ct.byref(root_id),
+        ct.byref(child_id),
+        ct.byref(root_x),
+        ct.byref(root_y),
+        ct.byref(win_x),
+        ct.byref(win_y),
+        ct.byref(mask),
+    )
+    keymap = (ct.c_char * 32)()
+    x11.XQueryKeymap(x_display, keymap)
+    keymap = bytes(keymap)
+
+    res = []
+    # Button1Mask is 1 << 8, ..., Button5Mask is 1 << 12
+    for button in range(1, 6):
+        bit = 1 << (7 + button)
+        if mask.value & bit and not last_buttons_mask & bit:
+            res.append("button" + str(button))
+    for i in range(32):
+        pressed = keymap[i] & ~last_keymap[i]
+        for bit in range(8):
+            if pressed & (1 << bit):
+                res.append("key" + str(i * 8 + bit))
+    last_buttons_mask = mask.value
+    last_keymap = keymap
+    return res
+
+
+def wait_for_trigger(timeout_sec):
+    """Sleeps for timeout_sec, or until an input event. Returns the event, or None if the time is out"""
+    global last_trigger_time
+    end = time.time() + timeout_sec
+    while time.time() < end:
+        try:
+            events = get_input_events()
+        except Exception as e:
+            print("logger_screen can't watch the input:", str(e))
+            time.sleep(max(0, end - time.time()))
+            return None
+        if events and time.time() - last_trigger_time >= min_trigger_interval_sec:
+            last_trigger_time = time.time()
+            return events[0]
+        time.sleep(trigger_poll_sec)
+    return None
+
+
 def log(done, callback):
     while not done():
-        time.sleep(dynamic_time_between_saves)
+        if triggered_capture7:
+            event = wait_for_trigger(
+                get_time_between_saves() * timer_slowdown_when_triggered
+            )
+        else:
+            time.sleep(get_time_between_saves())
+            event = None
         myscreen = fetch_screen()
-        callback(myscreen)
+        callback(myscreen, event)
 
 
 imgStack = []
@@ -108,13 +259,106 @@ __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file
 
 def get_full_path_screen():
     file_name = human_timestamp() + "screen.jpeg"
-    full_path = os.path.join(__location__, file_name)
+    full_path = os.path.join(get_output_dir("screen", __location__), file_name)
     return full_path
 
 
+def get_pointer_position():
+    """Returns (x, y) of the pointer on the screen, or None if unknown"""
+    try:
+        pointer = Gdk.Display.get_default().get_default_seat().get_pointer()
+        _, pointer_x, pointer_y = pointer.get_position()
+    except Exception as e:
+        print("unable to get the pointer position:", str(e))
+        return None
+    return pointer_x, pointer_y
+
+
+def get_fovea_box(width, height, pointer_xy):
+    """Returns (x, y, width, height) of the crop centered on the pointer, but not going beyond the frame"""
+    crop_width = min(fovea_width, width)
+    crop_height = min(fovea_height, height)
+    center_x, center_y = pointer_xy or (width // 2, height // 2)
+    crop_x = min(max(center_x - crop_width // 2, 0), width - crop_width)
+    crop_y = min(max(center_y - crop_height // 2, 0), height - crop_height)
+    return crop_x, crop_y, crop_width, crop_height
+
+
+def save_foveated(img, screen_path, pointer_xy):
+    """Saves the low resolution full frame to screen_path, and the full resolution crop next to it.
+
+    Returns:
+        paths: list of str: the saved files
+    """
+    periphery_scale = periphery_scale_factor * get_scale_factor()
+    periphery = img.scale_simple(
+        max(1, int(img.get_width() / periphery_scale)),
+        max(1, int(img.get_height() / periphery_scale)),
+        periphery_interp,
+    )
+    periphery.savev(screen_path, "jpeg", ["quality"], [str(get_jpeg_quality())])
+
+    crop_x, crop_y, crop_width, crop_height = get_fovea_box(
+        img.get_width(), img.get_height(), pointer_xy
+    )
+    fovea = img.new_subpixbuf(crop_x, crop_y, crop_width, crop_height)
+    fovea_name = "fovea_x%d_y%d_s%d.jpeg" % (crop_x, crop_y, periphery_scale)
+    fovea_path = screen_path[: -len("screen.jpeg")] + fovea_name
+    fovea.savev(fovea_path, "jpeg", ["quality"], [str(get_jpeg_quality())])
+    return [screen_path, fovea_path]
+
+
+def get_frame_hash(img, pointer_xy=None):
+    """The hash of the raw pixels of the frame (after the scaling), of its size and of the pointer position if given"""
+    hasher = hashlib.sha256()
+    frame_size = (img.get_width(), img.get_height(), img.get_rowstride())
+    hasher.update(str((frame_size, pointer_xy)).encode())
+    hasher.update(img.get_pixels())
+    return hasher.hexdigest()
+
+
+def append_session_record(screen_path, filetype, record):
+    """Appends the record to the session's file of the given type (e.g. the repeats), next to the screenshot"""
+    session_filename = session_id + ".jpeg." + filetype
+    session_path = os.path.join(os.path.dirname(screen_path), session_filename)
+    with open(session_path, "a") as session_f:
+        session_f.write(json.dumps(record) + "\n")
+
+
 # save the screen into a file
-def save_screen(img):
-    img.savev(get_full_path_screen(), "jpeg", ["quality"], [str(jpeg_quality)])
+def save_screen(img, event=None):
+    global last_saved_hash, last_saved_path
+    screen_path = get_full_path_screen()
+    # in the foveated mode, the same frame with the pointer elsewhere is a new frame
+    pointer_xy = get_pointer_position() if foveated7 else None
+    frame_hash = get_frame_hash(img, pointer_xy) if dedup_identical_frames7 else None
+    if (
+        frame_hash is not None
+        and frame_hash == last_saved_hash
+        and os.path.dirname(screen_path) == os.path.dirname(last_saved_path)
+    ):
+        # the screenshot that would be saved to screen_path is the same as the last saved one
+        record = {
+            "name": os.path.basename(screen_path),
+            "repeat_of": os.path.basename(last_saved_path),
+        }
+        append_session_record(screen_path, repeats_filetype, record)
+    else:
+        if foveated7:
+            saved_paths = save_foveated(img, screen_path, pointer_xy)
+        else:
+            img.savev(screen_path, "jpeg", ["quality"], [str(get_jpeg_quality())])
+            saved_paths = [screen_path]
+        for saved_path in saved_paths:
+            register_file(saved_path, record_checksum(saved_path, session_id))
+        last_saved_hash = frame_hash
+        last_saved_path = screen_path
+
+    if event is not None:
+        record = {"name": os.path.basename(screen_path), "event": event}
+        append_session_record(screen_path, triggers_filetype, record)
+        # the triggered screenshots come at irregular times, and would confuse the dynamic timing
+        return
 
     # storing the last 4 screens. Needed for dynamic time between saves:
     imgStack.append(img)
@@ -129,13 +373,14 @@ def main_circle_stuff():
     global jpeg_quality
     global scale_factor
     global previous_differ_speed
+    global load_level
 
     if dymanic_timing:
         if len(imgStack) > 3:
             differ1 = image_difference(imgStack[0], imgStack[1])
             differ2 = image_difference(imgStack[2], imgStack[3])
             differ = (differ1 + differ2) / 2
-            differ_speed = differ / dynamic_time_between_saves
+            differ_speed = differ / get_time_between_saves()
             str2out = "%.2f" % differ_speed
             if differ_speed > high_speed_trashhold:
                 dynamic_time_between_saves = (
@@ -173,8 +418,10 @@ def main_circle_stuff():
         dynamic_time_between_saves = time_between_saves
         current_speed_mode = "normal speed"
 
+    load_level = get_load_level()
+
     now = time.time()
-    done = lambda: time.time() > now + dynamic_time_between_saves
+    done = lambda: time.time() > now + get_time_between_saves()
     log(done, save_screen)
 
 
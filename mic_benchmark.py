@@ -0,0 +1,391 @@
+"""Replays recorded .wav files through the logger_mic pipeline, and reports its speed and detection quality.
+
+No audio hardware is needed: the chunks are read from the files (see WavFileSource in logger_mic.py),
+and go through the same detection and writing code as in the live logger, as fast as the CPU allows.
+
+For each run, it reports:
+- chunks per second
+- CPU seconds per hour of audio
+- precision and recall of the speech detection, measured on the chunk level
+
+The labels must be next to the .wav, with the same name and the .txt extension (e.g. talk.wav -> talk.txt).
+The format is the one of the Audacity label export: one speech span per line, "start<TAB>end<TAB>any label",
+in seconds. If there are no labels, only the speed is reported.
+
+The filter settings can be overridden, to tune them on a recorded corpus.
+Several comma-separated values produce a run for each combination. Example:
+
+python3 mic_benchmark.py corpus/*.wav --set min_relative_l=200,250,300 --set consecutive_num=1,2
+
+With --soak-hours, it instead replays the files in a loop for the given wall time, and checks that the memory
+stays flat: the RSS and the tracemalloc-traced memory are sampled periodically, and compared with the ones
+after the first pass (the warmup). It exits with the code 1 if the memory grew more than --soak-max-growth-mb.
+Example:
+
+python3 mic_benchmark.py corpus/*.wav --soak-hours 3
+
+"""
+
+import argparse
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import logger_mic
+from logger_mic import read_config, record_to_file, set_c_print_switch
+
+
+def read_labels(path):
+    """Returns the list of labelled speech spans, in seconds. Returns None if there is no such file.
+
+    Args:
+        path: str: the path to the label file in the Audacity format
+    Returns:
+        spans: list of tuples: e.g. [(1.5, 3.25), (10.0, 12.0)]
+    """
+    if not os.path.isfile(path):
+        return None
+
+    spans = []
+    with open(path) as labels_f:
+        for line in labels_f:
+            parts = line.strip().split("\t")
+            if len(parts) >= 2:
+                spans.append((float(parts[0]), float(parts[1])))
+    return spans
+
+
+def labelled_chunks(spans, chunks_num, chunk_duration):
+    """Returns the set of the indexes of the chunks that overlap with any of the labelled spans.
+
+    Args:
+        spans: list of tuples: the speech spans, in seconds
+        chunks_num: int: how many chunks are in the file
+        chunk_duration: float: the duration of a chunk, in seconds
+    Returns:
+        res: set of ints
+    """
+    res = set()
+    for start, end in spans:
+        first = max(0, int(start / chunk_duration))
+        last = min(chunks_num - 1, int(end / chunk_duration))
+        res.update(range(first, last + 1))
+    return res
+
+
+def count_wavs(dir_path):
+    """Only the recordings count, not e.g. the checksums manifests written next to them"""
+    return sum(1 for name in os.listdir(dir_path) if name.endswith(".wav"))
+
+
+def replay_file(wav_path, config, out_dir, discard_wav7):
+    """Runs the logger_mic pipeline on the given file until its end.
+
+    Args:
+        wav_path: str: the 16-bit .wav to replay
+        config: dict: the logger_mic config to use
+        out_dir: str: where the pipeline writes its .wav files
+        discard_wav7: bool: if True, the recognized sounds are not written
+    Returns:
+        res: dict: the number of chunks, the detected chunks, the timings etc
+    """
+    source = logger_mic.WavFileSource(wav_path, config["chunk_size"])
+    source.open()
+
+    config = dict(config)
+    config["frame_rate"] = source.frame_rate
+    config["channels"] = source.channels
+    config["use_catalog"] = False  # the replayed sounds are not captures
+
+    # to start uncalibrated, as the live logger does:
+    logger_mic.dyn_level = 0
+    logger_mic.noise_estimator.reset()
+
+    detected = set()
+    files_before = count_wavs(out_dir)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    while not source.exhausted7:
+        rep = record_to_file(
+            config,
+            dir_path=out_dir,
+            discard_wav7=discard_wav7,
+            source=source,
+        )["record_to_file"]
+        span = rep.get("recording_cycle", dict()).get("detected_span")
+        if span is not None:
+            detected.update(range(span[0], span[1] + 1))
+    wall_sec = time.perf_counter() - wall_start
+    cpu_sec = time.process_time() - cpu_start
+    source.release()
+
+    return {
+        "chunks_num": source.chunks_read,
+        "chunk_duration": config["chunk_size"] / config["frame_rate"],
+        "detected": detected,
+        "files_num": count_wavs(out_dir) - files_before,
+        "wall_sec": wall_sec,
+        "cpu_sec": cpu_sec,
+    }
+
+
+def get_metrics(replays, labels):
+    """Summarizes the replays of several files.
+
+    Args:
+        replays: list of dicts: the outputs of replay_file()
+        labels: list: the outputs of read_labels(), in the same order. None if the file has no labels
+    Returns:
+        res: dict: the metrics of all the files together
+    """
+    chunks_num = sum(r["chunks_num"] for r in replays)
+    audio_hours = sum(r["chunks_num"] * r["chunk_duration"] for r in replays) / 3600
+    wall_sec = sum(r["wall_sec"] for r in replays)
+    cpu_sec = sum(r["cpu_sec"] for r in replays)
+
+    res = {
+        "chunks_num": chunks_num,
+        "files_written": sum(r["files_num"] for r in replays),
+        "chunks_per_sec": chunks_num / wall_sec if wall_sec > 0 else 0.0,
+        "realtime_factor": audio_hours * 3600 / wall_sec if wall_sec > 0 else 0.0,
+        "cpu_sec_per_audio_hour": cpu_sec / audio_hours if audio_hours > 0 else 0.0,
+        "precision": None,
+        "recall": None,
+    }
+
+    true_pos, false_pos, false_neg = 0, 0, 0
+    labelled7 = False
+    for replay, spans in zip(replays, labels):
+        if spans is None:
+            continue
+        labelled7 = True
+        truth = labelled_chunks(spans, replay["chunks_num"], replay["chunk_duration"])
+        true_pos += len(truth & replay["detected"])
+        false_pos += len(replay["detected"] - truth)
+        false_neg += len(truth - replay["detected"])
+
+    if labelled7:
+        if true_pos + false_pos > 0:
+            res["precision"] = true_pos / (true_pos + false_pos)
+        if true_pos + false_neg > 0:
+            res["recall"] = true_pos / (true_pos + false_neg)
+    return res
+
+
+def parse_overrides(raw_overrides):
+    """Converts ["min_relative_l=200,250", "consecutive_num=2"] into a list of config overrides, one per run.
+
+    Args:
+        raw_overrides: list of str: the values of the --set args
+    Returns:
+        res: list of dicts: e.g. [{"min_relative_l": 200, ...}, {"min_relative_l": 250, ...}]
+    """
+    keys = []
+    values = []
+    for raw in raw_overrides:
+        key, _, raw_values = raw.partition("=")
+        keys.append(key.strip())
+        values.append([int(v) for v in raw_values.split(",")])
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def format_metrics(overrides, metrics):
+    res = str(overrides if overrides else "defaults") + ": "
+    res += "%.0f chunks/s, " % metrics["chunks_per_sec"]
+    res += "%.1fx realtime, " % metrics["realtime_factor"]
+    res += "%.1f CPU s per audio hour, " % metrics["cpu_sec_per_audio_hour"]
+    res += "%d files written" % metrics["files_written"]
+    for key in ("precision", "recall"):
+        if metrics[key] is not None:
+            res += ", %s %.3f" % (key, metrics[key])
+    return res
+
+
+def get_rss_bytes():
+    """Returns the resident set size of this process, in bytes. Linux only"""
+    with open("/proc/self/statm") as statm_f:
+        resident_pages = int(statm_f.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def clear_dir(dir_path):
+    """Only for the dirs created by this script, see run_benchmark()"""
+    for name in os.listdir(dir_path):
+        os.remove(os.path.join(dir_path, name))
+
+
+def run_soak(wav_paths, config, out_dir, hours, interval_sec, max_growth_mb):
+    """Replays the files in a loop for the given time, and reports if the memory grew.
+
+    The written files are deleted after each pass, to exercise the writing without filling the disk.
+
+    Args:
+        wav_paths: list of str: the files to replay
+        config: dict: the logger_mic config to use
+        out_dir: str: where the pipeline writes its .wav files
+        hours: float: how long to run, in hours of the wall time
+        interval_sec: float: how often to sample the memory
+        max_growth_mb: float: the max allowed growth of the RSS after the warmup
+    Returns:
+        flat7: bool: True if the memory stayed flat
+    """
+    tracemalloc.start()
+
+    def replay_pass():
+        for path in wav_paths:
+            replay_file(path, config, out_dir, discard_wav7=False)
+        clear_dir(out_dir)
+
+    replay_pass()  # the warmup: fills the buffers and the caches
+    base_rss = get_rss_bytes()
+    base_traced = tracemalloc.get_traced_memory()[0]
+    base_snapshot = tracemalloc.take_snapshot()
+    print(
+        "after the warmup: RSS %.1f MB, traced %.1f MB"
+        % (base_rss / 1e6, base_traced / 1e6)
+    )
+
+    start = time.time()
+    next_sample = start + interval_sec
+    passes = 1
+    max_rss = base_rss
+    while time.time() - start < hours * 3600:
+        replay_pass()
+        passes += 1
+        if time.time() >= next_sample:
+            next_sample += interval_sec
+            rss = get_rss_bytes()
+            traced, traced_peak = tracemalloc.get_traced_memory()
+            max_rss = max(max_rss, rss)
+            print(
+                "%.2f h, %d passes: RSS %.1f MB (%+.2f), traced %.1f MB (%+.2f), traced peak %.1f MB"
+                % (
+                    (time.time() - start) / 3600,
+                    passes,
+                    rss / 1e6,
+                    (rss - base_rss) / 1e6,
+                    traced / 1e6,
+                    (traced - base_traced) / 1e6,
+                    traced_peak / 1e6,
+                )
+            )
+
+    rss_growth_mb = (get_rss_bytes() - base_rss) / 1e6
+    traced_growth_mb = (tracemalloc.get_traced_memory()[0] - base_traced) / 1e6
+    print("the biggest allocation growths since the warmup:")
+    for stat in tracemalloc.take_snapshot().compare_to(base_snapshot, "lineno")[:5]:
+        print("   ", stat)
+    tracemalloc.stop()
+
+    flat7 = rss_growth_mb <= max_growth_mb and traced_growth_mb <= max_growth_mb
+    print(
+        "%d passes. RSS growth: %.2f MB (max RSS %.1f MB), traced growth: %.2f MB. The memory is %s"
+        % (
+            passes,
+            rss_growth_mb,
+            max_rss / 1e6,
+            traced_growth_mb,
+            "flat" if flat7 else "GROWING",
+        )
+    )
+    return flat7
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description="replays .wav files through the logger_mic pipeline"
+    )
+    parser.add_argument("wav_paths", nargs="+", help="16-bit .wav files to replay")
+    parser.add_argument(
+        "--set",
+        dest="overrides",
+        action="append",
+        default=[],
+        help="override a config setting, e.g. min_relative_l=250 or min_relative_l=200,300",
+    )
+    parser.add_argument(
+        "--out-dir",
+        dest="out_dir",
+        default=None,
+        help="where to keep the written files (in a new subdir). By default, a temp dir that is deleted at the end",
+    )
+    parser.add_argument(
+        "-nr",
+        "--discard_wav",
+        dest="discard_wav7",
+        action="store_true",
+        help="don't write the recognized sounds (measures the detection only)",
+    )
+    parser.add_argument(
+        "--soak-hours",
+        dest="soak_hours",
+        type=float,
+        default=None,
+        help="replay the files in a loop for this many hours, and check that the memory stays flat",
+    )
+    parser.add_argument(
+        "--soak-interval-sec",
+        dest="soak_interval_sec",
+        type=float,
+        default=60.0,
+        help="how often to report the memory during the soak test",
+    )
+    parser.add_argument(
+        "--soak-max-growth-mb",
+        dest="soak_max_growth_mb",
+        type=float,
+        default=2.0,
+        help="the soak test fails if the memory grows more than this after the warmup",
+    )
+    return parser.parse_args()
+
+
+def run_benchmark():
+    args = parse_command_line_args()
+    set_c_print_switch(False)  # the per-chunk console output would dominate the timings
+
+    # always a new dir of its own, as the soak test deletes the files in it
+    if args.out_dir is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+    out_dir = tempfile.mkdtemp(prefix="mic_benchmark", dir=args.out_dir)
+
+    if args.soak_hours is not None:
+        config = read_config()
+        for overrides in parse_overrides(args.overrides):
+            config.update(overrides)  # the first combination only
+            break
+        flat7 = run_soak(
+            args.wav_paths,
+            config,
+            out_dir,
+            args.soak_hours,
+            args.soak_interval_sec,
+            args.soak_max_growth_mb,
+        )
+        if args.out_dir is None:
+            shutil.rmtree(out_dir, ignore_errors=True)
+        sys.exit(0 if flat7 else 1)
+
+    labels = [read_labels(os.path.splitext(p)[0] + ".txt") for p in args.wav_paths]
+
+    for overrides in parse_overrides(args.overrides):
+        config = read_config()
+        config.update(overrides)
+        replays = [
+            replay_file(path, config, out_dir, args.discard_wav7)
+            for path in args.wav_paths
+        ]
+        print(format_metrics(overrides, get_metrics(replays, labels)))
+
+    if args.out_dir is None:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    else:
+        print("the written files are in", out_dir)
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,412 @@
+import argparse
+import configparser
+import fcntl
+import os
+import shutil
+import time
+
+from archiver import get_open_files, lock_filename as archiver_lock_filename
+from launcher import configure_loggers
+from utils import get_full_path, get_file_hash, print_and_log, checksums_filetype
+from utils import get_archives_dir, read_text_log, compress_block
+from utils import compression_suffixes, repeats_filetype
+from catalog import get_modality, loose_files, update_file, forget_files
+from catalog import forget_archive
+from zips_deleter import scan_archive_catalog
+from dataset_reader import read_session_records, parse_fovea_name
+from dataset_reader import get_frame_timestamp
+
+""" Keeps the disk usage of each modality within its budget. Launched by launcher.py in the background.
+
+The usage of a modality is the size of its not yet archived files (from the capture catalog, see catalog.py),
+plus the size of its archives. The budgets are set in the [retention] section of config.ini.
+If a modality is over its budget, the tiers below are applied, the cheapest first, until it fits:
+
+1. thinning the old screenshots: only one screenshot per thinned_screen_interval_sec is kept.
+   The screenshots repeated by the later frames (see dataset_reader.py) are kept too
+2. thinning the old mouse logs: only one position per thinned_mouse_interval_sec is kept
+3. deleting the oldest archives of the modality
+
+Independently of the budgets, if the free disk space falls below min_free_gb, the oldest archives of all modalities
+are deleted, so the loggers never stall on a full disk.
+
+It works incrementally: each pass changes no more than max_files_per_pass files, and then sleeps for pass_interval_sec.
+The thinning is idempotent: an already thinned file is never changed again.
+While the archiver is running, the not yet archived files are not thinned, to not change them under it.
+The monthly journals (see use_journals7 in archiver.py) are not touched.
+"""
+
+config_filename = "config.ini"
+
+# the budgets in GB, if not set in config.ini
+default_budgets_gb = {
+    "screen": 100,
+    "mouse": 10,
+    "keyboard": 2,
+    "headphone": 30,
+    "mic": 30,
+}
+
+min_free_gb = 5
+
+# the captures younger than this are never thinned
+thin_after_days = 7
+thinned_screen_interval_sec = 60
+thinned_mouse_interval_sec = 0.1
+
+max_files_per_pass = 2000
+pass_interval_sec = 600
+
+lock_filename = "retention.lock"
+
+# get the location of this very file
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+
+def read_budgets_gb(config_path=None):
+    """Returns the budget of each modality in GB, e.g. screen_budget_gb in the [retention] section of config.ini
+
+    >>> import tempfile
+    >>> path0 = os.path.join(tempfile.mkdtemp(), "config.ini")
+    >>> with open(path0, "w") as f0:
+    ...     _ = f0.write("[retention]\\nscreen_budget_gb = 50\\n")
+    >>> budgets0 = read_budgets_gb(path0)
+    >>> budgets0["screen"], budgets0["mic"]
+    (50.0, 30)
+    """
+    pa = configparser.ConfigParser()
+    pa.read(config_path or get_full_path(config_filename))
+    return {
+        modality: pa.getfloat("retention", modality + "_budget_gb", fallback=budget)
+        for modality, budget in default_budgets_gb.items()
+    }
+
+
+def get_free_gb(path):
+    return shutil.disk_usage(path).free / 2**30
+
+
+def get_usage(working_dir, loggers):
+    """Returns the disk usage, in bytes, per modality.
+
+    Returns:
+        loose: dict: modality -> list of (full_path, start_time, size) of the not yet archived files, the oldest first
+        archives: dict: modality -> list of ArchiveEntry (see zips_deleter.py), the oldest first
+        usage: dict: modality -> bytes
+    """
+    modalities_by_prefix = {
+        lgr.archive_prefix: get_modality("." + lgr.output_filetype) for lgr in loggers
+    }
+    loose = {modality: [] for modality in modalities_by_prefix.values()}
+    archives = {modality: [] for modality in modalities_by_prefix.values()}
+
+    for name, modality, start_time, size, file_dir in loose_files():
+        if modality in loose:
+            full_path = os.path.join(file_dir or working_dir, name)
+            loose[modality].append((full_path, start_time, size or 0))
+    for entry in scan_archive_catalog(working_dir):
+        modality = modalities_by_prefix.get(entry.prefix)
+        # e.g. an archive of a removed logger
+        if modality is None:
+            continue
+        archives[modality].append(entry)
+    for modality in archives:
+        archives[modality].sort(key=lambda e: e.timestamp)
+
+    for modality in loose:
+        loose[modality].sort(key=lambda e: e[1] or 0)
+    usage = {
+        modality: sum(e[2] for e in loose[modality])
+        + sum(e.size for e in archives[modality])
+        for modality in loose
+    }
+    return loose, archives, usage
+
+
+def select_thinned(entries, min_interval_sec):
+    """Returns the names to delete, to keep no more than one entry per min_interval_sec.
+
+    The entries with the same time as the kept one are kept too (e.g. the crops of a foveated screenshot).
+
+    Args:
+        entries: list of (path, start_time, size), sorted by start_time
+
+    >>> select_thinned([("a", 0.0, 1), ("b", 30.0, 1), ("c", 60.0, 1), ("d", 70.0, 1), ("e", 200.0, 1)], 60)
+    ['b', 'd']
+    >>> select_thinned([("a", 0.0, 1), ("c", 60.0, 1), ("e", 200.0, 1)], 60)  # already thinned
+    []
+    >>> select_thinned([("a", 0.0, 1), ("a_fovea", 0.0, 1), ("b", 30.0, 1), ("b_fovea", 30.0, 1)], 60)
+    ['b', 'b_fovea']
+    """
+    res = []
+    last_kept = None
+    for name, start_time, _ in entries:
+        if start_time is None:
+            continue
+        if last_kept is not None and 0 < start_time - last_kept < min_interval_sec:
+            res.append(name)
+        else:
+            last_kept = start_time
+    return res
+
+
+def get_repeated_timestamps(dir_path):
+    """Returns the timestamps of the screenshots that the repeats records of the dir point to, or None if unreadable
+
+    The repeats never refer to another dir, see dataset_reader.py
+    """
+    res = set()
+    try:
+        for filename in os.listdir(dir_path):
+            if filename.endswith(".jpeg." + repeats_filetype):
+                records = read_session_records(
+                    os.path.join(dir_path, filename), "repeat_of"
+                )
+                res.update(get_frame_timestamp(name) for name in records.values())
+    except OSError as e:
+        print_and_log("retention: failed to read the repeats in " + dir_path, str(e))
+        return None
+    return res
+
+
+def skip_repeated(full_paths):
+    """Returns the screenshots without the ones (and their crops) that the later frames repeat.
+
+    Deleting such a screenshot would lose its repeats too. If the repeats of a dir can't be read, its files are kept.
+
+    >>> import tempfile
+    >>> dir0 = tempfile.mkdtemp()
+    >>> with open(os.path.join(dir0, "20210502112444000.jpeg.repeats"), "w") as f0:
+    ...     _ = f0.write('{"name": "20210502112450123screen.jpeg", "repeat_of": "20210502112444123screen.jpeg"}\\n')
+    >>> names0 = ["20210502112444123screen.jpeg", "20210502112444123fovea_x0_y0_s4.jpeg", "20210502112500123screen.jpeg"]
+    >>> [os.path.basename(p) for p in skip_repeated([os.path.join(dir0, n) for n in names0])]
+    ['20210502112500123screen.jpeg']
+    """
+    repeated_by_dir = dict()
+    res = []
+    for full_path in full_paths:
+        dir_path, filename = os.path.split(full_path)
+        if dir_path not in repeated_by_dir:
+            repeated_by_dir[dir_path] = get_repeated_timestamps(dir_path)
+        repeated = repeated_by_dir[dir_path]
+        if repeated is None:
+            continue
+        fovea_info = parse_fovea_name(filename)
+        timestamp = fovea_info[0] if fovea_info else get_frame_timestamp(filename)
+        if timestamp not in repeated:
+            res.append(full_path)
+    return res
+
+
+def thin_mouse_lines(lines, min_interval_sec):
+    """Keeps only one position per min_interval_sec. Returns None if there is nothing to thin
+
+    >>> lines0 = ["1.00   5   6\\n", "1.01   5   7\\n", "1.10   6   7\\n", "broken\\n", "1.15   6   8\\n"]
+    >>> thin_mouse_lines(lines0, 0.1)
+    ['1.00   5   6\\n', '1.10   6   7\\n', 'broken\\n']
+    >>> thin_mouse_lines(thin_mouse_lines(lines0, 0.1), 0.1) is None
+    True
+    """
+    res = []
+    last_kept = None
+    for line in lines:
+        try:
+            line_time = float(line.split()[0])
+        except (ValueError, IndexError):
+            res.append(line)  # never lose what can't be parsed
+            continue
+        # a small tolerance for the rounding of the timestamps
+        if last_kept is None or line_time - last_kept >= min_interval_sec * 0.999:
+            res.append(line)
+            last_kept = line_time
+    return res if len(res) < len(lines) else None
+
+
+def thin_mouse_file(full_path):
+    """Rewrites the mouse log with fewer positions. Returns the bytes saved
+
+    A compressed log (see text_log_compression in utils.py) is rewritten as a single compressed block.
+    """
+    lines = read_text_log(full_path).splitlines(keepends=True)
+    thinned = thin_mouse_lines(lines, thinned_mouse_interval_sec)
+    if thinned is None:
+        return 0
+    size_before = os.path.getsize(full_path)
+    temp_path = full_path + ".tmp"
+    data = "".join(thinned).encode("utf-8")
+    for method, suffix in compression_suffixes.items():
+        if full_path.endswith("." + suffix):
+            data = compress_block(data, method)
+    with open(temp_path, "wb") as thinned_f:
+        thinned_f.write(data)
+    # keeps the mtime, as it's the end time of the capture
+    stat_info = os.stat(full_path)
+    os.utime(temp_path, ns=(stat_info.st_atime_ns, stat_info.st_mtime_ns))
+    os.replace(temp_path, full_path)
+    size_after = os.path.getsize(full_path)
+    update_file(os.path.basename(full_path), size_after, get_file_hash(full_path))
+    return size_before - size_after
+
+
+def delete_files(full_paths):
+    """Returns the bytes freed"""
+    freed = 0
+    deleted = []
+    for full_path in full_paths:
+        try:
+            freed += os.path.getsize(full_path)
+            os.remove(full_path)
+        except OSError:
+            pass  # already deleted. Then it's only forgotten
+        deleted.append(os.path.basename(full_path))
+    forget_files(deleted)
+    return freed
+
+
+def delete_archive(working_dir, entry):
+    """Deletes the archive, with its checksums manifest if any. Returns the bytes freed"""
+    freed = 0
+    for name in (entry.name, entry.name + "." + checksums_filetype):
+        full_path = os.path.join(working_dir, name)
+        if os.path.isfile(full_path):
+            freed += os.path.getsize(full_path)
+            os.remove(full_path)
+    forget_archive(entry.name)
+    print_and_log("retention: deleted the archive", entry.name)
+    return freed
+
+
+def archiver_running7():
+    """The archiver keeps its lock file open while running. Taking the lock here could make a starting archiver exit"""
+    return archiver_lock_filename in get_open_files(__location__)
+
+
+def get_old_loose(loose_entries):
+    thin_before = time.time() - thin_after_days * 24 * 3600
+    return [e for e in loose_entries if e[1] is not None and e[1] < thin_before]
+
+
+def enforce_budget(
+    working_dir, modality, loose_entries, archive_entries, usage, budget_gb, thin7=True
+):
+    """Applies the tiers to the modality until it fits its budget (in GB). Returns the number of the changed files
+
+    If thin7 is False, only the archives are deleted.
+    """
+    excess = usage - budget_gb * 2**30
+    if excess <= 0:
+        return 0
+    print_and_log(
+        "retention: %s is over its budget by %.1f MB" % (modality, excess / 2**20)
+    )
+    changed = 0
+
+    if thin7 and modality == "screen":
+        thinned = select_thinned(
+            get_old_loose(loose_entries), thinned_screen_interval_sec
+        )
+        thinned = skip_repeated(thinned)[:max_files_per_pass]
+        excess -= delete_files(thinned)
+        changed += len(thinned)
+        print_and_log("retention: thinned the old screenshots:", len(thinned))
+
+    if thin7 and modality == "mouse":
+        for full_path, _, _ in get_old_loose(loose_entries):
+            if excess <= 0 or changed >= max_files_per_pass:
+                break
+            try:
+                saved = thin_mouse_file(full_path)
+            except OSError as e:
+                print_and_log("retention: failed to thin " + full_path, str(e))
+                continue
+            if saved > 0:
+                excess -= saved
+                changed += 1
+
+    for entry in archive_entries:
+        if excess <= 0 or changed >= max_files_per_pass:
+            break
+        excess -= delete_archive(working_dir, entry)
+        changed += 1
+
+    if excess > 0 and changed < max_files_per_pass:
+        print_and_log(
+            "retention: %s is still over its budget, with nothing more to delete"
+            % modality
+        )
+    return changed
+
+
+def free_disk_space(working_dir, archives):
+    """Deletes the oldest archives of all modalities until there is min_free_gb of free space"""
+    all_archives = sorted(
+        (entry for entries in archives.values() for entry in entries),
+        key=lambda e: e.timestamp,
+    )
+    for entry in all_archives:
+        if get_free_gb(working_dir) >= min_free_gb:
+            break
+        delete_archive(working_dir, entry)
+    if get_free_gb(working_dir) < min_free_gb:
+        print_and_log("retention: LOW DISK SPACE, and no archives left to delete")
+
+
+def run_pass(working_dir, loggers):
+    loose, archives, usage = get_usage(working_dir, loggers)
+    if get_free_gb(working_dir) < min_free_gb:
+        free_disk_space(working_dir, archives)
+        loose, archives, usage = get_usage(working_dir, loggers)
+    thin7 = not archiver_running7()
+    # re-read each pass, to apply the changed budgets without a restart
+    budgets_gb = read_budgets_gb()
+    changed = 0
+    for modality in usage:
+        changed += enforce_budget(
+            working_dir,
+            modality,
+            loose[modality],
+            archives[modality],
+            usage[modality],
+            budgets_gb.get(modality, float("inf")),
+            thin7,
+        )
+    return changed
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(description="Keeps the disk usage within budgets")
+    parser.add_argument(
+        "--once",
+        dest="once7",
+        action="store_true",
+        help="do a single pass and exit",
+    )
+    return parser.parse_args()
+
+
+def run_retention():
+    args = parse_command_line_args()
+
+    # only one retention manager at a time (e.g. if the launcher was run twice)
+    with open(get_full_path(lock_filename), "w") as lock_f:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print_and_log("another retention manager is already running. Exiting")
+            return
+
+        loggers = configure_loggers()
+        while True:
+            try:
+                changed = run_pass(get_archives_dir(__location__), loggers)
+            except Exception as e:
+                print_and_log("retention pass failed:", str(e))
+                changed = 0
+            if args.once7:
+                break
+            # if the pass was cut short, the next one starts sooner
+            time.sleep(1 if changed >= max_files_per_pass else pass_interval_sec)
+
+
+if __name__ == "__main__":
+    run_retention()
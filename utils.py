@@ -1,11 +1,68 @@
 import datetime
+import gzip
+import hashlib
+import json
+import lzma
 import random
 import os
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # optional. Without it, "zstd" falls back to gzip
 
 """ Provides utils for the loggers."""
 
 cprint_verbose7 = True  # if true, the cprint func will print to sdout
 
+# each logger records the size and sha256 of each file it has written into a per-session manifest,
+# e.g. 20210502112444123.keystxt.checksums. The manifests are archived with the logs, see archiver.py
+record_checksums7 = True
+checksums_filetype = "checksums"
+
+# logger_screen can record an unchanged frame as a repeat of the previous screenshot, instead of a new jpeg.
+# The records are appended to a per-session file, e.g. 20210502112444123.jpeg.repeats. See dataset_reader.py
+repeats_filetype = "repeats"
+
+# logger_screen can take a screenshot on a mouse button or key press. The triggering events are appended
+# to a per-session file, e.g. 20210502112444123.jpeg.triggers
+triggers_filetype = "triggers"
+
+# the per-session files that the loggers append to. They are archived with the logs of the logger
+session_filetypes = (checksums_filetype, repeats_filetype, triggers_filetype)
+
+# if set (e.g. "~/pbctdct_data"), the loggers write into hour shards: <output_root>/<modality>/YYYY/MM/DD/HH/
+# and the archives are created in output_root. It keeps every dir small, and an hour is archived as a whole dir.
+# If None, everything is written next to the scripts, in a single dir
+output_root = None
+
+# if set (e.g. "/dev/shm/pbctdct_staging", a RAM-backed dir), the loggers write there instead,
+# and flusher.py moves the closed files to the disk in batches. See flusher.py for the loss window.
+# If the staged files exceed staging_ram_cap_mb (e.g. the flusher is down), the loggers write directly to the disk
+staging_root = None
+staging_ram_cap_mb = 512
+# the size of the staged files is measured once per this, in seconds, not on every write
+staging_check_sec = 5
+staging_usage_cache = {"dir": None, "full7": False, "checked": 0.0}
+
+# governor.py publishes the load level (0: idle .. 3: overloaded) here. The loggers capture less at the higher levels
+governor_state_filename = "governor_state.json"
+load_slowdowns = (1, 2, 4, 8)  # how many times slower the loggers capture, per level
+governor_state_max_age_sec = (
+    60  # an older state means the governor is down. Then the level is 0
+)
+load_level_check_sec = 5
+load_level_cache = {"level": 0, "checked": 0.0}
+
+# if set to "gzip", "lzma" or "zstd", the mouse and keyboard loggers compress their logs as they write them.
+# Each save is appended as an independently compressed block, so a crash loses no more than one block.
+# A file is closed (and a new one is started) every compressed_segment_sec
+text_log_compression = None
+compressed_segment_sec = 300
+compression_suffixes = {"gzip": "gz", "lzma": "xz", "zstd": "zst"}
+
 
 def set_cprint_switch(ibool):
     global cprint_verbose7
@@ -49,6 +106,84 @@ def get_full_path(filename, fake_parent_location=None):
     return full_path
 
 
+def get_archives_dir(fallback_dir, root=None):
+    """Returns the dir with the archives: output_root (or the given root) if set, fallback_dir otherwise"""
+    root = root if root is not None else output_root
+    if root is None:
+        return fallback_dir
+    return os.path.expanduser(root)
+
+
+def get_dir_size(dir_path):
+    """Returns the total size of the files in the dir and its subdirs, in bytes"""
+    res = 0
+    for parent, _, filenames in os.walk(dir_path):
+        for filename in filenames:
+            try:
+                res += os.path.getsize(os.path.join(parent, filename))
+            except OSError:  # just moved by the flusher
+                pass
+    return res
+
+
+def staging_full7(staging):
+    """Returns True if the staged files exceed staging_ram_cap_mb. Walks the dir once per few seconds
+
+    >>> import tempfile
+    >>> staging_usage_cache["checked"] = 0.0
+    >>> staging_full7(tempfile.mkdtemp())
+    False
+    """
+    now = time.time()
+    if (
+        staging_usage_cache["dir"] == staging
+        and now - staging_usage_cache["checked"] < staging_check_sec
+    ):
+        return staging_usage_cache["full7"]
+    full7 = get_dir_size(staging) >= staging_ram_cap_mb * 2**20
+    staging_usage_cache.update({"dir": staging, "full7": full7, "checked": now})
+    return full7
+
+
+def get_output_dir(
+    modality, fallback_dir, custom_datetime=None, root=None, staging=None
+):
+    """Returns the dir where a logger should write a file now, creating it if needed.
+
+    E.g. ~/pbctdct_data/screen/2021/05/02/11 if output_root (or the given root) is set, or fallback_dir otherwise.
+    If staging_root (or the given staging) is set, the same subdirs are returned under it, unless it's full.
+
+    >>> get_output_dir("screen", "/some/dir")
+    '/some/dir'
+    >>> import tempfile
+    >>> root0 = tempfile.mkdtemp()
+    >>> res0 = get_output_dir("screen", "/some/dir", datetime.datetime(2021, 5, 2, 11, 24, 44), root=root0)
+    >>> res0[len(root0):], os.path.isdir(res0)
+    ('/screen/2021/05/02/11', True)
+    >>> staging0 = tempfile.mkdtemp()
+    >>> res0 = get_output_dir("screen", "/some/dir", datetime.datetime(2021, 5, 2, 11, 24, 44), root0, staging0)
+    >>> res0[len(staging0):]
+    '/screen/2021/05/02/11'
+    >>> get_output_dir("screen", "/some/dir", staging=staging0) == staging0
+    True
+    """
+    root = root if root is not None else output_root
+    staging = staging if staging is not None else staging_root
+    if staging is not None and staging_full7(staging):
+        print_and_log("the staging dir is full. Writing directly to the disk", staging)
+        staging = None
+    if root is None:
+        if staging is None:
+            return fallback_dir
+        res = staging
+    else:
+        now = custom_datetime or datetime.datetime.now()
+        res = os.path.join(staging or root, modality, now.strftime("%Y/%m/%d/%H"))
+    res = os.path.expanduser(res)
+    os.makedirs(res, exist_ok=True)
+    return res
+
+
 def is_file7(fpath):
     """Returns True if there is a file on the given path, False otherwise.
 
@@ -71,3 +206,203 @@ def print_and_log(my_text1, my_text2=""):
             human_timestamp() + " - " + str(my_text1) + " " + str(my_text2) + "\n"
         )
     fff.close()
+
+
+def get_file_hash(full_path):
+    """Returns the sha256 of the file, reading it in chunks to not load a big file into RAM"""
+    hasher = hashlib.sha256()
+    with open(full_path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def record_checksum(full_path, session_id):
+    """Appends the size and sha256 of a closed log file to the session manifest in the same dir.
+
+    The manifest is named after the session and the file extension, e.g. 20210502112444123.keystxt.checksums
+    A failure is logged, but never stops the logger.
+
+    Returns:
+        record: dict: the name, size and sha256 of the file. None if not recorded
+    """
+    if not record_checksums7:
+        return None
+    try:
+        dir_path, filename = os.path.split(full_path)
+        filetype = strip_compression_suffix(filename).rpartition(".")[2]
+        manifest_name = str(session_id) + "." + filetype + "." + checksums_filetype
+        record = {
+            "name": filename,
+            "size": os.path.getsize(full_path),
+            "sha256": get_file_hash(full_path),
+        }
+        with open(os.path.join(dir_path, manifest_name), "a") as manifest_f:
+            manifest_f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print_and_log(
+            "failed to record the checksum of " + str(full_path) + ":", str(e)
+        )
+        record = None
+    return record
+
+
+def read_checksums(full_path):
+    """Returns the records of a checksums manifest as a dict: the key is the filename. The broken lines are skipped"""
+    res = dict()
+    with open(full_path) as manifest_f:
+        for line in manifest_f:
+            try:
+                record = json.loads(line)
+                res[record["name"]] = record
+            except (ValueError, KeyError, TypeError):
+                continue
+    return res
+
+
+def strip_compression_suffix(filename):
+    """E.g. "20210502112444123.mousetxt" for "20210502112444123.mousetxt.gz"
+
+    >>> strip_compression_suffix("20210502112444123.mousetxt.xz"), strip_compression_suffix("a.jpeg")
+    ('20210502112444123.mousetxt', 'a.jpeg')
+    """
+    base, _, suffix = filename.rpartition(".")
+    if base and suffix in compression_suffixes.values():
+        return base
+    return filename
+
+
+def get_compression_method(method):
+    """Returns the method actually available, e.g. "gzip" for "zstd" if zstandard is not installed"""
+    if method == "zstd" and zstandard is None:
+        print_and_log("zstandard is not installed. Using gzip instead of zstd")
+        return "gzip"
+    return method
+
+
+def compress_block(data, method):
+    """Compresses the bytes as a self-contained gzip member / xz stream / zstd frame.
+
+    Such blocks can be concatenated into a single valid file.
+
+    >>> data0 = b"1.00   5   6\\n" * 100
+    >>> all(decompress_all(compress_block(data0, m) * 2, m) == data0 * 2 for m in ["gzip", "lzma"])
+    True
+    """
+    if method == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if method == "lzma":
+        return lzma.compress(data, preset=6)
+    if method == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    raise ValueError("unknown compression method: " + str(method))
+
+
+def decompress_all(data, method):
+    """Decompresses all the concatenated blocks. A truncated last block (e.g. after a crash) is skipped
+
+    >>> blocks0 = compress_block(b"a\\n", "gzip") + compress_block(b"b\\n", "gzip")
+    >>> decompress_all(blocks0[:-3], "gzip")
+    b'a\\n'
+    """
+    errors = (EOFError, zlib.error, lzma.LZMAError)
+    if zstandard is not None:
+        errors += (zstandard.ZstdError,)
+    chunks = []
+    while data:
+        if method == "gzip":
+            decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        elif method == "lzma":
+            decompressor = lzma.LZMADecompressor()
+        else:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+        try:
+            chunk = decompressor.decompress(data)
+        except errors:
+            break
+        if not decompressor.eof:
+            break  # truncated
+        chunks.append(chunk)
+        data = decompressor.unused_data
+    return b"".join(chunks)
+
+
+def read_text_log(full_path):
+    """Returns the text of a log, compressed or not"""
+    suffix = full_path.rpartition(".")[2]
+    with open(full_path, "rb") as log_f:
+        data = log_f.read()
+    for method, method_suffix in compression_suffixes.items():
+        if suffix == method_suffix:
+            data = decompress_all(data, method)
+    return data.decode("utf-8", errors="replace")
+
+
+class CompressedLog:
+    """A log file compressed as it's written. See text_log_compression above.
+
+    The file is kept open until its segment ends, so the archiver and the flusher don't take it.
+    """
+
+    def __init__(self, get_path, method, segment_sec=compressed_segment_sec):
+        self.get_path = get_path  # returns a new uncompressed path, e.g. get_full_path_mouse() in logger_mouse.py
+        self.method = get_compression_method(method)
+        self.segment_sec = segment_sec
+        self.log_f = None
+        self.full_path = None
+        self.start = None
+
+    def write_block(self, text):
+        """Appends the text as a compressed block.
+
+        Returns:
+            closed_path: str: the path of the file, if its segment has ended and it's closed. None otherwise
+        """
+        if self.log_f is None:
+            self.full_path = self.get_path() + "." + compression_suffixes[self.method]
+            self.log_f = open(self.full_path, "ab")
+            self.start = time.time()
+        self.log_f.write(compress_block(text.encode("utf-8"), self.method))
+        self.log_f.flush()
+        if time.time() - self.start >= self.segment_sec:
+            return self.close()
+        return None
+
+    def close(self):
+        if self.log_f is None:
+            return None
+        self.log_f.close()
+        self.log_f = None
+        return self.full_path
+
+
+def get_load_level(state_path=None):
+    """Returns the load level published by governor.py: 0 (idle) .. 3 (overloaded). Reads the file once per few seconds
+
+    >>> import tempfile
+    >>> path0 = os.path.join(tempfile.mkdtemp(), "governor_state.json")
+    >>> with open(path0, "w") as f0:
+    ...     json.dump({"level": 2, "time": time.time()}, f0)
+    >>> load_level_cache["checked"] = 0.0
+    >>> get_load_level(path0)
+    2
+    >>> load_level_cache["checked"] = 0.0
+    >>> get_load_level(path0 + ".missing")
+    0
+    """
+    now = time.time()
+    if now - load_level_cache["checked"] < load_level_check_sec:
+        return load_level_cache["level"]
+    if state_path is None:
+        state_path = get_full_path(governor_state_filename)
+    level = 0
+    try:
+        with open(state_path) as state_f:
+            state = json.load(state_f)
+        if now - state["time"] < governor_state_max_age_sec:
+            level = max(0, min(int(state["level"]), len(load_slowdowns) - 1))
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    load_level_cache["level"] = level
+    load_level_cache["checked"] = now
+    return level
@@ -1,26 +1,37 @@
+import bisect
 import os
 import datetime
+import json
+import re
+import shutil
 import subprocess
-from utils import print_and_log, human_timestamp
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from catalog import forget_zip
+from utils import print_and_log, checksums_filetype, get_file_hash, read_checksums
+from utils import get_archives_dir
 
 """Checks if zpaq archives are valid. If valid, it deletes the corresponding zips to save drive space
 
-This script does the following checks before deleting the zips:
+The dir is scanned once, and the archive names are parsed into a catalog (see scan_archive_catalog).
+Each recent zip is paired with the zpaq of the same logger (and the same shard) created at about the same time.
 
-- the file must end with .zip
-- it's name must contain a pattern like put20181112 (but the current date instead)
-- the pattern should indicate not only the today's date, but also current or past HOUR
-- finds no more than N files (to avoding deleting anything unnecessary). The latest ones!
-- delete only if zpaqs are OK:
----- at least N were created this or past hour
----- all of them have non-zero sizes
+This script does the following checks before deleting a zip:
+
+- the zip must be created this or past hour (or after the given moment, see execute_deletion)
+- it must have a zpaq pair: the same prefix and shard, and the timestamps differ by no more than pair_max_gap_sec
+- delete only if its zpaq is OK:
+---- it has a non-zero size
 ---- the internal zpaq check has good outputs
 
+If the zpaq has a checksums manifest next to it (e.g. brainKeysOutput20210502112444.zpaq.checksums, see archiver.py),
+the files are extracted from it in batches, and their sizes and sha256 are compared with the ones recorded by
+the loggers at capture time. It proves that nothing was lost, not only that the zpaq is internally consistent.
+Otherwise, the internal zpaq check is used.
 
-LIMITATIONS:
-will not find zips if they were created yeasterday. 
-E.g. the scrypt was launched at 23:59, and the zips were created "yesterday" because of it. 
-The worst thing that will be because of it: zips are not deleted, which is ok
+The zpaqs are tested in parallel. The passed tests are saved in a ledger, together with the size and mtime
+of each zpaq. A zpaq that has not changed since its last passed test is not tested again (and not read at all).
 
 """
 
@@ -28,9 +39,7 @@ The worst thing that will be because of it: zips are not deleted, which is ok
 num_loggers = 5
 
 # TODO: move it to configs
-# to prevent the following situation:
-# some loggers doesnt work, and thus there are less than num_loggers archives to delete,
-# and thus this script will make a mistake and delete previous archives
+# only the archives with these prefixes are deleted (e.g. not the source code zips)
 archive_prefixes = {
     "brainKeysOutput",
     "brainMouseOutput",
@@ -44,9 +53,31 @@ archive_prefixes = {
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
 path_to_zpaq_exec = os.path.join(__location__, "zpaq715")
-folder_where_to_delete_stuff = __location__
+folder_where_to_delete_stuff = get_archives_dir(__location__)
 path4_fake_extract = "/temp"
 
+# the zpaqs that passed the test. Keyed by the full path, and checked against the size and mtime of the file
+verification_ledger_path = os.path.join(__location__, "zpaq_verification_ledger.json")
+
+# how many zpaqs are tested at the same time. Each test gets an equal share of the cores
+max_verification_workers = 4
+
+# the zip and zpaq of the same job are named a moment apart, see get_archive_name in archiver.py
+pair_max_gap_sec = 60
+
+# how many files are extracted at once to compare their checksums. Limits the temp space used
+checksums_batch_size = 200
+
+# a smaller zpaq is considered empty
+min_zpaq_size = 100
+
+# e.g. brainMicOtput20210502112444.zip or brainMicOtput20210502112444s20210428.zpaq (a shard of the logs)
+archive_name_regex = re.compile(r"^([A-Za-z]+?)(\d{14})(?:s(\d+))?\.(zip|zpaq)$")
+
+ArchiveEntry = namedtuple(
+    "ArchiveEntry", ["prefix", "timestamp", "shard_key", "kind", "size", "name"]
+)
+
 
 def delete_given_file(death_row_file):
     if os.path.isfile(death_row_file):
@@ -59,245 +90,303 @@ def delete_given_file(death_row_file):
         )
 
 
-def get_file_size_in_bytes(full_path):
-    stat_info = os.stat(full_path)
-    return stat_info.st_size  # Output is in bytes
-
-
 def join_paths(file_name):
     return os.path.join(folder_where_to_delete_stuff, file_name)
 
 
-def remove_letters(s):
-    new = ""
-    for letter in s:
-        if not (letter.isalpha()):
-            new += letter
-    return new
-
+def load_verification_ledger():
+    if not os.path.isfile(verification_ledger_path):
+        return dict()
+    try:
+        with open(verification_ledger_path) as ledger_f:
+            return json.load(ledger_f)
+    except (OSError, ValueError) as e:
+        print_and_log(
+            "failed to read the verification ledger, will test all zpaqs:", str(e)
+        )
+        return dict()
 
-def get_the_previous_hour(current_hour_string):  # input is a string
-    current_hour = int(current_hour_string)
-    if current_hour > 0:
-        past_h = str(current_hour - 1)  # output is a string
-    else:  # if it 0, then the previous hour was 23
-        past_h = str(23)
 
-    if len(past_h) < 2:  # the output should have 2 digital places
-        past_h = "0" + past_h
-    return past_h
+def save_verification_ledger(ledger):
+    # the records of the deleted zpaqs are not needed anymore
+    ledger = {path: record for path, record in ledger.items() if os.path.isfile(path)}
+    temp_path = verification_ledger_path + ".tmp"
+    with open(temp_path, "w") as ledger_f:
+        json.dump(ledger, ledger_f, indent=1)
+    os.replace(temp_path, verification_ledger_path)
 
 
-def execute_deletion():
-    # TODO: split the code into funcs
+def get_file_record(full_path):
+    """The zpaqs are only appended to (or rewritten), so a change always changes the size or the mtime.
+    It spares hashing the whole zpaq, on top of the test that reads it anyway
+    """
+    stat_info = os.stat(full_path)
+    return {"size": stat_info.st_size, "mtime_ns": stat_info.st_mtime_ns}
+
+
+def verify_checksums_in_zpaq(full_path, checksums, threads):
+    """Extracts the files from the zpaq in batches, and compares their sizes and sha256 with the given checksums.
+
+    Each batch is extracted into a temp dir, and deleted after hashing.
+
+    Args:
+        full_path: str: the zpaq
+        checksums: dict: the key is the filename, the value is a dict with the size and sha256, see read_checksums()
+        threads: int: for the zpaq extract
+    Returns:
+        code: int: 0 if all the files are in the zpaq and match the checksums. Otherwise, the zpaq exit code or 2
+    """
+    filenames = sorted(checksums.keys())
+    for i in range(0, len(filenames), checksums_batch_size):
+        batch = filenames[i : i + checksums_batch_size]
+        temp_dir = tempfile.mkdtemp(prefix="zpaq_checksums")
+        try:
+            command = [path_to_zpaq_exec, "extract", full_path] + batch
+            code = subprocess.call(command + ["-threads", str(threads)], cwd=temp_dir)
+            if code != 0:
+                return code
+            for filename in batch:
+                extracted_path = os.path.join(temp_dir, filename)
+                expected = checksums[filename]
+                if not os.path.isfile(extracted_path):
+                    print_and_log("    the file is missing in the zpaq:", filename)
+                    return 2
+                if (
+                    os.path.getsize(extracted_path) != expected["size"]
+                    or get_file_hash(extracted_path) != expected["sha256"]
+                ):
+                    print_and_log("    the file doesn't match its checksum:", filename)
+                    return 2
+                os.remove(extracted_path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return 0
+
+
+def verify_zpaq(full_path, ledger_record, threads):
+    """Tests the zpaq, unless it's unchanged since its last passed test.
+
+    The test is the checksums comparison if the zpaq has a checksums manifest, or the internal zpaq check otherwise.
+
+    Returns:
+        code: int: the zpaq exit code. 0 if OK, 1 in case of warnings, or 2 in case of an error
+        record: dict: the size and mtime of the tested zpaq, to save in the ledger
+    """
+    record = get_file_record(full_path)
+    if ledger_record is not None and ledger_record.get("code") == 0:
+        same7 = all(ledger_record.get(key) == record[key] for key in record)
+        if same7:
+            print_and_log("    unchanged since the last passed test:", full_path)
+            return 0, ledger_record
+
+    checksums_path = full_path + "." + checksums_filetype
+    print_and_log("    launching the extract command:", full_path)
+    if os.path.isfile(checksums_path):
+        code = verify_checksums_in_zpaq(
+            full_path, read_checksums(checksums_path), threads
+        )
+    else:
+        code = subprocess.call(
+            [
+                path_to_zpaq_exec,
+                "extract",
+                full_path,
+                "-to",
+                path4_fake_extract,
+                "-test",
+                "-threads",
+                str(threads),
+            ]
+        )
+    print_and_log("    the extract command finished with the code:", code)
+    # the zpaq could be modified during the test. Then the test result is not saved
+    if get_file_record(full_path) == record:
+        record["code"] = code
+    return code, record
+
+
+def verify_zpaqs(filenames):
+    """Tests the given zpaqs in parallel. Returns a dict: the zpaq exit code for each filename"""
+    ledger = load_verification_ledger()
+    full_paths = [join_paths(filename) for filename in filenames]
+    workers = max(1, min(max_verification_workers, len(full_paths)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    # threads are enough, as the tests are done by the zpaq processes
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            filename: pool.submit(verify_zpaq, path, ledger.get(path), threads)
+            for filename, path in zip(filenames, full_paths)
+        }
+        res = dict()
+        for filename, future in futures.items():
+            path = join_paths(filename)
+            try:
+                code, record = future.result()
+            except Exception as e:
+                print_and_log("failed to test the zpaq " + path + ":", str(e))
+                code, record = 2, None
+            res[filename] = code
+            if record is not None and "code" in record:
+                ledger[path] = record
+            else:
+                ledger.pop(path, None)
+
+    try:
+        save_verification_ledger(ledger)
+    except OSError as e:
+        print_and_log("failed to save the verification ledger:", str(e))
+    return res
+
+
+def parse_archive_name(filename):
+    """Returns (prefix, timestamp, shard_key, kind) if it's a name of a logger archive, None otherwise.
+
+    >>> parse_archive_name("brainMicOtput20210502112444s20210428.zpaq")
+    ('brainMicOtput', datetime.datetime(2021, 5, 2, 11, 24, 44), '20210428', 'zpaq')
+    >>> parse_archive_name("brainKeysOutput20210502112444.zip")[1:]
+    (datetime.datetime(2021, 5, 2, 11, 24, 44), '', 'zip')
+    >>> [parse_archive_name(n) for n in ["source_code20210502112444123.zip", "brainMicOtputJournal202105.zpaq"]]
+    [None, None]
+    """
+    match = archive_name_regex.match(filename)
+    if match is None or match.group(1) not in archive_prefixes:
+        return None
+    try:
+        timestamp = datetime.datetime.strptime(match.group(2), "%Y%m%d%H%M%S")
+    except ValueError:
+        return None
+    return match.group(1), timestamp, match.group(3) or "", match.group(4)
+
+
+def scan_archive_catalog(folder):
+    """Scans the dir once. Returns the list of ArchiveEntry, sorted by prefix, shard_key and timestamp.
+
+    The dir could contain millions of logs, so only the names ending with .zip or .zpaq are parsed and stat-ed.
+    """
+    res = []
+    with os.scandir(folder) as dir_entries:
+        for dir_entry in dir_entries:
+            name = dir_entry.name
+            if not (name.endswith(".zip") or name.endswith(".zpaq")):
+                continue
+            parsed = parse_archive_name(name)
+            if parsed is None or not dir_entry.is_file():
+                continue
+            res.append(ArchiveEntry(*parsed, dir_entry.stat().st_size, name))
+    res.sort()
+    return res
+
+
+def pair_archives(catalog, since, known_pairs=()):
+    """Pairs each zip created after the given moment with its zpaq.
+
+    The zpaq must have the same prefix and shard_key, and the closest timestamp, no further than pair_max_gap_sec.
+    The known_pairs (a list of (zip name, zpaq name)) are paired as is, whenever the zip was created.
+
+    >>> t0 = datetime.datetime(2021, 5, 2, 23, 59, 59)
+    >>> gap = datetime.timedelta(seconds=1)
+    >>> catalog0 = [ArchiveEntry("brainKeysOutput", t0, "", "zip", 10, "k0.zip")]
+    >>> catalog0 += [ArchiveEntry("brainKeysOutput", t0 + gap, "", "zpaq", 10, "k1.zpaq")]  # the next day
+    >>> catalog0 += [ArchiveEntry("brainMouseOutput", t0, "", "zip", 10, "m0.zip")]  # no zpaq
+    >>> [(zip_e.name, zpaq_e.name) for zip_e, zpaq_e in pair_archives(sorted(catalog0), t0 - 3600 * gap)]
+    [('k0.zip', 'k1.zpaq')]
+    >>> [(zip_e.name, zpaq_e.name) for zip_e, zpaq_e in pair_archives(sorted(catalog0), t0 + gap, [("k0.zip", "k1.zpaq")])]
+    [('k0.zip', 'k1.zpaq')]
+    """
+    zpaqs_by_key = dict()
+    for entry in catalog:
+        if entry.kind == "zpaq":
+            zpaqs_by_key.setdefault((entry.prefix, entry.shard_key), []).append(entry)
+    # the catalog is sorted, so are the zpaqs of each key
+    timestamps_by_key = {
+        key: [e.timestamp for e in zpaqs] for key, zpaqs in zpaqs_by_key.items()
+    }
+
+    max_gap = datetime.timedelta(seconds=pair_max_gap_sec)
+    res = []
+    for entry in catalog:
+        if entry.kind != "zip" or entry.timestamp < since:
+            continue
+        key = (entry.prefix, entry.shard_key)
+        timestamps = timestamps_by_key.get(key, [])
+        i = bisect.bisect_left(timestamps, entry.timestamp)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(timestamps)]
+        if len(candidates) == 0:
+            continue
+        best = min(candidates, key=lambda j: abs(timestamps[j] - entry.timestamp))
+        if abs(timestamps[best] - entry.timestamp) <= max_gap:
+            res.append((entry, zpaqs_by_key[key][best]))
+
+    entries_by_name = {entry.name: entry for entry in catalog}
+    paired_zips = {zip_entry.name for zip_entry, _ in res}
+    for zip_name, zpaq_name in known_pairs:
+        if zip_name in paired_zips:
+            continue
+        if zip_name in entries_by_name and zpaq_name in entries_by_name:
+            res.append((entries_by_name[zip_name], entries_by_name[zpaq_name]))
+            paired_zips.add(zip_name)
+    return res
+
+
+def execute_deletion(since=None, known_pairs=()):
+    """Deletes the recent zips that have valid zpaq pairs.
+
+    Args:
+        since: datetime: optional: only the zips created after this moment are considered.
+            By default, the zips created this or past hour
+        known_pairs: list: optional: (zip name, zpaq name) to consider regardless of since, e.g. of the resumed jobs
+    """
     print_and_log("######################### Starting #########################")
 
-    there_are_n_or_more_recent_zpaqs = False
-    there_are_n_or_more_recent_zpaqs_checked = False
-    the_recent_zpaqs_have_nonzero_sizes = False
-    the_recent_zpaqs_have_nonzero_sizes_checked = False
-    zpaq_test_outputs_good = False
-    zpaq_test_outputs_good_checked = False
-
-    current_hour = datetime.datetime.now()
-    current_hour = current_hour.strftime("%H")
-    pattern = human_timestamp()
-    pattern = "put" + pattern[:-10]  # sample result: put20181112
-    current_hour_pattern = pattern + current_hour
-    past_hour_pattern = pattern + get_the_previous_hour(current_hour)
-
-    print_and_log("patterns for zpaq search:")
-    print_and_log("currentHourPattern: ", current_hour_pattern)
-    print_and_log("pastHourPattern:    ", past_hour_pattern)
-
-    # find zpaqs for the checks
-    found_zpaqs = []
-
-    alist_filter = [".zpaq"]
-    path = folder_where_to_delete_stuff
-    for r, d, f in os.walk(path):
-        for filename in f:
-            if filename[-5:] in alist_filter and current_hour_pattern in filename:
-                found_zpaqs.append(filename)
-    for r, d, f in os.walk(path):
-        for filename in f:
-            if filename[-5:] in alist_filter and past_hour_pattern in filename:
-                found_zpaqs.append(filename)
+    if since is None:
+        since = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        since -= datetime.timedelta(hours=1)
+    print_and_log("searching for the zips created since", str(since))
+
+    catalog = scan_archive_catalog(folder_where_to_delete_stuff)
+    pairs = pair_archives(catalog, since, known_pairs)
 
     print_and_log("--------------------------------")
-    print_and_log("foundZpaqs:")
-    for element in found_zpaqs:
-        print_and_log(element)
+    print_and_log("found zip / zpaq pairs:")
+    for zip_entry, zpaq_entry in pairs:
+        print_and_log(zip_entry.name, zpaq_entry.name)
     print_and_log("--------------------------------")
 
-    # check if there N+ resent zpaqs found
-    if len(found_zpaqs) >= num_loggers:
-        there_are_n_or_more_recent_zpaqs = True
-    else:
+    paired_prefixes = {zip_entry.prefix for zip_entry, _ in pairs}
+    if len(paired_prefixes) < num_loggers:
         print_and_log(
-            "there_are_n_or_more_recent_zpaqs", str(there_are_n_or_more_recent_zpaqs)
+            "there are zpaqs only for %d loggers of %d. Some loggers werent working in the previous session?"
+            % (len(paired_prefixes), num_loggers)
         )
-    there_are_n_or_more_recent_zpaqs_checked = True
-
-    # check if they have non-zero sizes
 
-    if there_are_n_or_more_recent_zpaqs:
-        counting_zero_sized_files = 0
-        for element in found_zpaqs:
-            zp_full_path = join_paths(element)
-            if get_file_size_in_bytes(zp_full_path) < 100:
-                counting_zero_sized_files += 1
-
-        if counting_zero_sized_files == 0:
-            the_recent_zpaqs_have_nonzero_sizes = True
-        else:
-            print_and_log(
-                "the_recent_zpaqs_have_nonzero_sizes",
-                the_recent_zpaqs_have_nonzero_sizes,
-            )
-        the_recent_zpaqs_have_nonzero_sizes_checked = True
+    nonzero_zpaqs = []
+    for _, zpaq_entry in pairs:
+        if zpaq_entry.size < min_zpaq_size:
+            print_and_log("the zpaq is too small, not testing it:", zpaq_entry.name)
+        elif zpaq_entry.name not in nonzero_zpaqs:
+            nonzero_zpaqs.append(zpaq_entry.name)
 
     print_and_log("trying to extract zpacs")
-
-    if there_are_n_or_more_recent_zpaqs:
-        counting_none_ok_extracts = 0
-        for element in found_zpaqs:
-            path_to_this_zpaq = join_paths(element)
-            print_and_log("    launching the extract command")
-            zpaq_output = subprocess.call(
-                [
-                    path_to_zpaq_exec,
-                    "extract",
-                    path_to_this_zpaq,
-                    "-to",
-                    path4_fake_extract,
-                    "-test",
-                ]
-            )
-            print_and_log("    the extract command finished")
-            # zpaq returns 0 if successful, 1 in case of warnings, or 2 in case of an error.
-            if zpaq_output != 0:
-                counting_none_ok_extracts = +1
-
-        if counting_none_ok_extracts == 0:
-            zpaq_test_outputs_good = True
-        else:
-            print_and_log("zpaqTestOutputsGood", zpaq_test_outputs_good)
-        zpaq_test_outputs_good_checked = True
-
+    zpaq_codes = verify_zpaqs(nonzero_zpaqs) if len(nonzero_zpaqs) > 0 else dict()
     print_and_log("extracting zpacs finished")
 
-    if (
-        there_are_n_or_more_recent_zpaqs
-        & the_recent_zpaqs_have_nonzero_sizes
-        & zpaq_test_outputs_good
-    ):
-
-        # searching for zips
-
-        found_files = []
-
-        alist_filter = [".zip"]
-        path = folder_where_to_delete_stuff
-        for r, d, f in os.walk(path):
-            for filename in f:
-                if filename[-4:] in alist_filter and current_hour_pattern in filename:
-                    if (
-                        not "source" in filename
-                    ):  # don't count the zip with the source code
-                        found_files.append(filename)
-
-        for r, d, f in os.walk(path):
-            for filename in f:
-                if filename[-4:] in alist_filter and past_hour_pattern in filename:
-                    if (
-                        not "source" in filename
-                    ):  # don't count the zip with the source code
-                        found_files.append(filename)
-
-        # timestamps from the filenames of the found files
-        timestamps_of_found_files = []
-        for element in found_files:
-            tempst = remove_letters(element)
-            tempst = tempst[:-1]
-            timestamps_of_found_files.append(tempst)
-
-        timestamps_of_found_files.sort(reverse=True)
-
-        found_files_latest_n = []
-
-        i = 0
-        while (i < num_loggers) & (i < len(timestamps_of_found_files)):
-            time_str = timestamps_of_found_files[i]
-            for j in range(len(found_files)):
-                file_str = found_files[j]
-                if time_str in file_str:
-                    found_files_latest_n.append(file_str)
-            i += 1
-
-        found_files_latest_n = list(set(found_files_latest_n))
-
-        print(found_files_latest_n)
-
-        # to prevent the following situation:
-        # some loggers doesnt work, and thus there are less than N archives to delete,
-        # and thus this script (without this fix) will make a mistake and delete previous archives
-        files_by_prefix = dict()
-        for prefix in archive_prefixes:
-            templist = []
-            for found_file in found_files_latest_n:
-                if prefix in found_file:
-                    templist.append(found_file)
-            if len(templist) > 0:
-                templist.sort(reverse=True)
-                files_by_prefix[prefix] = templist[0]
-        print(files_by_prefix)
-        found_files_latest_n = list(files_by_prefix.values())
-        print(found_files_latest_n)
-
-        # TODO: printANDlog if there is something like this in files_by_prefix:
-        # 'brainSoundInput': [], 'brainScreenInput': []
-        # it means, some loggers werent working
-
-        print_and_log("-----------------------------")
-        print_and_log("foundFilesLatestN zips:")
-        for element in found_files_latest_n:
-            print_and_log(element)
-
-        if len(found_files_latest_n) < num_loggers:
+    kept_num = 0
+    for zip_entry, zpaq_entry in pairs:
+        # zpaq returns 0 if successful, 1 in case of warnings, or 2 in case of an error.
+        if zpaq_codes.get(zpaq_entry.name) == 0:
+            delete_given_file(join_paths(zip_entry.name))
+            forget_zip(zip_entry.name)
+        else:
+            kept_num += 1
             print_and_log(
-                "THERE ARE ALREADY less than N zips. Some loggers werent working in the previous session?"
+                "not deleting the zip, as its zpaq failed the checks:",
+                zip_entry.name + " " + zpaq_entry.name,
             )
-        else:
-            # deleting zips
-            print_and_log("-----------------------------")
-            print_and_log("Everything seems to be ok. Commencing deletion of zips")
-
-        for doomed_file in found_files_latest_n:
-            death_full_path = os.path.join(folder_where_to_delete_stuff, doomed_file)
-            delete_given_file(death_full_path)
-        print_and_log("deletion complete")
-
-    else:
-        print_and_log("not deleting anything bacause some checks were failed:")
-        print_and_log(
-            "thereAreNOrMoreRecentZpaqs: "
-            + str(there_are_n_or_more_recent_zpaqs)
-            + ". Checked? "
-            + str(there_are_n_or_more_recent_zpaqs_checked)
-        )
-        print_and_log(
-            "theRecentZpaqsHaveNonzeroSizes: "
-            + str(the_recent_zpaqs_have_nonzero_sizes)
-            + ". Checked?"
-            + str(the_recent_zpaqs_have_nonzero_sizes_checked)
-        )
-        print_and_log(
-            "zpaqTestOutputsGood: "
-            + str(zpaq_test_outputs_good)
-            + ". Checked?"
-            + str(zpaq_test_outputs_good_checked)
-        )
+    print_and_log(
+        "deletion complete. Deleted zips: %d, kept: %d"
+        % (len(pairs) - kept_num, kept_num)
+    )
 
     print_and_log("####### Exiting #######")
     print_and_log(" ")